@@ -0,0 +1,458 @@
+# Copyright © 2024 FriedrichFroebel
+#
+# This file is part of python-djvulibre.
+#
+# python-djvulibre is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+#
+# python-djvulibre is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+"""
+DjVuLibre bindings: batch processing of documents in worker processes.
+"""
+
+import collections
+import itertools
+import multiprocessing
+import os
+import queue
+from multiprocessing import resource_tracker, shared_memory
+
+import djvu.decode
+
+
+Task = collections.namedtuple('Task', ['kind', 'path', 'options'])
+Task.__doc__ = """
+A unit of work for a WorkerPool: a single document to process.
+
+Use render_pages(), extract_text(), page_info(), save() or export_ps() to
+create tasks.
+
+Tasks are hashable: options is a sorted tuple of (name, value) pairs.
+"""
+
+
+def _task(kind, path, **options):
+    # Page lists are stored as tuples, so that the task is hashable.
+    pages = options.get('pages')
+    if pages is not None:
+        options['pages'] = tuple(pages)
+    return Task(kind, path, tuple(sorted(options.items())))
+
+
+def render_pages(path, pages=None, mode=djvu.decode.RENDER_COLOR, dpi=None, pixel_format='RGB', row_alignment=1):
+    """
+    render_pages(path, pages=None, mode=RENDER_COLOR, dpi=None, pixel_format='RGB', row_alignment=1) -> a Task
+
+    Render the pages (all of them by default) of the document, scaled to
+    dpi resolution (or at their own resolution).
+
+    pixel_format is one of the names in PIXEL_FORMATS. Rows are stored top
+    to bottom.
+
+    The result is a list of (n, (width, height, row_size), image) tuples,
+    where image is a SharedImage.
+    """
+    if pixel_format not in PIXEL_FORMATS:
+        raise ValueError(f'Unknown pixel format: {pixel_format!r}')
+    return _task('render_pages', path, pages=pages, mode=mode, dpi=dpi, pixel_format=pixel_format, row_alignment=row_alignment)
+
+
+def extract_text(path, pages=None, details=djvu.decode.TEXT_DETAILS_ALL):
+    """
+    extract_text(path, pages=None, details=TEXT_DETAILS_ALL) -> a Task
+
+    Extract the hidden text of the pages (all of them by default).
+
+    The result is a list of (n, sexpr) tuples. See PageText.
+    """
+    return _task('extract_text', path, pages=pages, details=details)
+
+
+def page_info(path):
+    """
+    page_info(path) -> a Task
+
+    Obtain information about all the pages, without decoding them.
+
+    The result is a list of (n, (width, height), dpi, rotation) tuples.
+    """
+    return _task('page_info', path)
+
+
+def save(path, output, pages=None):
+    """
+    save(path, output, pages=None) -> a Task
+
+    Save the pages (all of them by default) as a bundled DjVu file named
+    output.
+
+    The result is output.
+    """
+    return _task('save', path, output=output, pages=pages)
+
+
+def export_ps(path, output, pages=None, **options):
+    """
+    export_ps(path, output, pages=None, **options) -> a Task
+
+    Convert the pages (all of them by default) into a PostScript file named
+    output. See Document.export_ps() for the options.
+
+    The result is output.
+    """
+    return _task('export_ps', path, output=output, pages=pages, **options)
+
+
+PIXEL_FORMATS = {
+    'RGB': lambda: djvu.decode.PixelFormatRgb('RGB'),
+    'BGR': lambda: djvu.decode.PixelFormatRgb('BGR'),
+    'RGBA': lambda: djvu.decode.PixelFormatRgba('RGBA'),
+    'BGRA': lambda: djvu.decode.PixelFormatRgba('BGRA'),
+    'L': lambda: djvu.decode.PixelFormatGrey(),
+    '1': lambda: djvu.decode.PixelFormatPackedBits('>'),
+}
+
+
+class SharedImage:
+    """
+    An image rendered by a worker process, in shared memory.
+
+    data is a memoryview of the image data. Call close() (or use the image as
+    a context manager) to free the shared memory as soon as you are done.
+    """
+
+    def __init__(self, name, nbytes):
+        self._shm = _attach_shared_memory(name)
+        self.data = self._shm.buf[:nbytes]
+
+    def close(self):
+        shm = self._shm
+        if shm is None:
+            return
+        self._shm = None
+        self.data.release()
+        try:
+            shm.close()
+        finally:
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __bytes__(self):
+        return self.data.tobytes()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _create_shared_memory(size):
+    # The shared memory is owned by the main process, which unlinks it;
+    # the resource tracker of the worker must not unlink it when the worker
+    # exits.
+    try:
+        return shared_memory.SharedMemory(create=True, size=size, track=False)
+    except TypeError:
+        # Python < 3.13
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: the shared memory is registered with the resource
+        # tracker, and then unregistered by unlink().
+        return shared_memory.SharedMemory(name=name)
+
+
+def _release_shared_memory(kind, result):
+    if kind != 'render_pages':
+        return
+    for n, size, name, nbytes in result:
+        SharedImage(name, nbytes).close()
+
+
+# Worker processes:
+
+_context = None
+
+
+def _init_worker(cache_size):
+    global _context
+    _context = djvu.decode.Context()
+    if cache_size is not None:
+        _context.cache_size = cache_size
+
+
+def _open_document(path):
+    document = _context.new_document(djvu.decode.FileUri(path))
+    document.decoding_job.wait()
+    if document.decoding_error:
+        raise document.decoding_status(path)
+    return document
+
+
+def _select_pages(document, pages):
+    if pages is None:
+        return list(document.pages)
+    return [document.pages[n] for n in pages]
+
+
+def _wait_for_job(job):
+    if job.is_error:
+        raise job.status
+
+
+def _render_pages(document, pages, mode, dpi, pixel_format, row_alignment):
+    results = []
+    pixel_format_name = pixel_format
+    try:
+        for page in _select_pages(document, pages):
+            job = page.decode(wait=True)
+            _wait_for_job(job)
+            width, height = job.size
+            if dpi is not None:
+                width = max(1, int(width * dpi / job.dpi + 0.5))
+                height = max(1, int(height * dpi / job.dpi + 0.5))
+            pixel_format = PIXEL_FORMATS[pixel_format_name]()
+            pixel_format.rows_top_to_bottom = 1
+            bpp = pixel_format.bpp
+            row_size = (width * bpp + 7) // 8
+            row_size = (row_size + row_alignment - 1) // row_alignment * row_alignment
+            nbytes = row_size * height
+            shm = _create_shared_memory(nbytes)
+            results += [(page.n, (width, height, row_size), shm.name, nbytes)]
+            buffer = shm.buf[:nbytes]
+            try:
+                rect = (0, 0, width, height)
+                job.render(mode, rect, rect, pixel_format, row_alignment, buffer)
+            finally:
+                buffer.release()
+                shm.close()
+    except BaseException:
+        _release_shared_memory('render_pages', results)
+        raise
+    return results
+
+
+def _extract_text(document, pages, details):
+    results = []
+    for page in _select_pages(document, pages):
+        text = djvu.decode.PageText(page, details)
+        text.wait()
+        results += [(page.n, text.sexpr)]
+    return results
+
+
+def _page_info(document):
+    results = []
+    for page in document.pages:
+        page.get_info()
+        results += [(page.n, page.size, page.dpi, page.rotation)]
+    return results
+
+
+def _save(document, output, pages):
+    with open(output, 'wb') as file:
+        job = document.save(file, pages=pages)
+    _wait_for_job(job)
+    return output
+
+
+def _export_ps(document, output, pages, **options):
+    with open(output, 'wb') as file:
+        job = document.export_ps(file, pages=pages, **options)
+    _wait_for_job(job)
+    return output
+
+
+_task_functions = dict(
+    render_pages=_render_pages,
+    extract_text=_extract_text,
+    page_info=_page_info,
+    save=_save,
+    export_ps=_export_ps,
+)
+
+
+def _run_chunk(chunk):
+    # Run tasks in a worker process. Return a list of (index, ok, result)
+    # tuples; exceptions are returned rather than raised, so that a single
+    # broken document does not spoil the whole chunk.
+    results = []
+    for index, task in chunk:
+        try:
+            document = _open_document(task.path)
+            result = _task_functions[task.kind](document, **dict(task.options))
+        except Exception as exception:
+            results += [(index, False, exception)]
+        else:
+            results += [(index, True, result)]
+        finally:
+            document = None
+    return results
+
+
+# Main process:
+
+class WorkerPool:
+    """
+    WorkerPool(workers=None, chunk_size=1, max_in_flight=None, max_documents=100, cache_size=None, mp_context=None)
+      -> a worker pool
+
+    A pool of worker processes, each with its own long-lived Context.
+
+    Tasks are sent to the workers in chunks of chunk_size tasks; at most
+    max_in_flight chunks (by default, twice the number of workers) are
+    submitted at any time, so that the task iterable can be arbitrarily long.
+
+    Each worker is replaced by a fresh process after it has processed about
+    max_documents documents, to keep the memory used by libdjvu in check.
+
+    If cache_size is not None, it is the cache size of the contexts of the
+    workers. mp_context is the multiprocessing context used to start the
+    workers (e.g. multiprocessing.get_context('spawn')); prefer the 'spawn' or
+    'forkserver' start methods if the main process uses contexts, too.
+    """
+
+    def __init__(self, workers=None, chunk_size=1, max_in_flight=None, max_documents=100, cache_size=None, mp_context=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        elif workers <= 0:
+            raise ValueError('workers must be a positive integer')
+        if chunk_size <= 0:
+            raise ValueError('chunk_size must be a positive integer')
+        if max_in_flight is None:
+            max_in_flight = 2 * workers
+        elif max_in_flight <= 0:
+            raise ValueError('max_in_flight must be a positive integer')
+        if max_documents <= 0:
+            raise ValueError('max_documents must be a positive integer')
+        if mp_context is None:
+            mp_context = multiprocessing.get_context()
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self._pool = mp_context.Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(cache_size,),
+            maxtasksperchild=max(1, max_documents // chunk_size),
+        )
+
+    def imap(self, tasks, return_exceptions=False):
+        """
+        P.imap(tasks, return_exceptions=False) -> an iterator
+
+        Run the tasks in the worker processes. Yield (task, result) pairs in
+        the order of completion.
+
+        If a task fails, the exception is raised; or, if return_exceptions
+        is true, yielded in place of the result.
+        """
+        tasks = enumerate(tasks)
+        done = queue.Queue()
+        submitted = {}
+        pending = 0
+        results = []
+
+        def on_error(exception):
+            done.put((False, exception))
+
+        try:
+            while True:
+                while tasks is not None and pending < self.max_in_flight:
+                    chunk = list(itertools.islice(tasks, self.chunk_size))
+                    if not chunk:
+                        tasks = None
+                        break
+                    submitted.update(chunk)
+                    self._pool.apply_async(_run_chunk, (chunk,), callback=lambda result: done.put((True, result)), error_callback=on_error)
+                    pending += 1
+                if pending == 0:
+                    break
+                ok, chunk_results = done.get()
+                pending -= 1
+                if not ok:
+                    raise chunk_results
+                results = list(chunk_results)
+                while results:
+                    index, ok, result = results.pop(0)
+                    task = submitted.pop(index)
+                    if not ok:
+                        if return_exceptions:
+                            yield task, result
+                            continue
+                        raise result
+                    if task.kind == 'render_pages':
+                        result = [
+                            (n, size, SharedImage(name, nbytes))
+                            for n, size, name, nbytes in result
+                        ]
+                    yield task, result
+        finally:
+            # Free the shared memory of the results that were not yielded,
+            # including those of the chunks in flight.
+            while True:
+                for index, ok, result in results:
+                    if ok:
+                        _release_shared_memory(submitted[index].kind, result)
+                if pending == 0:
+                    break
+                ok, results = done.get()
+                pending -= 1
+                if not ok:
+                    results = []
+
+    def close(self):
+        """
+        P.close() -> None
+
+        Wait until the workers finish, then stop them.
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """
+        P.terminate() -> None
+
+        Stop the workers immediately.
+        """
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+__all__ = [
+    'PIXEL_FORMATS',
+    'SharedImage',
+    'Task',
+    'WorkerPool',
+    'export_ps',
+    'extract_text',
+    'page_info',
+    'render_pages',
+    'save',
+]
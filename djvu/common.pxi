@@ -64,6 +64,19 @@ cdef object decode_utf8(const char *s):
 cdef extern from 'Python.h':
     int buffer_to_writable_memory 'PyObject_AsWriteBuffer'(object, void **, Py_ssize_t *)
 
+# Python buffers:
+
+from cpython.buffer cimport (  # noqa: F401
+    PyObject_GetBuffer as get_buffer,
+    PyBuffer_Release as release_buffer,
+    PyBUF_FORMAT, PyBUF_ND, PyBUF_STRIDES, PyBUF_RECORDS,
+    PyBUF_C_CONTIGUOUS, PyBUF_F_CONTIGUOUS, PyBUF_ANY_CONTIGUOUS,
+)
+from cpython.bytearray cimport (  # noqa: F401
+    PyByteArray_FromStringAndSize as make_bytearray,
+    PyByteArray_AS_STRING as bytearray_to_charp,
+)
+
 # Python booleans:
 
 from cpython cimport PyBool_FromLong as bool  # noqa: F401
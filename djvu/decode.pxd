@@ -192,6 +192,12 @@ cdef class Context
 cdef class Document
 
 
+cdef class DecodeScheduler
+
+
+cdef class PageJobCache
+
+
 cdef class DocumentExtension:
     cdef Document _document
 
@@ -201,7 +207,43 @@ cdef class DocumentPages(DocumentExtension):
 
 
 cdef class DocumentFiles(DocumentExtension):
-    cdef object _page_map
+    pass
+
+
+cdef class PageInfoTable:
+    cdef object _width
+    cdef object _height
+    cdef object _dpi
+    cdef object _rotation
+    cdef object _version
+
+
+cdef class FileTable:
+    cdef object _type
+    cdef object _n_page
+    cdef object _size
+    cdef tuple _id
+    cdef tuple _name
+    cdef tuple _title
+    cdef dict _page_map
+    cdef dict _id_map
+    cdef dict _name_map
+
+
+cdef class DocumentIndexEntry:
+    cdef PageInfoTable _page_info_table
+    cdef FileTable _file_table
+    cdef object _has_text
+    cdef object _outline
+    cdef object _annotations
+
+
+cdef class DocumentIndex:
+    cdef object _path
+    cdef object _connection
+    cdef object _lock
+    cdef object __weakref__
+    cdef object _reopen(self)
 
 
 cdef class Document:
@@ -211,6 +253,19 @@ cdef class Document:
     cdef DocumentFiles _files
     cdef object _queue
     cdef object _condition
+    cdef list _waiters
+    cdef object _weakref
+    cdef tuple _subscriptions
+    cdef unsigned int _subscription_mask
+    cdef object _render_caches
+    cdef dict _timestamps
+    cdef unsigned int _generation
+    cdef unsigned long long _serial
+    cdef PageInfoTable _page_info_table
+    cdef FileTable _file_table
+    cdef DocumentIndexEntry _index_entry
+    cdef PageJobCache _page_job_cache
+    cdef object _schedulers
     cdef object __weakref__
     cdef object _init(self, Context context, ddjvu_document_t* ddjvu_document)
     cdef object _clear(self)
@@ -229,6 +284,7 @@ cdef class DocumentOutline(DocumentExtension):
 cdef class Annotations:
     cdef _SexprWrapper _sexpr
     cdef object _update_sexpr(self)
+    cdef object _indexed_sexpr(self)
     cdef Document _document
 
 
@@ -251,6 +307,7 @@ cdef class File:
     cdef ddjvu_fileinfo_t ddjvu_fileinfo
     cdef Document _document
     cdef object _get_info(self)
+    cdef object _table_info(self)
 
 
 cdef class Page:
@@ -272,9 +329,94 @@ cdef class PageText:
     cdef object _update_sexpr(self)
 
 
+cdef class RenderBufferPool
+cdef class RenderCache
+cdef class Job
+
+
+cdef class QueuePolicy:
+    cdef Py_ssize_t _max_size
+    cdef int _drop_oldest
+    cdef int _coalesce
+    cdef Py_ssize_t _depth
+    cdef Py_ssize_t _max_depth
+    cdef object _dropped
+    cdef object _coalesced
+
+
+cdef class Subscription:
+    cdef object _owner
+    cdef object _types
+    cdef object _callback
+    cdef unsigned int _mask
+
+
+cdef class Histogram:
+    cdef long long _counts[34]
+    cdef long long _count
+    cdef double _total
+    cdef double _min
+    cdef double _max
+    cdef object _add(self, double value)
+    cdef dict _as_dict(self)
+
+
+cdef class Instrumentation:
+    cdef object _exporter
+    cdef int _profile
+    cdef object _tracer
+    cdef dict _histograms
+    cdef long long _message_counts[32]
+    cdef long long _documents_created
+    cdef long long _documents_decoded
+    cdef double _document_time
+    cdef long long _jobs_created
+    cdef long long _jobs_done
+    cdef double _job_time
+    cdef long long _render_calls
+    cdef long long _render_pixels
+    cdef double _render_time
+    cdef long long _stream_bytes
+    cdef Py_ssize_t _max_queue_depth
+    cdef object _reset(self)
+    cdef object _message_received(self, Context context, Job job, Document document, ddjvu_message_tag_t tag)
+    cdef Histogram _histogram(self, object name)
+    cdef object _trace(self, object event, object name)
+
+
+cdef class _RegisterLock:
+    cdef object _lock
+    cdef Instrumentation _instrumentation
+    cdef double _acquired
+
+
 cdef class Context:
     cdef ddjvu_context_t* ddjvu_context
     cdef object _queue
+    cdef object _register_lock
+    cdef _RegisterLock _profiled_register_lock
+    cdef QueuePolicy _queue_policy
+    cdef tuple _subscriptions
+    cdef unsigned int _subscription_mask
+    cdef object _message_types
+    cdef unsigned int _message_mask
+    cdef RenderBufferPool _buffer_pool
+    cdef RenderCache _render_cache
+    cdef Instrumentation _instrumentation
+    cdef object _argv0
+    cdef object __weakref__
+    cdef object _after_fork(self, object cache_size)
+    cdef object _registering(self)
+
+
+cdef class ContextPool:
+    cdef tuple _contexts
+    cdef object _lock
+    cdef list _loads
+    cdef dict _uris
+    cdef int _acquire(self, object uri) except -1
+    cdef object _release(self, object uri)
+    cdef object __weakref__
 
 
 cdef class PixelFormat:
@@ -294,6 +436,13 @@ cdef class PixelFormatRgbMask(PixelFormat):
     cdef unsigned int _params[4]
 
 
+cdef class PixelFormatRgba(PixelFormat):
+    cdef unsigned int _params[4]
+    cdef object _byte_order
+    cdef int _premultiplied
+    cdef int _alpha_index
+
+
 cdef class PixelFormatGrey(PixelFormat):
     pass
 
@@ -307,18 +456,115 @@ cdef class PixelFormatPackedBits(PixelFormat):
     pass
 
 
+cdef class RenderBufferPool:
+    cdef object _lock
+    cdef object _idle
+    cdef object _buckets
+    cdef Py_ssize_t _idle_bytes
+    cdef object _max_bytes
+    cdef object _hits
+    cdef object _misses
+    cdef object _evictions
+    cdef object __weakref__
+    cdef object _evict(self)
+
+
+cdef class RenderCache:
+    cdef object _lock
+    cdef object _entries
+    cdef object _documents
+    cdef Py_ssize_t _cached_bytes
+    cdef object _max_bytes
+    cdef object _hits
+    cdef object _misses
+    cdef object _evictions
+    cdef object __weakref__
+    cdef object _get(self, object key)
+    cdef object _put(self, Document document, object key, object data)
+    cdef object _forget(self, object key, object data)
+    cdef object _evict(self)
+    cdef object _invalidate(self, object document_key)
+
+
+cdef class PageJobCache:
+    cdef object _lock
+    cdef object _entries
+    cdef dict _pins
+    cdef dict _in_flight
+    cdef object _document_weakref
+    cdef Py_ssize_t _cached_bytes
+    cdef object _max_bytes
+    cdef object _hits
+    cdef object _misses
+    cdef object _evictions
+    cdef object _evicted_bytes
+    cdef object __weakref__
+    cdef PageJob _get(self, int n)
+    cdef object _start(self, PageJob job)
+    cdef object _put(self, PageJob job)
+    cdef object _evict(self)
+
+
+cdef class Image:
+    cdef object _buffer
+    cdef Py_buffer _view
+    cdef int _have_view
+    cdef char *_memory
+    cdef PixelFormat _pixel_format
+    cdef long _width
+    cdef long _height
+    cdef long _row_size
+    cdef int _ndim
+    cdef Py_ssize_t _shape[3]
+    cdef Py_ssize_t _strides[3]
+    cdef Py_ssize_t _itemsize
+    cdef Py_ssize_t _offset
+    cdef int _contiguous
+    cdef char *_format
+    cdef object _init(self, PixelFormat pixel_format, long width, long height, long row_size, object buffer)
+
+
 cdef class Job:
     cdef Context _context
     cdef ddjvu_job_t* ddjvu_job
     cdef object _queue
     cdef object _condition
+    cdef list _waiters
+    cdef object _weakref
+    cdef dict _timestamps
+    cdef unsigned int _generation
     cdef object _init(self, Context context, ddjvu_job_t *ddjvu_job)
     cdef object _clear(self)
     cdef object __weakref__
 
 
 cdef class PageJob(Job):
-    pass
+    cdef Document _document
+    cdef int _n
+    cdef long _updates
+    cdef int _cached
+    cdef DecodeScheduler _scheduler
+    cdef object _render_cached(
+        self, ddjvu_render_mode_t mode, ddjvu_rect_t *c_page_rect, ddjvu_rect_t *c_render_rect, PixelFormat pixel_format,
+        long row_alignment, long row_size
+    )
+
+
+cdef class DecodeScheduler:
+    cdef Document _document
+    cdef int _max_jobs
+    cdef int _prefetch
+    cdef object _condition
+    cdef list _heap
+    cdef dict _priorities
+    cdef dict _running
+    cdef dict _jobs
+    cdef unsigned long _seq
+    cdef object __weakref__
+    cdef object _push(self, int n, int priority)
+    cdef object _stop(self, int n)
+    cdef object _pump(self)
+    cdef object _job_done(self, PageJob job)
 
 
 cdef class SaveJob(Job):
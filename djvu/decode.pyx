@@ -29,6 +29,8 @@ The DDJVU API hides this complexity with a familiar event model.
 
 include 'common.pxi'
 
+cimport cython
+
 cdef object weakref
 import weakref
 
@@ -41,35 +43,105 @@ from queue import Queue, Empty
 cdef object Condition
 from threading import Condition
 
+cdef object get_running_loop
+from asyncio import get_running_loop
+
+cdef object ContextVar, contextmanager
+from contextvars import ContextVar
+from contextlib import contextmanager
+
 cdef object imap, izip
 imap = map
 izip = zip
 
-cdef object sys, devnull, format_exc
+cdef object sys, devnull, cpu_count, format_exc
 import sys
-from os import devnull
+from os import devnull, cpu_count
 from traceback import format_exc
 
+cdef object register_at_fork
+try:
+    from os import register_at_fork
+except ImportError:
+    # Windows
+    register_at_fork = None
+
 cdef object memoryview
 from builtins import memoryview
 
+cdef object OrderedDict
+from collections import OrderedDict
+
+cdef object SimpleNamespace
+from types import SimpleNamespace
+
+cdef object array
+from array import array
+
 cdef object StringIO
 from io import StringIO
 
-cdef object Symbol, SymbolExpression, InvalidExpression
-from djvu.sexpr import Symbol, SymbolExpression, InvalidExpression
+cdef object compressobj, crc32, struct_pack
+from zlib import compressobj, crc32
+from struct import pack as struct_pack
+
+cdef object monotonic
+from time import monotonic
+
+cdef object splitext, abspath, fspath, os_stat
+from os.path import splitext, abspath
+from os import fspath
+from os import stat as os_stat
+
+cdef object blake2b
+from hashlib import blake2b
+
+cdef object json_dumps, json_loads
+from json import dumps as json_dumps, loads as json_loads
+
+cdef object heappush, heappop
+from heapq import heappush, heappop
+
+cdef object ThreadPoolExecutor, FIRST_COMPLETED, wait_for_futures
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as wait_for_futures
+
+cdef object Expression, Symbol, SymbolExpression, InvalidExpression
+from djvu.sexpr import Expression, Symbol, SymbolExpression, InvalidExpression
 
 cdef object the_sentinel
 the_sentinel = object()
 
-cdef object _context_loft, _document_loft, _document_weak_loft, _job_loft, _job_weak_loft
-cdef Lock loft_lock
-_context_loft = {}
+# Documents and jobs are kept alive until they are done. Messages find their
+# Python objects through weak references stored as libdjvu user data. The user
+# data owns a reference to the weak reference, released in __dealloc__() once
+# the user data is reset: the garbage collector may clear the _weakref
+# attribute first.
+cdef object _document_loft, _job_loft
 _document_loft = set()
-_document_weak_loft = weakref.WeakValueDictionary()
 _job_loft = set()
-_job_weak_loft = weakref.WeakValueDictionary()
-loft_lock = allocate_lock()
+
+# Serial numbers of documents, which identify their images in render caches:
+# unlike the addresses of libdjvu documents, they are never reused.
+cdef unsigned long long document_serial = 0
+
+# Incremented in the child process after fork(). Documents and jobs created
+# in an earlier generation belong to libdjvu contexts whose threads did not
+# survive fork(); they are never released.
+cdef unsigned int fork_generation = 0
+
+
+cdef object check_generation(unsigned int generation):
+    # Waiting for a document or job of an earlier generation would block
+    # forever: refuse instead.
+    if generation != fork_generation:
+        raise RuntimeError('documents and jobs created before fork() cannot be used in the child process')
+
+
+cdef object from_user_data(void *user_data):
+    if user_data == NULL:
+        return
+    return (<object> user_data)()
 
 
 cdef extern from 'libdjvu/ddjvuapi.h':
@@ -186,6 +258,8 @@ cdef extern from 'libdjvu/ddjvuapi.h':
 
 # Python files:
 
+from cpython.ref cimport Py_INCREF, Py_DECREF
+
 from cpython cimport (
     PyErr_SetFromErrno as posix_error,
     PyObject_AsFileDescriptor as file_to_fd,
@@ -196,6 +270,7 @@ cdef int is_file(object o):
 from posix.unistd cimport dup
 from libc.stdio cimport fclose
 from libc.stdio cimport fdopen
+from libc.math cimport frexp
 
 cdef extern from 'langinfo.h':
     ctypedef enum nl_item:
@@ -234,6 +309,162 @@ cdef object write_unraisable_exception(object cause):
     )
 
 
+cdef object parallel_map
+
+
+def _parallel_map(function, iterable, int workers):
+    # Call function for every item of iterable, using a pool of worker
+    # threads. Yield (item, result) pairs in the order of completion.
+    # At most 2 * workers calls are in flight at any time, so that iterable
+    # can be arbitrarily long.
+    cdef int max_pending
+    max_pending = 2 * workers
+    pending = {}
+    iterator = iter(iterable)
+    executor = ThreadPoolExecutor(workers)
+    try:
+        while True:
+            while iterator is not None and len(pending) < max_pending:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    iterator = None
+                    break
+                pending[executor.submit(function, item)] = item
+            if not pending:
+                break
+            done, _ = wait_for_futures(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                yield item, future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+parallel_map = _parallel_map
+del _parallel_map
+
+
+cdef object set_future_done
+
+
+def _set_future_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+set_future_done = _set_future_done
+del _set_future_done
+
+
+cdef object current_deadline
+current_deadline = ContextVar('djvu.decode.deadline', default=None)
+
+
+cdef object get_deadline(object timeout, object deadline):
+    # Return the earliest of monotonic() + timeout, deadline and the deadline
+    # of the innermost deadline(...) block; or None if there is none.
+    end = current_deadline.get()
+    if deadline is not None and (end is None or deadline < end):
+        end = deadline
+    if timeout is not None:
+        timeout = monotonic() + timeout
+        if end is None or timeout < end:
+            end = timeout
+    return end
+
+
+cdef object wait_until(object condition, object end):
+    # Wait for the condition until end (a monotonic() value, or None).
+    # Return False if end has already passed.
+    # Assumption: the condition is already acquired.
+    if end is None:
+        condition.wait()
+        return True
+    timeout = end - monotonic()
+    if timeout <= 0:
+        return False
+    condition.wait(timeout)
+    return True
+
+
+cdef object wake_waiters(list waiters):
+    # Wake up coroutines suspended in wait_async(...).
+    # Assumption: the condition guarding the waiters is already acquired.
+    for loop, future in waiters:
+        try:
+            loop.call_soon_threadsafe(set_future_done, future)
+        except RuntimeError:
+            # The event loop is already closed.
+            pass
+    del waiters[:]
+
+
+cdef object wait_async
+
+
+async def _wait_async(condition, list waiters, ready, stop):
+    # Suspend the current coroutine until ready() returns true, without
+    # blocking the event loop thread. ready() is called with the condition
+    # acquired; the message distributor wakes up the waiters whenever it
+    # notifies the condition.
+    # If the deadline of the enclosing deadline(...) block passes first,
+    # call stop() (unless it is None) and raise DeadlineExceeded.
+    loop = get_running_loop()
+    end = get_deadline(None, None)
+    while True:
+        condition.acquire()
+        try:
+            if ready():
+                return
+            if end is not None:
+                timeout = end - monotonic()
+                if timeout <= 0:
+                    break
+            future = loop.create_future()
+            waiters.append((loop, future))
+        finally:
+            condition.release()
+        if end is None:
+            await future
+            continue
+        timer = loop.call_later(timeout, set_future_done, future)
+        try:
+            await future
+        finally:
+            timer.cancel()
+    if stop is not None:
+        stop()
+    raise DeadlineExceeded
+
+
+wait_async = _wait_async
+del _wait_async
+
+
+cdef object get_message_async
+
+
+async def _get_message_async(condition, list waiters, queue):
+    # The message distributor puts messages into the queue before it
+    # notifies the condition.
+    # Waiting for a message is not waiting for the job to finish: if the
+    # deadline passes, nothing is stopped.
+    while True:
+        await wait_async(condition, waiters, lambda: not queue.empty(), None)
+        try:
+            return queue.get_nowait()
+        except Empty:
+            # Another consumer was faster.
+            pass
+
+
+get_message_async = _get_message_async
+del _get_message_async
+
+
 cdef class _FileWrapper:
 
     cdef object _file
@@ -299,7 +530,8 @@ cdef class DocumentPages(DocumentExtension):
 
     Page indexing is zero-based, i.e. pages[0] stands for the very first page.
 
-    len(pages) might return 1 when called before receiving a DocInfoMessage.
+    len(pages) might return 1 when called before receiving a DocInfoMessage,
+    unless the document was opened with a DocumentIndex.
     """
 
     def __cinit__(self, Document document not None, **kwargs):
@@ -307,6 +539,8 @@ cdef class DocumentPages(DocumentExtension):
         self._document = document
 
     def __len__(self):
+        if self._document._page_info_table is not None:
+            return len(self._document._page_info_table)
         return ddjvu_document_get_pagenum(self._document.ddjvu_document)
 
     def __getitem__(self, key):
@@ -318,6 +552,201 @@ cdef class DocumentPages(DocumentExtension):
             raise TypeError('page numbers must be integers')
 
 
+cdef class PageInfoTable:
+    """
+    Information about all the pages of a document: their widths, heights,
+    resolutions, rotations and versions, as read-only memoryview columns of
+    C ints.
+
+    Use document.page_info_table(...) to obtain instances of this class.
+
+    table[n] is a (width, height, dpi, rotation, version) tuple for the n-th
+    page.
+    """
+
+    def __cinit__(self, **kwargs):
+        check_sentinel(self, kwargs)
+
+    property width:
+        """
+        Return the page widths, in pixels.
+        """
+        def __get__(self):
+            return memoryview(self._width).toreadonly()
+
+    property height:
+        """
+        Return the page heights, in pixels.
+        """
+        def __get__(self):
+            return memoryview(self._height).toreadonly()
+
+    property dpi:
+        """
+        Return the page resolutions, in pixels per inch.
+        """
+        def __get__(self):
+            return memoryview(self._dpi).toreadonly()
+
+    property rotation:
+        """
+        Return the initial page rotations, in degrees.
+        """
+        def __get__(self):
+            return memoryview(self._rotation).toreadonly()
+
+    property version:
+        """
+        Return the page versions.
+        """
+        def __get__(self):
+            return memoryview(self._version).toreadonly()
+
+    def __len__(self):
+        return len(self._width)
+
+    def __getitem__(self, n):
+        return self._width[n], self._height[n], self._dpi[n], self._rotation[n], self._version[n]
+
+    def __repr__(self):
+        return f'<{get_type_name(PageInfoTable)} of {len(self)} pages>'
+
+
+cdef class FileTable:
+    """
+    Information about all the component files of a document: their types,
+    page numbers, sizes, identifiers, names and titles, with maps from page
+    numbers, identifiers and names to file numbers.
+
+    Use document.file_table(...) to obtain instances of this class.
+
+    table[n] is a (type, n_page, size, id, name, title) tuple for the n-th
+    file. See File.
+    """
+
+    def __cinit__(self, **kwargs):
+        check_sentinel(self, kwargs)
+
+    property type:
+        """
+        Return the file types, as a string with one character per file. See
+        File.type.
+        """
+        def __get__(self):
+            return self._type
+
+    property n_page:
+        """
+        Return the page numbers, as a read-only memoryview; -1 stands for
+        files which are not pages.
+        """
+        def __get__(self):
+            return memoryview(self._n_page).toreadonly()
+
+    property size:
+        """
+        Return the file sizes, as a read-only memoryview; -1 stands for
+        unknown sizes.
+        """
+        def __get__(self):
+            return memoryview(self._size).toreadonly()
+
+    property id:
+        """
+        Return the file identifiers, as a tuple.
+        """
+        def __get__(self):
+            return self._id
+
+    property name:
+        """
+        Return the file names, as a tuple.
+        """
+        def __get__(self):
+            return self._name
+
+    property title:
+        """
+        Return the file titles, as a tuple.
+        """
+        def __get__(self):
+            return self._title
+
+    def find_page(self, n):
+        """
+        T.find_page(n) -> a file number
+
+        Return the number of the file of the n-th page.
+
+        Possible exceptions: KeyError.
+        """
+        return self._page_map[n]
+
+    def find_id(self, id):
+        """
+        T.find_id(id) -> a file number
+
+        Return the number of the file with the identifier.
+
+        Possible exceptions: KeyError.
+        """
+        return self._id_map[id]
+
+    def find_name(self, name):
+        """
+        T.find_name(name) -> a file number
+
+        Return the number of the file with the name.
+
+        Possible exceptions: KeyError.
+        """
+        return self._name_map[name]
+
+    def __len__(self):
+        return len(self._type)
+
+    def __getitem__(self, n):
+        n_page = self._n_page[n]
+        size = self._size[n]
+        return (
+            self._type[n],
+            n_page if n_page >= 0 else None,
+            size if size >= 0 else None,
+            self._id[n], self._name[n], self._title[n]
+        )
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def __repr__(self):
+        return f'<{get_type_name(FileTable)} of {len(self)} files>'
+
+
+cdef FileTable new_file_table(object files):
+    # files is a sequence of (type, n_page, size, id, name, title) tuples.
+    cdef FileTable table
+    cdef Py_ssize_t i
+    table = FileTable(sentinel = the_sentinel)
+    table._type = str.join('', [file[0] for file in files])
+    table._n_page = array('i', [-1 if file[1] is None else file[1] for file in files])
+    table._size = array('i', [-1 if file[2] is None else file[2] for file in files])
+    table._id = tuple([file[3] for file in files])
+    table._name = tuple([file[4] for file in files])
+    table._title = tuple([file[5] for file in files])
+    table._page_map = {}
+    table._id_map = {}
+    table._name_map = {}
+    for i in range(len(files)):
+        if table._n_page[i] >= 0:
+            table._page_map[table._n_page[i]] = i
+        if table._id[i] is not None:
+            table._id_map[table._id[i]] = i
+        if table._name[i] is not None:
+            table._name_map[table._name[i]] = i
+    return table
+
+
 cdef class Page:
     """
     Page of a document.
@@ -326,9 +755,18 @@ cdef class Page:
     """
 
     def __cinit__(self, Document document not None, int n):
+        cdef PageInfoTable table
         self._document = document
         self._have_info = 0
         self._n = n
+        table = document._page_info_table
+        if table is not None and 0 <= n < len(table):
+            self.ddjvu_pageinfo.width = table._width[n]
+            self.ddjvu_pageinfo.height = table._height[n]
+            self.ddjvu_pageinfo.dpi = table._dpi[n]
+            self.ddjvu_pageinfo.rotation = table._rotation[n] // 90
+            self.ddjvu_pageinfo.version = table._version[n]
+            self._have_info = 1
 
     property document:
         """
@@ -360,6 +798,24 @@ cdef class Page:
         def __get__(self):
             return Thumbnail(self)
 
+    property has_text:
+        """
+        Return True if the page has a hidden text layer.
+
+        If the document was opened with a DocumentIndex that recorded the
+        text layers, the text is not decoded.
+
+        If the text is not available, raise NotAvailable exception.
+
+        Possible exceptions: NotAvailable, JobFailed.
+        """
+        def __get__(self):
+            cdef DocumentIndexEntry entry
+            entry = self._document._index_entry
+            if entry is not None and entry._has_text is not None and self._n < len(entry._has_text):
+                return bool(entry._has_text[self._n])
+            return len(PageText(self, TEXT_DETAILS_PAGE).sexpr) > 0
+
     cdef object _get_info(self):
         cdef ddjvu_status_t status
         if self._have_info:
@@ -373,25 +829,32 @@ cdef class Page:
         else:
             raise ex
 
-    def get_info(self, wait=1):
+    def get_info(self, wait=1, timeout=None, deadline=None):
         """
-        P.get_info(wait=True) -> None
+        P.get_info(wait=True, timeout=None, deadline=None) -> None
 
         Attempt to obtain information about the page without decoding the page.
 
-        If wait is true, wait until the information is available.
+        If wait is true, wait until the information is available. If the
+        timeout (in seconds) or the deadline (a time.monotonic() value), or
+        the deadline of the enclosing deadline(...) block, passes first,
+        raise DeadlineExceeded. Decoding of the document goes on.
 
         If the information is not available, raise NotAvailable exception.
         Then, start fetching the page data, which causes emission of
         PageInfoMessage messages with empty .page_job.
 
-        Possible exceptions: NotAvailable, JobFailed.
+        Possible exceptions: NotAvailable, JobFailed, DeadlineExceeded,
+        RuntimeError (if the document was created before fork() in the parent
+        process).
         """
         cdef ddjvu_status_t status
         if self._have_info:
             return
+        check_generation(self._document._generation)
         if not wait:
             return self._get_info()
+        end = get_deadline(timeout, deadline)
         while True:
             self._document._condition.acquire()
             try:
@@ -401,11 +864,39 @@ cdef class Page:
                     self._have_info = 1
                     return
                 elif ex is JobStarted:
-                    self._document._condition.wait()
+                    if not wait_until(self._document._condition, end):
+                        break
                 else:
                     raise ex
             finally:
                 self._document._condition.release()
+        raise DeadlineExceeded
+
+    async def get_info_async(self):
+        """
+        P.get_info_async() -> None
+
+        Coroutine version of get_info(wait=True): wait until the information
+        about the page is available, without blocking the event loop.
+
+        Possible exceptions: JobFailed, RuntimeError.
+        """
+
+        def ready():
+            cdef ddjvu_status_t status
+            status = ddjvu_document_get_pageinfo(self._document.ddjvu_document, self._n, &self.ddjvu_pageinfo)
+            ex = JobException_from_c(status)
+            if ex is JobOK:
+                self._have_info = 1
+                return True
+            elif ex is JobStarted:
+                return False
+            raise ex
+
+        if self._have_info:
+            return
+        check_generation(self._document._generation)
+        await wait_async(self._document._condition, self._document._waiters, ready, None)
 
     property width:
         """
@@ -501,16 +992,26 @@ cdef class Page:
 
         If wait is true, wait until the job is done.
 
+        If the document has a page_job_cache holding a job of the page, or if
+        a job of the page started through the cache is still in flight,
+        return that job instead.
+
         Possible exceptions:
 
         - NotAvailable (if called before receiving the DocInfoMessage).
         - JobFailed (if document decoding failed).
+        - RuntimeError (if the document was created before fork() in the
+          parent process).
         """
         cdef PageJob job
         cdef ddjvu_job_t* ddjvu_job
-        with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
-        try:
+        cdef PageJobCache cache = self._document._page_job_cache
+        check_generation(self._document._generation)
+        if cache is not None:
+            job = cache._get(self._n)
+            if job is not None:
+                return job
+        with self._document._context._registering():
             ddjvu_job = <ddjvu_job_t*> ddjvu_page_create_by_pageno(self._document.ddjvu_document, self._n)
             if ddjvu_job == NULL:
                 raise _NotAvailable_
@@ -518,12 +1019,71 @@ cdef class Page:
                 raise JobException_from_c(ddjvu_document_decoding_status(self._document.ddjvu_document))
             job = PageJob(sentinel = the_sentinel)
             job._init(self._document._context, ddjvu_job)
-        finally:
-            release_lock(loft_lock)
+            job._document = self._document
+            job._n = self._n
+        if cache is not None:
+            cache._start(job)
         if wait:
             job.wait()
+        if cache is not None:
+            cache._put(job)
         return job
 
+    def render_to_file(self, file, format=None, dpi=None, ddjvu_render_mode_t mode=DDJVU_RENDER_COLOR):
+        """
+        P.render_to_file(file, format=None, dpi=None, mode=RENDER_COLOR) -> (w, h)
+
+        Decode the page and render it in full, with the mode layers (see
+        PageJob.render() for the possible values), at dpi resolution (or at
+        the page's own resolution if dpi is None), into an image file.
+
+        file is either a file name or a file-like object opened in binary
+        mode. format is one of:
+
+        'png'
+            PNG image: 8-bit RGB, or 1-bit greyscale for bitonal pages that
+            are not scaled down
+        'ppm'
+            binary PPM image (8-bit RGB)
+        'pgm'
+            binary PGM image (8-bit greyscale)
+        'pbm'
+            binary PBM image (1-bit)
+
+        If format is None, it is determined from the file name extension, or
+        is 'png' if there is no file name.
+
+        The page is rendered stripe by stripe, and the rows are streamed into
+        the encoder, so that the whole image is never held in memory.
+
+        Return the image dimensions in pixels.
+
+        Possible exceptions: NotAvailable, JobFailed, ValueError (if the
+        format is unknown).
+        """
+        cdef PageJob job
+        is_file_name = not hasattr(file, 'write')
+        if format is None:
+            if is_file_name:
+                format = splitext(fspath(file))[1][1:]
+                if is_bytes(format):
+                    format = format.decode('ASCII', 'replace')
+                format = format.lower()
+            else:
+                format = 'png'
+        if format not in image_file_formats:
+            raise ValueError(f'Unknown image format: {format!r}')
+        if dpi is not None and dpi <= 0:
+            raise ValueError('dpi must be a positive number or none')
+        job, width, height = decode_page(self, dpi)
+        bitonal = job.type == DDJVU_PAGETYPE_BITONAL and (dpi is None or dpi >= job.dpi)
+        if is_file_name:
+            with open(file, 'wb') as fp:
+                write_image(job, fp, format, mode, width, height, bitonal)
+        else:
+            write_image(job, file, format, mode, width, height, bitonal)
+        return width, height
+
     property annotations:
         """
         Return PageAnnotations for the page.
@@ -590,6 +1150,8 @@ cdef class Thumbnail:
         * with each row starting at row_alignment bytes boundary;
         * into the provided buffer or to a newly created string.
 
+        buffer may also be a RenderBufferPool, as for PageJob.render(...).
+
         Raise NotAvailable when no thumbnail is available.
         Otherwise, return a ((w1, h1, row_size), data) tuple:
 
@@ -600,8 +1162,12 @@ cdef class Thumbnail:
           actual image data.
         """
         cdef int iw, ih
+        cdef int rc
+        cdef int alpha_index = -1
         cdef long w, h, row_size
         cdef void* memory
+        cdef ddjvu_document_t* ddjvu_document
+        cdef ddjvu_format_t* ddjvu_format
         if row_alignment <= 0:
             raise ValueError('row_alignment must be a positive integer')
         w, h = size
@@ -615,8 +1181,20 @@ cdef class Thumbnail:
             result = None
             memory = NULL
         else:
+            if buffer is None:
+                buffer = self._page._document._context._buffer_pool
             (result, memview) = allocate_image_memory(row_size, h, buffer, &memory)
-        if ddjvu_thumbnail_render(self._page._document.ddjvu_document, self._page._n, &iw, &ih, pixel_format.ddjvu_format, row_size, <char*> memory):
+        ddjvu_document = self._page._document.ddjvu_document
+        ddjvu_format = pixel_format.ddjvu_format
+        if typecheck(pixel_format, PixelFormatRgba):
+            alpha_index = (<PixelFormatRgba> pixel_format)._alpha_index
+        # result and memview keep the image memory alive while the GIL is released.
+        with nogil:
+            rc = ddjvu_thumbnail_render(ddjvu_document, self._page._n, &iw, &ih, ddjvu_format, row_size, <char*> memory)
+            if rc and memory != NULL and alpha_index >= 0:
+                # Thumbnails have no mask: they are opaque.
+                fill_alpha(<char*> memory, iw, ih, row_size, alpha_index)
+        if rc:
             return (iw, ih, row_size), result
         else:
             raise _NotAvailable_
@@ -634,23 +1212,29 @@ cdef class DocumentFiles(DocumentExtension):
     File indexing is zero-based, i.e. files[0] stands for the very first file.
 
     len(files) might raise NotAvailable when called before receiving
-    a DocInfoMessage.
+    a DocInfoMessage, unless the document was opened with a DocumentIndex.
+
+    files[page] is the File of the Page; files[id_or_name] is the File with
+    the identifier or, failing that, the name. These lookups use
+    document.file_table() and raise NotAvailable if the table is not
+    available yet.
     """
 
     def __cinit__(self, Document document not None, **kwargs):
         check_sentinel(self, kwargs)
-        self._page_map = None
         self._document = document
 
     def __len__(self):
         cdef int result
+        if self._document._file_table is not None:
+            return len(self._document._file_table)
         result = ddjvu_document_get_filenum(self._document.ddjvu_document)
         if result is None:
             raise _NotAvailable_
         return result
 
     def __getitem__(self, key):
-        cdef int i
+        cdef FileTable table
         if is_int(key):
             if key < 0 or key >= len(self):
                 raise IndexError('file number out of range')
@@ -658,19 +1242,23 @@ cdef class DocumentFiles(DocumentExtension):
         elif typecheck(key, Page):
             if (<Page>key)._document is not self._document:
                 raise KeyError(key)
-            if self._page_map is None:
-                self._page_map = {}
-                for i in range(len(self)):
-                    file = File(self._document, i, sentinel = the_sentinel)
-                    n_page = file.n_page
-                    if n_page is not None:
-                        self._page_map[n_page] = file
+            table = self._document.file_table(wait=False)
             try:
-                return self._page_map[(<Page>key)._n]
+                n = table._page_map[(<Page>key)._n]
             except KeyError:
                 raise KeyError(key)
+        elif is_unicode(key):
+            table = self._document.file_table(wait=False)
+            try:
+                n = table._id_map[key]
+            except KeyError:
+                try:
+                    n = table._name_map[key]
+                except KeyError:
+                    raise KeyError(key)
         else:
-            raise TypeError('DocumentFiles indices must be integers or Page instances')
+            raise TypeError('DocumentFiles indices must be integers, strings or Page instances')
+        return File(self._document, n, sentinel = the_sentinel)
 
 
 cdef class File:
@@ -702,6 +1290,15 @@ cdef class File:
         def __get__(self):
             return self._n
 
+    cdef object _table_info(self):
+        # A (type, n_page, size, id, name, title) tuple from the file table
+        # of the document, or None.
+        cdef FileTable table
+        table = self._document._file_table
+        if table is None or self._n >= len(table):
+            return
+        return table[self._n]
+
     cdef object _get_info(self):
         cdef ddjvu_status_t status
         if self._have_info:
@@ -715,21 +1312,25 @@ cdef class File:
         else:
             raise ex
 
-    def get_info(self, wait=1):
+    def get_info(self, wait=1, timeout=None, deadline=None):
         """
-        F.get_info(wait=True) -> None
+        F.get_info(wait=True, timeout=None, deadline=None) -> None
 
         Attempt to obtain information about the component file.
 
-        If wait is true, wait until the information is available.
+        If wait is true, wait until the information is available. See
+        Page.get_info() for timeout and deadline.
 
-        Possible exceptions: NotAvailable, JobFailed.
+        Possible exceptions: NotAvailable, JobFailed, DeadlineExceeded,
+        RuntimeError.
         """
         cdef ddjvu_status_t status
-        if self._have_info:
+        if self._have_info or self._table_info() is not None:
             return
+        check_generation(self._document._generation)
         if not wait:
             return self._get_info()
+        end = get_deadline(timeout, deadline)
         while True:
             self._document._condition.acquire()
             try:
@@ -739,11 +1340,13 @@ cdef class File:
                     self._have_info = 1
                     return
                 elif ex is JobStarted:
-                    self._document._condition.wait()
+                    if not wait_until(self._document._condition, end):
+                        break
                 else:
                     raise ex
             finally:
                 self._document._condition.release()
+        raise DeadlineExceeded
 
     property type:
         """
@@ -756,6 +1359,9 @@ cdef class File:
         Possible exceptions: NotAvailable, JobFailed.
         """
         def __get__(self):
+            info = self._table_info()
+            if info is not None:
+                return info[0]
             cdef char buffer[2]
             self._get_info()
             buffer[0] = self.ddjvu_fileinfo.type
@@ -771,6 +1377,9 @@ cdef class File:
         Possible exceptions: NotAvailable, JobFailed.
         """
         def __get__(self):
+            info = self._table_info()
+            if info is not None:
+                return info[1]
             self._get_info()
             if self.ddjvu_fileinfo.pageno < 0:
                 return
@@ -784,6 +1393,11 @@ cdef class File:
         Possible exceptions: NotAvailable, JobFailed.
         """
         def __get__(self):
+            info = self._table_info()
+            if info is not None:
+                if info[1] is None:
+                    return
+                return self._document.pages[info[1]]
             self._get_info()
             if self.ddjvu_fileinfo.pageno < 0:
                 return
@@ -797,6 +1411,9 @@ cdef class File:
         Possible exceptions: NotAvailable, JobFailed.
         """
         def __get__(self):
+            info = self._table_info()
+            if info is not None:
+                return info[2]
             self._get_info()
             if self.ddjvu_fileinfo.size < 0:
                 return
@@ -810,6 +1427,9 @@ cdef class File:
         Possible exceptions: NotAvailable, JobFailed.
         """
         def __get__(self):
+            info = self._table_info()
+            if info is not None:
+                return info[3]
             self._get_info()
             cdef char* result
             result = <char*> self.ddjvu_fileinfo.id
@@ -825,6 +1445,9 @@ cdef class File:
         Possible exceptions: NotAvailable, JobFailed.
         """
         def __get__(self):
+            info = self._table_info()
+            if info is not None:
+                return info[4]
             self._get_info()
             cdef char* result
             result = <char*> self.ddjvu_fileinfo.name
@@ -840,6 +1463,9 @@ cdef class File:
         Possible exceptions: NotAvailable, JobFailed.
         """
         def __get__(self):
+            info = self._table_info()
+            if info is not None:
+                return info[5]
             self._get_info()
             cdef char* result
             result = <char*> self.ddjvu_fileinfo.title
@@ -919,14 +1545,22 @@ cdef class SaveJob(Job):
     def __cinit__(self, **kwargs):
         self._file = None
 
-    def wait(self):
-        Job.wait(self)
+    def wait(self, timeout=None, deadline=None):
+        # If the deadline passes, the file is left open: the job might still
+        # be writing to it.
+        Job.wait(self, timeout, deadline)
         # Ensure that the underlying file is flushed.
         # FIXME: In Python 3, the file might be never flushed if you do not use wait()!
         if self._file is not None:
             (<_FileWrapper> self._file).close()
             self._file = None
 
+    async def wait_async(self):
+        await Job.wait_async(self)
+        if self._file is not None:
+            (<_FileWrapper> self._file).close()
+            self._file = None
+
 
 cdef class DocumentDecodingJob(Job):
     """
@@ -939,7 +1573,9 @@ cdef class DocumentDecodingJob(Job):
         self._context = document._context
         self._document = document
         self._condition = document._condition
+        self._waiters = document._waiters
         self._queue = document._queue
+        self._generation = document._generation
         self.ddjvu_job = <ddjvu_job_t*> document.ddjvu_document
 
     def __dealloc__(self):
@@ -949,6 +1585,10 @@ cdef class DocumentDecodingJob(Job):
         return f'<{get_type_name(DocumentDecodingJob)} for {self._document!r}>'
 
 
+# Documents are always in reference cycles (with their DocumentPages and
+# DocumentFiles); the garbage collector must break them elsewhere, so that
+# __dealloc__() still finds the render caches to invalidate.
+@cython.no_gc_clear
 cdef class Document:
     """
     DjVu document.
@@ -962,24 +1602,35 @@ cdef class Document:
         self._pages = DocumentPages(self, sentinel = the_sentinel)
         self._files = DocumentFiles(self, sentinel = the_sentinel)
         self._context = None
-        self._queue = Queue()
+        self._queue = MessageQueue()
         self._condition = Condition()
+        self._waiters = []
+        self._subscriptions = ()
+        self._subscription_mask = 0
+        self._render_caches = set()
+        self._timestamps = None
+        self._index_entry = None
 
     cdef object _init(self, Context context, ddjvu_document_t *ddjvu_document):
-        # Assumption: loft_lock is already acquired.
+        # Assumption: context._register_lock is already acquired.
+        global document_serial
         assert (context is not None) and ddjvu_document != NULL
         self.ddjvu_document = ddjvu_document
         self._context = context
+        document_serial += 1
+        self._serial = document_serial
+        self._queue = MessageQueue(context._queue_policy)
+        self._generation = fork_generation
+        if context._instrumentation is not None:
+            self._timestamps = dict(created=monotonic())
+            context._instrumentation._documents_created += 1
+        self._weakref = weakref.ref(self)
+        Py_INCREF(self._weakref)
+        ddjvu_document_set_user_data(ddjvu_document, <void*> self._weakref)
         _document_loft.add(self)
-        _document_weak_loft[voidp_to_int(ddjvu_document)] = self
 
     cdef object _clear(self):
-        with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
-        try:
-            _document_loft.discard(self)
-        finally:
-            release_lock(loft_lock)
+        _document_loft.discard(self)
 
     property decoding_status:
         """
@@ -1002,6 +1653,55 @@ cdef class Document:
         def __get__(self):
             return bool(ddjvu_document_decoding_done(self.ddjvu_document))
 
+    property timestamps:
+        """
+        Return a dictionary mapping the lifecycle events of the document to
+        their time.monotonic() values:
+
+        * 'created' -- when the document was created by
+          Context.new_document(...);
+        * 'info' -- when the DocInfoMessage was received.
+
+        Timestamps are recorded only if the context had an Instrumentation
+        when the document was created; otherwise, the dictionary is empty.
+        """
+        def __get__(self):
+            if self._timestamps is None:
+                return {}
+            return dict(self._timestamps)
+
+    property page_job_cache:
+        """
+        The PageJobCache of completed PageJobs of this document, or None.
+
+        The default is None, i.e. do not cache page jobs. A cache can be
+        attached to a single document only.
+
+        Possible exceptions: ValueError.
+        """
+
+        def __get__(self):
+            return self._page_job_cache
+
+        def __set__(self, PageJobCache value):
+            if value is not None:
+                document = None
+                if value._document_weakref is not None:
+                    document = value._document_weakref()
+                if document is not None and document is not self:
+                    raise ValueError('cache is already attached to another document')
+                value._document_weakref = self._weakref
+            self._page_job_cache = value
+
+    property index_entry:
+        """
+        Return the DocumentIndexEntry the document was opened with, or None.
+
+        See Context.new_document(...).
+        """
+        def __get__(self):
+            return self._index_entry
+
     property decoding_job:
         """
         Return the DocumentDecodingJob.
@@ -1036,14 +1736,163 @@ cdef class Document:
         def __get__(self):
             return self._pages
 
-    property files:
-        """
-        Return the DocumentPages.
+    def page_info_table(self, wait=1, timeout=None, deadline=None):
         """
-        def __get__(self):
-            return self._files
+        D.page_info_table(wait=True, timeout=None, deadline=None) -> a PageInfoTable
 
-    property outline:
+        Obtain information about all the pages at once, without decoding
+        them. The table is cached; pages obtained from document.pages
+        afterwards do not need to call get_info().
+
+        If the document was opened with a DocumentIndex, the table comes from
+        the index and is available at once.
+
+        If wait is true, wait until the information about all the pages is
+        available. See Page.get_info() for timeout and deadline.
+
+        If the information is not available, raise NotAvailable exception.
+
+        Possible exceptions: NotAvailable, JobFailed, DeadlineExceeded.
+        """
+        cdef PageInfoTable table
+        cdef ddjvu_pageinfo_t info
+        cdef ddjvu_status_t status
+        cdef int expired = 0
+        cdef int i, n
+        if self._page_info_table is not None:
+            return self._page_info_table
+        end = get_deadline(timeout, deadline)
+        self._condition.acquire()
+        try:
+            # The number of pages is known only after decoding the document.
+            while not ddjvu_document_decoding_done(self.ddjvu_document):
+                if not wait:
+                    raise _NotAvailable_
+                if not wait_until(self._condition, end):
+                    expired = 1
+                    break
+            if not expired:
+                if ddjvu_document_decoding_error(self.ddjvu_document):
+                    raise JobException_from_c(ddjvu_document_decoding_status(self.ddjvu_document))
+                n = ddjvu_document_get_pagenum(self.ddjvu_document)
+                table = PageInfoTable(sentinel = the_sentinel)
+                table._width = array('i', [0]) * n
+                table._height = array('i', [0]) * n
+                table._dpi = array('i', [0]) * n
+                table._rotation = array('i', [0]) * n
+                table._version = array('i', [0]) * n
+                # Ask for all the missing pages before waiting, so that
+                # their data is fetched at once.
+                missing = range(n)
+                while True:
+                    still_missing = []
+                    for i in missing:
+                        status = ddjvu_document_get_pageinfo(self.ddjvu_document, i, &info)
+                        if status == DDJVU_JOB_OK:
+                            table._width[i] = info.width
+                            table._height[i] = info.height
+                            table._dpi[i] = info.dpi
+                            table._rotation[i] = info.rotation * 90
+                            table._version[i] = info.version
+                        elif status < DDJVU_JOB_OK:
+                            still_missing += [i]
+                        else:
+                            raise JobException_from_c(status)
+                    missing = still_missing
+                    if not missing:
+                        break
+                    if not wait:
+                        raise _NotAvailable_
+                    if not wait_until(self._condition, end):
+                        expired = 1
+                        break
+        finally:
+            self._condition.release()
+        if expired:
+            raise DeadlineExceeded
+        self._page_info_table = table
+        return table
+
+    def file_table(self, wait=1, timeout=None, deadline=None):
+        """
+        D.file_table(wait=True, timeout=None, deadline=None) -> a FileTable
+
+        Obtain information about all the component files at once. The table
+        is cached; document.files uses it to look up files by page, identifier
+        or name, and File objects take their information from it.
+
+        If the document was opened with a DocumentIndex, the table comes from
+        the index and is available at once.
+
+        If wait is true, wait until the information about all the files is
+        available. See Page.get_info() for timeout and deadline.
+
+        If the information is not available, raise NotAvailable exception.
+
+        Possible exceptions: NotAvailable, JobFailed, DeadlineExceeded.
+        """
+        cdef ddjvu_fileinfo_t info
+        cdef ddjvu_status_t status
+        cdef int expired = 0
+        cdef int i, n
+        if self._file_table is not None:
+            return self._file_table
+        end = get_deadline(timeout, deadline)
+        self._condition.acquire()
+        try:
+            # The number of files is known only after decoding the document.
+            while not ddjvu_document_decoding_done(self.ddjvu_document):
+                if not wait:
+                    raise _NotAvailable_
+                if not wait_until(self._condition, end):
+                    expired = 1
+                    break
+            if not expired:
+                if ddjvu_document_decoding_error(self.ddjvu_document):
+                    raise JobException_from_c(ddjvu_document_decoding_status(self.ddjvu_document))
+                n = ddjvu_document_get_filenum(self.ddjvu_document)
+                files = [None] * n
+                missing = range(n)
+                while True:
+                    still_missing = []
+                    for i in missing:
+                        status = ddjvu_document_get_fileinfo(self.ddjvu_document, i, &info)
+                        if status == DDJVU_JOB_OK:
+                            files[i] = (
+                                chr(<unsigned char> info.type),
+                                info.pageno if info.pageno >= 0 else None,
+                                info.size if info.size >= 0 else None,
+                                decode_utf8(info.id) if info.id != NULL else None,
+                                decode_utf8(info.name) if info.name != NULL else None,
+                                decode_utf8(info.title) if info.title != NULL else None,
+                            )
+                        elif status < DDJVU_JOB_OK:
+                            still_missing += [i]
+                        else:
+                            raise JobException_from_c(status)
+                    missing = still_missing
+                    if not missing:
+                        break
+                    if not wait:
+                        raise _NotAvailable_
+                    if not wait_until(self._condition, end):
+                        expired = 1
+                        break
+        finally:
+            self._condition.release()
+        if expired:
+            raise DeadlineExceeded
+        self._file_table = new_file_table(files)
+        return self._file_table
+
+    property files:
+        """
+        Return the DocumentPages.
+        """
+        def __get__(self):
+            return self._files
+
+    property outline:
         """
         Return the DocumentOutline.
         """
@@ -1058,8 +1907,19 @@ cdef class Document:
             return DocumentAnnotations(self)
 
     def __dealloc__(self):
+        cdef RenderCache cache
+        cdef void *user_data
         if self.ddjvu_document == NULL:
             return
+        if self._generation != fork_generation:
+            return
+        if self._render_caches is not None:
+            for cache in self._render_caches:
+                cache._invalidate(self._serial)
+        user_data = ddjvu_document_get_user_data(self.ddjvu_document)
+        ddjvu_document_set_user_data(self.ddjvu_document, NULL)
+        if user_data != NULL:
+            Py_DECREF(<object> user_data)
         ddjvu_document_release(self.ddjvu_document)
 
     def save(self, file=None, indirect=None, pages=None, wait=1):
@@ -1101,14 +1961,10 @@ cdef class Document:
             s2 = pages_to_opt(pages, 1)
             optv[optc] = s2
             optc = optc + 1
-        with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
-        try:
+        with self._context._registering():
             job = SaveJob(sentinel = the_sentinel)
             job._init(self._context, ddjvu_document_save(self.ddjvu_document, output, optc, optv))
             job._file = file_wrapper
-        finally:
-            release_lock(loft_lock)
         if wait:
             job.wait()
         return job
@@ -1307,23 +2163,184 @@ cdef class Document:
                 if is_unicode(option):
                     options[optc] = option = encode_utf8(option)
                 optv[optc] = option
-            with nogil:
-                acquire_lock(loft_lock, WAIT_LOCK)
-            try:
+            with self._context._registering():
                 job = SaveJob(sentinel = the_sentinel)
                 job._init(
                     self._context,
                     ddjvu_document_print(self.ddjvu_document, output, len(options), optv)
                 )
                 job._file = file_wrapper
-            finally:
-                release_lock(loft_lock)
         finally:
             py_free(optv)
         if wait:
             job.wait()
         return job
 
+    def iter_pages(self, prefetch=1, max_jobs=None):
+        """
+        D.iter_pages(prefetch=1, max_jobs=None) -> an iterator
+
+        Decode the pages in order, and yield their PageJobs as soon as they
+        are done. While a page is being decoded, up to prefetch following
+        pages are decoded ahead, with at most max_jobs (by default, the
+        number of processors) jobs in flight. See DecodeScheduler.
+
+        Read-ahead jobs still in flight are stopped when the iterator is
+        closed.
+
+        Possible exceptions: ValueError, JobFailed.
+        """
+        cdef DecodeScheduler scheduler
+        scheduler = DecodeScheduler(self, max_jobs, prefetch)
+        self.decoding_job.wait()
+        try:
+            for n in range(len(self._pages)):
+                scheduler.set_visible([n])
+                yield scheduler.get(n)
+        finally:
+            scheduler.set_visible([])
+
+    def render_pages(
+            self, pages, ddjvu_render_mode_t mode, dpi, PixelFormat pixel_format not None, long row_alignment=1, workers=None
+    ):
+        """
+        D.render_pages(pages, mode, dpi, pixel_format, row_alignment=1, workers=None) -> an iterator
+
+        Decode and render the specified pages, using a pool of worker threads.
+        If pages is None, render all the pages of the document.
+
+        Each page is rendered in full, with the mode layers (see
+        PageJob.render() for the possible values), at dpi resolution (or at
+        the page's own resolution if dpi is None), using the pixel_format
+        pixel format. Each row will start at row_alignment bytes boundary.
+
+        Yield (n, (w, h, row_size), data) tuples as soon as rendering of the
+        page number n is finished, so the order of pages is not preserved:
+
+        * w and h are the image dimensions in pixels;
+        * row_size is length of each image row, in bytes;
+        * data contains the actual image data.
+
+        workers is the number of threads to use. By default, it is equal to
+        the number of processors.
+
+        Possible exceptions: NotAvailable, JobFailed.
+        """
+        if row_alignment <= 0:
+            raise ValueError('row_alignment must be a positive integer')
+        if dpi is not None and dpi <= 0:
+            raise ValueError('dpi must be a positive number or none')
+        if workers is None:
+            workers = cpu_count() or 1
+        elif workers < 1:
+            raise ValueError('workers must be a positive integer')
+        if pages is None:
+            pages = range(len(self._pages))
+
+        def render(n):
+            return render_page(self._pages[n], mode, dpi, pixel_format, row_alignment)
+
+        return ((n, size, data) for n, (size, data) in parallel_map(render, pages, workers))
+
+    def render_thumbnails(self, size, PixelFormat pixel_format not None, pages=None, long row_alignment=1, workers=None):
+        """
+        D.render_thumbnails((w0, h0), pixel_format, pages=None, row_alignment=1, workers=None) -> an iterator
+
+        Calculate and render thumbnails of the specified pages, using a pool
+        of worker threads. If pages is None, render thumbnails of all the
+        pages of the document.
+
+        Calculation of all the thumbnails is initiated at once. Thumbnails are
+        rendered as soon as they are available, i.e. as ThumbnailMessage
+        messages arrive. See Thumbnail.render(...) for the meaning of the
+        size, pixel_format and row_alignment arguments.
+
+        Yield (n, (w1, h1, row_size), data) tuples as soon as rendering of the
+        thumbnail of the page number n is finished, so the order of pages is
+        not preserved:
+
+        * w1 and h1 are actual thumbnail dimensions in pixels
+          (w1 <= w0 and h1 <= h0);
+        * row_size is length of each image row, in bytes;
+        * data contains the actual image data.
+
+        workers is the number of threads to use. By default, it is equal to
+        the number of processors.
+
+        Possible exceptions: NotAvailable, JobFailed (if a thumbnail could
+        not be calculated).
+        """
+        if row_alignment <= 0:
+            raise ValueError('row_alignment must be a positive integer')
+        w, h = size
+        if w <= 0 or h <= 0:
+            raise ValueError('size width/height must a positive integer')
+        if workers is None:
+            workers = cpu_count() or 1
+        elif workers < 1:
+            raise ValueError('workers must be a positive integer')
+        if pages is None:
+            pages = range(len(self._pages))
+        thumbnails = [self._pages[n].thumbnail for n in pages]
+        for thumbnail in thumbnails:
+            thumbnail.calculate()
+
+        finished = []
+
+        def render(thumbnail):
+            return thumbnail.render(size, pixel_format, row_alignment)
+
+        def render_done(future):
+            with self._condition:
+                finished.append(future)
+                self._condition.notify_all()
+
+        def rendered_thumbnails():
+            # Start rendering thumbnails as soon as they are available, i.e.
+            # as ThumbnailMessage messages arrive, and yield them as soon as
+            # they are rendered. Both events are waited for on the document
+            # condition, so that neither delays the other.
+            pending = thumbnails
+            futures = {}
+            executor = ThreadPoolExecutor(workers)
+            try:
+                while pending or futures:
+                    available = []
+                    self._condition.acquire()
+                    try:
+                        while True:
+                            not_available = []
+                            for thumbnail in pending:
+                                status = thumbnail.status
+                                if status is JobOK:
+                                    available += [thumbnail]
+                                elif issubclass(status, JobDone):
+                                    raise status
+                                else:
+                                    not_available += [thumbnail]
+                            pending = not_available
+                            if available or finished:
+                                break
+                            self._condition.wait()
+                        done = finished[:]
+                        del finished[:]
+                    finally:
+                        self._condition.release()
+                    for thumbnail in available:
+                        future = executor.submit(render, thumbnail)
+                        futures[future] = thumbnail
+                        future.add_done_callback(render_done)
+                    for future in done:
+                        thumbnail = futures.pop(future)
+                        thumbnail_size, data = future.result()
+                        yield thumbnail.page.n, thumbnail_size, data
+            finally:
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=True)
+
+        return rendered_thumbnails()
+
     property message_queue:
         """
         Return the internal message queue.
@@ -1337,30 +2354,74 @@ cdef class Document:
 
         Get message from the internal document queue.
         Return None if wait is false and no message is available.
+
+        Possible exceptions: RuntimeError (if the document was created before
+        fork() in the parent process).
         """
+        check_generation(self._generation)
         try:
             return self._queue.get(wait)
         except Empty:
             return
 
+    def subscribe(self, types, callback):
+        """
+        D.subscribe(types, callback) -> a Subscription
+
+        Call callback(message), in a separate thread, for every received
+        message concerning the document that is an instance of one of the
+        types. Such messages are then not passed to Context.handle_message().
+
+        All exceptions raised by the callback will be ignored.
+
+        Possible exceptions: TypeError.
+        """
+        cdef Subscription subscription
+        subscription = Subscription(self, types, callback, sentinel = the_sentinel)
+        self._subscriptions += (subscription,)
+        self._subscription_mask |= subscription._mask
+        return subscription
+
+    async def get_message_async(self):
+        """
+        D.get_message_async() -> a Message
+
+        Coroutine version of get_message(): get message from the internal
+        document queue, without blocking the event loop. The deadline of the
+        enclosing deadline(...) block applies, but decoding of the document
+        is not stopped when it passes.
+
+        Possible exceptions: DeadlineExceeded, RuntimeError.
+        """
+        check_generation(self._generation)
+        return await get_message_async(self._condition, self._waiters, self._queue)
+
     def __iter__(self):
         return self
 
     def __next__(self):
         return self.get_message()
 
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get_message_async()
+
 
-cdef Document Document_from_c(ddjvu_document_t* ddjvu_document):
-    cdef Document result
+cdef Document Document_from_c(Context context, ddjvu_document_t* ddjvu_document):
+    cdef void *user_data
     if ddjvu_document == NULL:
-        result = None
-    else:
-        with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
-        try:
-            result = _document_weak_loft.get(voidp_to_int(ddjvu_document))
-        finally:
-            release_lock(loft_lock)
+        return
+    user_data = ddjvu_document_get_user_data(ddjvu_document)
+    if user_data != NULL:
+        return from_user_data(user_data)
+    # The document might be still being created. Resolve the borrowed weak
+    # reference while the lock is held: releasing the lock can run Python
+    # code (the tracer) and switch threads, and the document might be gone
+    # by then, along with its weak reference.
+    with context._registering():
+        result = from_user_data(ddjvu_document_get_user_data(ddjvu_document))
     return result
 
 
@@ -1373,560 +2434,2967 @@ class FileUri(str):
 FileURI = FileUri
 
 
-cdef object Context_message_distributor
+# Bumped whenever the layout of the documents table changes; indexes with
+# a different version are rebuilt from scratch.
+cdef int INDEX_VERSION = 2
+
+cdef object INDEX_SCHEMA
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    digest BLOB NOT NULL,
+    pages BLOB NOT NULL,
+    files TEXT NOT NULL,
+    has_text BLOB,
+    outline TEXT,
+    annotations TEXT
+)
+'''
 
 
-def _Context_message_distributor(Context self not None, **kwargs):
-    cdef Message message
-    cdef Document document
-    cdef Job job
-    cdef PageJob page_job
-    cdef ddjvu_message_t* ddjvu_message
+cdef object file_digest(object path):
+    digest = blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(1 << 20)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.digest()
+
+
+cdef DocumentIndexEntry index_entry_from_row(tuple row):
+    # row is a (pages, files, has_text, outline, annotations) tuple of the
+    # documents table.
+    cdef DocumentIndexEntry entry
+    cdef PageInfoTable table
+    cdef Py_ssize_t n
+    pages, files, has_text, outline, annotations = row
+    columns = array('i')
+    columns.frombytes(pages)
+    n = len(columns) // 5
+    table = PageInfoTable(sentinel = the_sentinel)
+    table._width = columns[0:n]
+    table._height = columns[n:2 * n]
+    table._dpi = columns[2 * n:3 * n]
+    table._rotation = columns[3 * n:4 * n]
+    table._version = columns[4 * n:5 * n]
+    entry = DocumentIndexEntry(sentinel = the_sentinel)
+    entry._page_info_table = table
+    entry._file_table = new_file_table(json_loads(files))
+    if has_text is not None:
+        entry._has_text = array('b', has_text)
+    if outline is not None:
+        entry._outline = Expression.from_string(outline)
+    if annotations is not None:
+        entry._annotations = Expression.from_string(annotations)
+    return entry
+
+
+cdef class DocumentIndexEntry:
+    """
+    Information about a document recorded in a DocumentIndex.
 
-    check_sentinel(self, kwargs)
-    while True:
-        with nogil:
-            ddjvu_message = ddjvu_message_wait(self.ddjvu_context)
-        try:
-            try:
-                message = Message_from_c(ddjvu_message)
-            finally:
-                ddjvu_message_pop(self.ddjvu_context)
-            if message is None:
-                raise SystemError
-            self.handle_message(message)
-            # XXX Order of branches below is *crucial*. Do not change.
-            if message._job is not None:
-                job = message._job
-                job._condition.acquire()
-                try:
-                    job._condition.notify_all()
-                finally:
-                    job._condition.release()
-                if job.is_done:
-                    job._clear()
-            elif message._page_job is not None:
-                raise SystemError  # Should not happen.
-            elif message._document is not None:
-                document = message._document
-                document._condition.acquire()
-                try:
-                    document._condition.notify_all()
-                finally:
-                    document._condition.release()
-                if document.decoding_done:
-                    document._clear()
-        except KeyboardInterrupt:
-            return
-        except SystemExit:
-            return
-        except Exception:
-            write_unraisable_exception(self)
+    Use index.lookup(...), index.add(...) or document.index_entry to obtain
+    instances of this class.
+    """
 
+    def __cinit__(self, **kwargs):
+        check_sentinel(self, kwargs)
+        self._has_text = None
+        self._outline = None
+        self._annotations = None
 
-Context_message_distributor = _Context_message_distributor
-del _Context_message_distributor
+    property page_info_table:
+        """
+        Return the PageInfoTable of the document.
+        """
+        def __get__(self):
+            return self._page_info_table
 
+    property file_table:
+        """
+        Return the FileTable of the document.
+        """
+        def __get__(self):
+            return self._file_table
 
-cdef class Context:
+    property has_text:
+        """
+        Return a read-only memoryview of flags telling whether each page has
+        a hidden text layer, or None if they were not recorded.
+        """
+        def __get__(self):
+            if self._has_text is None:
+                return
+            return memoryview(self._has_text).toreadonly()
 
-    def __cinit__(self, argv0=None):
-        if argv0 is None:
-            argv0 = sys.argv[0]
-        if is_unicode(argv0):
-            argv0 = encode_utf8(argv0)
-        with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
-        try:
-            self.ddjvu_context = ddjvu_context_create(argv0)
-            if self.ddjvu_context == NULL:
-                raise MemoryError('Unable to create DjVu context')
-            _context_loft[voidp_to_int(self.ddjvu_context)] = self
-        finally:
-            release_lock(loft_lock)
-        self._queue = Queue()
-        thread.start_new_thread(Context_message_distributor, (self,), {'sentinel': the_sentinel})
+    property outline:
+        """
+        Return the outline S-expression, or None if it was not recorded.
+        """
+        def __get__(self):
+            return self._outline
 
-    property cache_size:
+    property annotations:
+        """
+        Return the document-wide annotations S-expression, or None if they
+        were not recorded.
+        """
+        def __get__(self):
+            return self._annotations
 
-        def __set__(self, value):
-            if 0 < value < (1 << 31):
-                ddjvu_cache_set_size(self.ddjvu_context, value)
-            else:
-                raise ValueError('0 < cache_size < (2 ** 31) must be satisfied')
+    def __repr__(self):
+        return f'<{get_type_name(DocumentIndexEntry)} of {len(self._page_info_table)} pages>'
 
-        def __get__(self):
-            return ddjvu_cache_get_size(self.ddjvu_context)
 
-    def handle_message(self, Message message not None):
-        """
-        C.handle_message(message) -> None
+cdef class DocumentIndex:
+    """
+    DocumentIndex(path) -> a document index
 
-        This method is called, in a separate thread, for every received
-        message, *before* any blocking method finishes.
+    A persistent index of local documents, stored in the SQLite database at
+    path (which is created if needed).
 
-        By default, do something roughly equivalent to::
+    For each document, the index records the PageInfoTable, the FileTable,
+    whether each page has a hidden text layer, the outline and the
+    document-wide annotations. Pass the index to Context.new_document(...)
+    to have these served before the document is decoded.
 
-            if message.job is not None:
-                message.job.message_queue.put(message)
-            elif message.document is not None:
-                message.document.message_queue.put(message)
-            else:
-                message.context.message_queue.put(message)
+    Entries are keyed by the absolute path of the document, and are valid as
+    long as its size, modification time, status change time and inode number
+    do not change; if only the times or the inode number changed, a hash of
+    the contents is compared. (Rewriting a file in place, preserving its
+    modification time, still changes its status change time.)
 
-        You may want to override this method to change this behaviour.
+    The index survives os.fork(): the database is closed while forking, and
+    opened again in both processes, so that no SQLite connection is shared
+    across the fork.
 
-        All exceptions raised by this method will be ignored.
-        """
+    Possible exceptions: sqlite3.Error.
+    """
 
-        # XXX Order of branches below is *crucial*. Do not change.
-        if message._job is not None:
-            message._job._queue.put(message)
-        elif message._page_job is not None:
-            raise SystemError  # Should not happen.
-        elif message._document is not None:
-            message._document._queue.put(message)
-        else:
-            message._context._queue.put(message)
+    def __cinit__(self, path):
+        import sqlite3
+        self._lock = thread.allocate_lock()
+        self._path = fspath(path)
+        self._connection = sqlite3.connect(self._path, check_same_thread=False)
+        try:
+            with self._connection:
+                [version] = self._connection.execute('PRAGMA user_version').fetchone()
+                if version != INDEX_VERSION:
+                    self._connection.execute('DROP TABLE IF EXISTS documents')
+                    self._connection.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+                self._connection.execute(INDEX_SCHEMA)
+        except BaseException:
+            self._connection.close()
+            raise
+        _document_indexes.add(self)
 
-    property message_queue:
-        """
-        Return the internal message queue.
-        """
-        def __get__(self):
-            return self._queue
+    def __dealloc__(self):
+        if self._path is not None and self._connection is not None:
+            self._connection.close()
 
-    def get_message(self, wait=1):
+    cdef object _reopen(self):
+        # Called in both processes after fork(), with self._lock acquired in
+        # the parent. The connection was closed before forking.
+        import sqlite3
+        if self._path is not None:
+            self._connection = sqlite3.connect(self._path, check_same_thread=False)
+
+    def lookup(self, path):
         """
-        C.get_message(wait=True) -> a Message or None
+        I.lookup(path) -> a DocumentIndexEntry or None
 
-        Get message from the internal context queue.
-        Return None if wait is false and no message is available.
+        Return the entry for the document at path, or None if the document is
+        not in the index or has changed since it was added.
         """
+        path = abspath(fspath(path))
         try:
-            return self._queue.get(wait)
-        except Empty:
+            stat = os_stat(path)
+        except OSError:
+            return
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT size, mtime_ns, ctime_ns, ino, digest, pages, files, has_text, outline, annotations '
+                'FROM documents WHERE path = ?',
+                (path,)
+            ).fetchone()
+        if row is None:
             return
+        size, mtime_ns, ctime_ns, ino, digest = row[:5]
+        if size != stat.st_size:
+            return
+        if (mtime_ns, ctime_ns, ino) != (stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino):
+            # The file might have been touched, copied without preserving its
+            # modification time, or rewritten in place.
+            if file_digest(path) != digest:
+                return
+            with self._lock, self._connection:
+                self._connection.execute(
+                    'UPDATE documents SET mtime_ns = ?, ctime_ns = ?, ino = ? WHERE path = ?',
+                    (stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino, path)
+                )
+        return index_entry_from_row(row[5:])
 
-    def new_document(self, uri, cache=1):
+    def add(self, path, context=None, text=True, timeout=None, deadline=None):
         """
-        C.new_document(uri, cache=True) -> a Document
+        I.add(path, context=None, text=True, timeout=None, deadline=None) -> a DocumentIndexEntry
 
-        Creates a decoder for a DjVu document and starts decoding. This
-        method returns immediately. The decoding job then generates messages to
-        request the raw data and to indicate the state of the decoding process.
+        Decode the document at path (in context, or in a new Context), and
+        record it in the index, replacing any previous entry.
 
-        uri specifies an optional URI for the document. The URI follows the
-        usual syntax (protocol://machine/path). It should not end with
-        a slash. It only serves two purposes:
+        If text is false, do not decode the hidden text of the pages to
+        find which have it; then, Page.has_text is not served from the index.
 
-        - The URI is used as a key for the cache of decoded pages.
-        - The URI is used to document NewStreamMessage messages.
+        See Page.get_info() for timeout and deadline.
 
-        Setting argument cache to a true value indicates that decoded pages
-        should be cached when possible.
+        Possible exceptions: JobFailed, DeadlineExceeded, OSError,
+        sqlite3.Error.
+        """
+        cdef PageInfoTable table
+        path = abspath(fspath(path))
+        stat = os_stat(path)
+        digest = file_digest(path)
+        if context is None:
+            context = Context()
+        end = get_deadline(timeout, deadline)
+        document = context.new_document(FileUri(path))
+        table = document.page_info_table(deadline=end)
+        pages = array('i')
+        for column in (table._width, table._height, table._dpi, table._rotation, table._version):
+            pages.extend(column)
+        files = list(document.file_table(deadline=end))
+        has_text = None
+        if text:
+            has_text = array('b')
+            for page in document.pages:
+                page_text = PageText(page, TEXT_DETAILS_PAGE)
+                page_text.wait(deadline=end)
+                has_text.append(len(page_text.sexpr) > 0)
+            has_text = has_text.tobytes()
+        outline = document.outline
+        outline.wait(deadline=end)
+        annotations = document.annotations
+        annotations.wait(deadline=end)
+        row = (pages.tobytes(), json_dumps(files), has_text, outline.sexpr.as_string(), annotations.sexpr.as_string())
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino, digest) + row
+            )
+        return index_entry_from_row(row)
 
-        It is important to understand that the URI is not used to access the
-        data. The document generates NewStreamMessage messages to indicate
-        which data is needed. The caller must then provide the raw data using
-        a NewStreamMessage.stream object.
+    def remove(self, path):
+        """
+        I.remove(path) -> None
 
-        To open a local file, provide a FileUri instance as a URI.
+        Remove the entry for the document at path, if any.
+        """
+        path = abspath(fspath(path))
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM documents WHERE path = ?', (path,))
 
-        Localized characters in uri should be in URI-encoded.
+    def __len__(self):
+        with self._lock:
+            [result] = self._connection.execute('SELECT COUNT(*) FROM documents').fetchone()
+        return result
 
-        Possible exceptions: JobFailed.
+    def close(self):
         """
-        cdef Document document
-        cdef ddjvu_document_t* ddjvu_document
-        with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
-        try:
-            if typecheck(uri, FileUri):
-                uri = encode_utf8(uri)
-                ddjvu_document = ddjvu_document_create_by_filename(self.ddjvu_context, uri, cache)
-            else:
-                uri = encode_utf8(uri)
-                ddjvu_document = ddjvu_document_create(self.ddjvu_context, uri, cache)
-            if ddjvu_document == NULL:
-                raise JobFailed
-            document = Document(sentinel = the_sentinel)
-            document._init(self, ddjvu_document)
-        finally:
-            release_lock(loft_lock)
-        return document
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        return self.get_message()
+        I.close() -> None
 
-    def clear_cache(self):
-        """
-        C.clear_cache() -> None
+        Close the underlying database.
         """
-        ddjvu_cache_clear(self.ddjvu_context)
+        with self._lock:
+            self._connection.close()
+            self._path = None
 
-    def __dealloc__(self):
-        ddjvu_context_release(self.ddjvu_context)
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-cdef Context Context_from_c(ddjvu_context_t* ddjvu_context):
-    cdef Context result
-    if ddjvu_context == NULL:
-        result = None
-    else:
-        with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
-        try:
-            try:
-                result = _context_loft[voidp_to_int(ddjvu_context)]
-            except KeyError:
-                raise SystemError
-        finally:
-            release_lock(loft_lock)
-    return result
 
+cdef class QueuePolicy:
+    """
+    QueuePolicy(max_size=None, drop='oldest', coalesce=True) -> a queue policy
 
-RENDER_COLOR = DDJVU_RENDER_COLOR
-RENDER_BLACK = DDJVU_RENDER_BLACK
-RENDER_COLOR_ONLY = DDJVU_RENDER_COLORONLY
-RENDER_MASK_ONLY = DDJVU_RENDER_MASKONLY
-RENDER_BACKGROUND = DDJVU_RENDER_BACKGROUND
-RENDER_FOREGROUND = DDJVU_RENDER_FOREGROUND
+    A policy for the message queues of a context, its documents and jobs
+    (see the queue_policy argument of Context).
 
-PAGE_TYPE_UNKNOWN = DDJVU_PAGETYPE_UNKNOWN
-PAGE_TYPE_BITONAL = DDJVU_PAGETYPE_BITONAL
-PAGE_TYPE_PHOTO = DDJVU_PAGETYPE_PHOTO
-PAGE_TYPE_COMPOUND = DDJVU_PAGETYPE_COMPOUND
+    max_size is the maximum number of messages kept in each queue, or None
+    for no limit. If max_size is 0, messages are not queued at all; this is
+    useful if you only use the wait() methods. When a queue is full, either
+    the oldest queued message or the incoming message is dropped, depending
+    on drop ('oldest' or 'newest').
 
+    If coalesce is true, a ProgressMessage or a RedisplayMessage replaces an
+    older queued message of the same type for the same job, in its place in
+    the queue.
 
-cdef class PixelFormat:
+    The policy also keeps statistics about all the queues it governs.
     """
-    Abstract pixel format.
 
-    Do not use this class directly, use one of its subclasses.
-    """
+    def __cinit__(self, max_size=None, drop='oldest', coalesce=True):
+        if max_size is None:
+            self._max_size = -1
+        elif max_size >= 0:
+            self._max_size = max_size
+        else:
+            raise ValueError('max_size must be a non-negative integer or None')
+        if drop == 'oldest':
+            self._drop_oldest = 1
+        elif drop == 'newest':
+            self._drop_oldest = 0
+        else:
+            raise ValueError(f"drop must be 'oldest' or 'newest', not {drop!r}")
+        self._coalesce = bool(coalesce)
+        self._depth = self._max_depth = 0
+        self._dropped = self._coalesced = 0
 
-    def __cinit__(self, *args, **kwargs):
-        self._row_order = 0
-        self._y_direction = 0
-        self._dither_bpp = 32
-        self._gamma = 2.2
-        self.ddjvu_format = NULL
-        for cls in (PixelFormatRgb, PixelFormatRgbMask, PixelFormatGrey, PixelFormatPalette, PixelFormatPackedBits):
-            if typecheck(self, cls):
+    property max_size:
+        """
+        Return the maximum number of messages kept in each queue, or None.
+        """
+        def __get__(self):
+            if self._max_size < 0:
                 return
-        raise_instantiation_error(type(self))
+            return self._max_size
 
-    property rows_top_to_bottom:
+    property drop:
         """
-        Flag indicating whether the rows in the pixel buffer are stored
-        starting from the top or the bottom of the image.
-
-        Default ordering starts from the bottom of the image. This is the
-        opposite of the X11 convention.
+        Return which message is dropped when a queue is full: 'oldest' or
+        'newest'.
         """
-
         def __get__(self):
-            return bool(self._row_order)
-
-        def __set__(self, value):
-            ddjvu_format_set_row_order(self.ddjvu_format, not not value)
+            return 'oldest' if self._drop_oldest else 'newest'
 
-    property y_top_to_bottom:
+    property coalesce:
         """
-        Flag indicating whether the *y* coordinates in the drawing area are
-        oriented from bottom to top, or from top to bottom.
-
-        The default is bottom to top, similar to PostScript. This is the
-        opposite of the X11 convention.
+        Indicate whether repeated progress and redisplay messages are
+        coalesced.
         """
-
         def __get__(self):
-            return bool(self._row_order)
+            return bool(self._coalesce)
 
-        def __set__(self, value):
-            ddjvu_format_set_y_direction(self.ddjvu_format, not not value)
-
-    property bpp:
+    property depth:
         """
-        Return the depth of the image, in bits per pixel.
+        Return the total number of messages currently kept in the queues.
         """
         def __get__(self):
-            return self._bpp
+            return self._depth
 
-    property dither_bpp:
+    property max_depth:
         """
-        The final depth of the image on the screen. This is used to decide
-        which dithering algorithm should be used.
-
-        The default is usually appropriate.
+        Return the largest value of depth so far.
         """
         def __get__(self):
-            return self._dither_bpp
-
-        def __set__(self, int value):
-            if 0 < value < 64:
-                ddjvu_format_set_ditherbits(self.ddjvu_format, value)
-                self._dither_bpp = value
-            else:
-                raise ValueError('0 < value < 64 must be satisfied')
+            return self._max_depth
 
-    property gamma:
+    property dropped:
         """
-        Gamma of the display for which the pixels are intended. This will be
-        combined with the gamma stored in DjVu documents in order to compute
-        a suitable color correction.
+        Return the number of dropped messages.
+        """
+        def __get__(self):
+            return self._dropped
 
-        The default value is 2.2.
+    property coalesced:
+        """
+        Return the number of messages replaced by a newer message.
         """
         def __get__(self):
-            return self._gamma
+            return self._coalesced
 
-        def __set__(self, double value):
-            if 0.5 <= value <= 5.0:
-                ddjvu_format_set_gamma(self.ddjvu_format, value)
-            else:
-                raise ValueError('0.5 <= value <= 5.0 must be satisfied')
+    def __repr__(self):
+        return (
+            f'{get_type_name(QueuePolicy)}'
+            f'(max_size = {self.max_size!r}, drop = {self.drop!r}, coalesce = {self.coalesce!r})'
+        )
 
-    def __dealloc__(self):
-        if self.ddjvu_format != NULL:
-            ddjvu_format_release(self.ddjvu_format)
 
-    def __repr__(self):
-        return f'{get_type_name(type(self))}()'
+class _CoalescedSlot:
+    # A queue entry whose message can be replaced in place by a newer one.
+    __slots__ = ('key', 'message')
 
 
-cdef class PixelFormatRgb(PixelFormat):
+class MessageQueue(Queue):
     """
-    PixelFormatRgb([byteorder='RGB']) -> a pixel format
+    MessageQueue(policy=None) -> a message queue
 
-    24-bit pixel format, with:
+    A queue.Queue subclass that enforces a QueuePolicy. Puts never block:
+    when the queue is full, a message is dropped instead.
+    """
 
-    - RGB (byteorder == 'RGB') or
-    - BGR (byteorder == 'BGR')
+    def __init__(self, QueuePolicy policy=None):
+        self.policy = policy
+        # (message type, job, document) -> the slot of the queued message
+        # that a newer one would replace.
+        self._slots = {}
+        Queue.__init__(self)
+
+    def __del__(self):
+        # Messages of a dropped queue are no longer kept.
+        cdef QueuePolicy policy = getattr(self, 'policy', None)
+        if policy is not None:
+            policy._depth -= len(self.queue)
+
+    # The methods below are called with self.mutex acquired.
+
+    def _put(self, message):
+        cdef QueuePolicy policy = self.policy
+        queue = self.queue
+        if policy is None:
+            queue.append(message)
+            return
+        key = None
+        if policy._coalesce and (typecheck(message, ProgressMessage) or typecheck(message, RedisplayMessage)):
+            key = (type(message), message.job, message.document)
+            slot = self._slots.get(key)
+            if slot is not None:
+                slot.message = message
+                policy._coalesced += 1
+                # Queue.put() counts the message as a new task.
+                self.unfinished_tasks -= 1
+                return
+        if 0 <= policy._max_size <= len(queue):
+            policy._dropped += 1
+            self.unfinished_tasks -= 1
+            if not policy._drop_oldest or not queue:
+                return
+            self._unwrap(queue.popleft())
+            policy._depth -= 1
+        if key is not None:
+            slot = _CoalescedSlot()
+            slot.key = key
+            slot.message = message
+            self._slots[key] = slot
+            message = slot
+        queue.append(message)
+        policy._depth += 1
+        if policy._depth > policy._max_depth:
+            policy._max_depth = policy._depth
+
+    def _get(self):
+        cdef QueuePolicy policy = self.policy
+        message = self.queue.popleft()
+        if policy is not None:
+            policy._depth -= 1
+            message = self._unwrap(message)
+        return message
+
+    def _unwrap(self, message):
+        if type(message) is _CoalescedSlot:
+            del self._slots[message.key]
+            message = message.message
+        return message
+
+
+cdef unsigned int message_types_to_mask(object types) except? 0:
+    # Map message types to a bit mask of DDJVU_* message tags.
+    cdef unsigned int mask = 0
+    types = tuple(types)
+    for message_type in types:
+        try:
+            if not issubclass(message_type, Message):
+                raise TypeError
+        except TypeError:
+            raise TypeError('types must be a sequence of Message subclasses')
+        for tag, message_class in MESSAGE_MAP.items():
+            if issubclass(message_class, message_type):
+                mask |= 1U << tag
+    return mask
 
-    byte order.
+
+cdef unsigned int subscriptions_mask(tuple subscriptions):
+    cdef Subscription subscription
+    cdef unsigned int mask = 0
+    for subscription in subscriptions:
+        mask |= subscription._mask
+    return mask
+
+
+cdef class Subscription:
     """
+    A subscription to messages of a context or a document.
 
-    def __cinit__(self, byte_order='RGB', unsigned int bpp=24):
-        cdef ddjvu_format_style_t _format
-        if byte_order == 'RGB':
-            self._rgb = 1
-            _format = DDJVU_FORMAT_RGB24
-        elif byte_order == 'BGR':
-            self._rgb = 0
-            _format = DDJVU_FORMAT_BGR24
-        else:
-            raise ValueError("byte_order must be equal to 'RGB' or 'BGR'")
-        if bpp != 24:
-            raise ValueError('bpp must be equal to 24')
-        self._bpp = 24
-        self.ddjvu_format = ddjvu_format_create(_format, 0, NULL)
+    Use context.subscribe(...) or document.subscribe(...) to obtain instances
+    of this class.
+    """
 
-    property byte_order:
+    def __cinit__(self, owner, types, callback, **kwargs):
+        check_sentinel(self, kwargs)
+        if not callable(callback):
+            raise TypeError('callback must be callable')
+        self._types = tuple(types)
+        self._mask = message_types_to_mask(self._types)
+        self._callback = callback
+        self._owner = owner
+
+    property types:
         """
-        Return the byte order:
-        - 'RGB' or
-        - 'BGR'.
+        Return the message types the subscription is interested in.
         """
         def __get__(self):
-            if self._rgb:
-                return 'RGB'
-            else:
-                return 'BGR'
+            return self._types
+
+    property callback:
+        """
+        Return the function called for every matching message.
+        """
+        def __get__(self):
+            return self._callback
+
+    property active:
+        """
+        Indicate whether the subscription has not been cancelled.
+        """
+        def __get__(self):
+            return self._owner is not None
+
+    def cancel(self):
+        """
+        S.cancel() -> None
+
+        Stop delivering messages to the callback.
+        """
+        cdef Context context
+        cdef Document document
+        cdef tuple subscriptions
+        owner = self._owner
+        if owner is None:
+            return
+        self._owner = None
+        if typecheck(owner, Context):
+            context = owner
+            subscriptions = tuple(s for s in context._subscriptions if s is not self)
+            context._subscriptions = subscriptions
+            context._subscription_mask = subscriptions_mask(subscriptions)
+        else:
+            document = owner
+            subscriptions = tuple(s for s in document._subscriptions if s is not self)
+            document._subscriptions = subscriptions
+            document._subscription_mask = subscriptions_mask(subscriptions)
 
     def __repr__(self):
-        return f'{get_type_name(PixelFormatRgb)}(byte_order = {self.byte_order!r}, bpp = {self.bpp})'
+        return f'<{get_type_name(Subscription)} for {self._owner!r}: {self._types!r}>'
 
 
-cdef class PixelFormatRgbMask(PixelFormat):
-    """
-    PixelFormatRgbMask(red_mask, green_mask, blue_mask[, xor_value], bpp=16) -> a pixel format
-    PixelFormatRgbMask(red_mask, green_mask, blue_mask[, xor_value], bpp=32) -> a pixel format
+cdef object Context_message_distributor
 
-    red_mask, green_mask and blue_mask are bit masks for color components
-    for each pixel. The resulting color is then xored with the xor_value.
 
-    For example, PixelFormatRgbMask(0xF800, 0x07E0, 0x001F, bpp=16) is a
-    highcolor format with:
+def _Context_message_distributor(Context self not None, **kwargs):
+    cdef Message message
+    cdef Document document
+    cdef Job job
+    cdef Subscription subscription
+    cdef tuple subscriptions
+    cdef Instrumentation instrumentation
+    cdef ddjvu_message_t* ddjvu_message
+    cdef ddjvu_message_tag_t tag
+    cdef unsigned int tag_bit
+    cdef int profile
+    cdef double arrival = 0, start = 0
 
-    - 5 (most significant) bits for red,
-    - 6 bits for green,
-    - 5 (least significant) bits for blue.
-    """
+    check_sentinel(self, kwargs)
+    ddjvu_message = NULL
+    while True:
+        if ddjvu_message == NULL:
+            with nogil:
+                ddjvu_message = ddjvu_message_wait(self.ddjvu_context)
+        try:
+            try:
+                tag = ddjvu_message.m_any.tag
+                tag_bit = (1U << tag) if tag < 32 else 0
+                instrumentation = self._instrumentation
+                profile = instrumentation is not None and instrumentation._profile
+                if profile:
+                    arrival = monotonic()
+                    instrumentation._trace('call', 'dispatch')
+                if instrumentation is not None and tag < 32:
+                    instrumentation._message_counts[<int> tag] += 1
+                job = Job_from_c(self, ddjvu_message.m_any.job)
+                document = Document_from_c(self, ddjvu_message.m_any.document)
+                subscriptions = ()
+                if self._subscription_mask & tag_bit:
+                    subscriptions = self._subscriptions
+                if document is not None and document._subscription_mask & tag_bit:
+                    subscriptions += document._subscriptions
+                # Messages nobody is interested in are not even converted to
+                # Python objects.
+                if subscriptions or self._message_mask & tag_bit:
+                    message = Message_from_c(self, ddjvu_message)
+                    if message is None:
+                        raise SystemError
+                else:
+                    message = None
+            finally:
+                ddjvu_message_pop(self.ddjvu_context)
+                # Drain the pending messages without releasing the GIL.
+                ddjvu_message = ddjvu_message_peek(self.ddjvu_context)
+            if instrumentation is not None:
+                instrumentation._message_received(self, job, document, tag)
+            if subscriptions:
+                if profile:
+                    instrumentation._trace('call', 'subscriptions')
+                    start = monotonic()
+                for subscription in subscriptions:
+                    if subscription._mask & tag_bit:
+                        try:
+                            subscription._callback(message)
+                        except Exception:
+                            write_unraisable_exception(subscription._callback)
+                if profile:
+                    instrumentation._histogram('subscriptions.' + type(message).__name__)._add(monotonic() - start)
+                    instrumentation._trace('return', 'subscriptions')
+            elif message is not None:
+                if profile:
+                    instrumentation._trace('call', 'handle_message')
+                    start = monotonic()
+                self.handle_message(message)
+                if profile:
+                    instrumentation._histogram('handle_message.' + type(message).__name__)._add(monotonic() - start)
+                    instrumentation._trace('return', 'handle_message')
+            # XXX Order of branches below is *crucial*. Do not change.
+            if job is not None:
+                job._condition.acquire()
+                try:
+                    if tag in (DDJVU_CHUNK, DDJVU_RELAYOUT, DDJVU_REDISPLAY) and typecheck(job, PageJob):
+                        (<PageJob> job)._updates += 1
+                    job._condition.notify_all()
+                    wake_waiters(job._waiters)
+                finally:
+                    job._condition.release()
+                if job.is_done:
+                    job._clear()
+                    if typecheck(job, PageJob):
+                        if (<PageJob> job)._document is not None and (<PageJob> job)._document._page_job_cache is not None:
+                            (<PageJob> job)._document._page_job_cache._put(job)
+                        if (<PageJob> job)._scheduler is not None:
+                            (<PageJob> job)._scheduler._job_done(job)
+            elif document is not None:
+                document._condition.acquire()
+                try:
+                    document._condition.notify_all()
+                    wake_waiters(document._waiters)
+                finally:
+                    document._condition.release()
+                if document.decoding_done:
+                    document._clear()
+                    if document._schedulers is not None:
+                        schedulers = list(document._schedulers)
+                        document._schedulers.clear()
+                        for scheduler in schedulers:
+                            (<DecodeScheduler> scheduler)._pump()
+            if profile:
+                if job is not None or document is not None:
+                    instrumentation._histogram('wake_latency')._add(monotonic() - arrival)
+                instrumentation._trace('return', 'dispatch')
+        except KeyboardInterrupt:
+            return
+        except SystemExit:
+            return
+        except Exception:
+            write_unraisable_exception(self)
 
-    def __cinit__(
-            self, unsigned int red_mask, unsigned int green_mask, unsigned int blue_mask, unsigned int xor_value = 0, unsigned int bpp = 16
-    ):
-        cdef ddjvu_format_style_t _format
-        if bpp == 16:
-            _format = DDJVU_FORMAT_RGBMASK16
-            red_mask = red_mask & 0xFFFF
-            blue_mask = blue_mask & 0xFFFF
-            green_mask = green_mask & 0xFFFF
-            xor_value = xor_value & 0xFFFF
-        elif bpp == 32:
-            _format = DDJVU_FORMAT_RGBMASK32
-            red_mask = red_mask & 0xFFFFFFFF
-            blue_mask = blue_mask & 0xFFFFFFFF
-            green_mask = green_mask & 0xFFFFFFFF
-            xor_value = xor_value & 0xFFFFFFFF
-        else:
-            raise ValueError('bpp must be equal to 16 or 32')
-        self._bpp = self._dither_bpp = bpp
-        (self._params[0], self._params[1], self._params[2], self._params[3]) = (red_mask, green_mask, blue_mask, xor_value)
-        self.ddjvu_format = ddjvu_format_create(_format, 4, self._params)
 
-    def __repr__(self):
-        return (
-            f'{get_type_name(PixelFormatRgbMask)}(red_mask = 0x{self._params[0]:0{self.bpp // 4}x}, '
-            f'green_mask = 0x{self._params[1]:0{self.bpp // 4}x}, blue_mask = 0x{self._params[2]:0{self.bpp // 4}x}, '
-            f'xor_value = 0x{self._params[3]:0{self.bpp // 4}x}, bpp = {self.bpp})'
-        )
+Context_message_distributor = _Context_message_distributor
+del _Context_message_distributor
 
 
-cdef class PixelFormatGrey(PixelFormat):
+cdef class Histogram:
     """
-    PixelFormatGrey() -> a pixel format
+    Histogram() -> a histogram
 
-    8-bit, grey pixel format.
+    Distribution of durations, in seconds.
+
+    Durations are counted in buckets with exponentially growing upper
+    bounds: 1 µs, 2 µs, 4 µs, ..., 2 ** 32 µs (more than an hour), and
+    infinity.
     """
 
-    def __cinit__(self, unsigned int bpp = 8):
-        cdef unsigned int params[4]
-        if bpp != 8:
-            raise ValueError('bpp must be equal to 8')
-        self._bpp = self._dither_bpp = bpp
+    def __cinit__(self):
+        cdef int i
+        for i in range(34):
+            self._counts[i] = 0
+        self._count = 0
+        self._total = self._min = self._max = 0
+
+    cdef object _add(self, double value):
+        cdef int exponent
+        cdef double mantissa
+        cdef int i
+        if value <= 1e-6:
+            i = 0
+        else:
+            # The smallest i such that value <= 2 ** i µs:
+            mantissa = frexp(value * 1e6, &exponent)
+            i = exponent - 1 if mantissa == 0.5 else exponent
+            if i > 33:
+                i = 33
+        self._counts[i] += 1
+        if self._count == 0 or value < self._min:
+            self._min = value
+        if self._count == 0 or value > self._max:
+            self._max = value
+        self._count += 1
+        self._total += value
+
+    cdef dict _as_dict(self):
+        return dict(
+            count=self.count,
+            total=self.total,
+            min=self.min,
+            max=self.max,
+            buckets=self.buckets,
+        )
+
+    def add(self, value):
+        """
+        H.add(value) -> None
+
+        Count the duration (in seconds).
+        """
+        self._add(value)
+
+    property count:
+        """
+        Return the number of counted durations.
+        """
+        def __get__(self):
+            return self._count
+
+    property total:
+        """
+        Return the sum of the counted durations, in seconds.
+        """
+        def __get__(self):
+            return self._total
+
+    property min:
+        """
+        Return the shortest counted duration, in seconds, or None.
+        """
+        def __get__(self):
+            if self._count:
+                return self._min
+
+    property max:
+        """
+        Return the longest counted duration, in seconds, or None.
+        """
+        def __get__(self):
+            if self._count:
+                return self._max
+
+    property buckets:
+        """
+        Return the non-empty buckets, as a list of (upper_bound, count)
+        pairs, where upper_bound is in seconds.
+        """
+        def __get__(self):
+            cdef int i
+            return [
+                (histogram_bucket_bound(i), self._counts[i])
+                for i in range(34)
+                if self._counts[i]
+            ]
+
+    def percentile(self, q):
+        """
+        H.percentile(q) -> a float or None
+
+        Return the upper bound (in seconds) of the bucket containing the q-th
+        percentile of the counted durations; or None if there are none.
+
+        Possible exceptions: ValueError.
+        """
+        cdef int i
+        cdef long long n = 0
+        if not 0 <= q <= 100:
+            raise ValueError('q must be between 0 and 100')
+        if self._count == 0:
+            return
+        for i in range(34):
+            n += self._counts[i]
+            if n * 100 >= q * self._count and n > 0:
+                return histogram_bucket_bound(i)
+
+    def __repr__(self):
+        return f'<{get_type_name(Histogram)} of {self._count} durations>'
+
+
+cdef object histogram_bucket_bound(int i):
+    if i == 33:
+        return float('inf')
+    return (1 << i) * 1e-6
+
+
+cdef object trace_frames
+trace_frames = {}
+
+
+cdef object trace_frame(object name):
+    # Return a frame-like object for the name, for sys.setprofile(...)-style
+    # tracers: they read frame.f_code.co_name and the like.
+    frame = trace_frames.get(name)
+    if frame is None:
+        code = SimpleNamespace(co_name=name, co_qualname=name, co_filename=__file__, co_firstlineno=0)
+        frame = SimpleNamespace(f_code=code, f_lineno=0, f_back=None, f_globals={}, f_locals={})
+        frame = trace_frames.setdefault(name, frame)
+    return frame
+
+
+cdef class Instrumentation:
+    """
+    Instrumentation(exporter=None, profile=False, tracer=None) -> an instrumentation
+
+    Performance counters of a context, its documents and jobs.
+
+    Attach the instrumentation to a context (see Context.instrumentation) to
+    count messages (by type), documents and jobs (and the time it took to
+    decode them), page renders (with the number of pixels and the time
+    spent), bytes passed to Stream.write(...) and the maximum message queue
+    depth; and to record the timestamps of documents and jobs (see
+    Document.timestamps and Job.timestamps). Without instrumentation, none of
+    this is recorded.
+
+    exporter, if not None, is called by export(...) with a snapshot.
+
+    If profile is true, also measure (see histograms) the time spent waiting
+    for and holding the lock that guards the creation of documents and jobs,
+    the time spent in handle_message(...) and in subscription callbacks (by
+    message type), and the delay between the moment the message distributor
+    takes a message and the moment it wakes up the waiting threads.
+
+    When profiling, tracer, if not None, is called as tracer(frame, event,
+    None), like sys.setprofile(...) functions: event is 'call' or 'return',
+    and frame is a frame-like object whose f_code.co_name is 'dispatch'
+    (handling a message as a whole), 'handle_message', 'subscriptions' or
+    'register_lock'.
+    """
+
+    def __cinit__(self, exporter=None, profile=False, tracer=None):
+        self.exporter = exporter
+        self.profile = profile
+        self.tracer = tracer
+        self._reset()
+
+    cdef object _reset(self):
+        cdef int i
+        for i in range(32):
+            self._message_counts[i] = 0
+        self._documents_created = self._documents_decoded = 0
+        self._document_time = 0
+        self._jobs_created = self._jobs_done = 0
+        self._job_time = 0
+        self._render_calls = self._render_pixels = 0
+        self._render_time = 0
+        self._stream_bytes = 0
+        self._max_queue_depth = 0
+        self._histograms = {}
+
+    cdef Histogram _histogram(self, object name):
+        cdef Histogram histogram
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            # Several threads might get here at once.
+            histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    cdef object _trace(self, object event, object name):
+        if self._tracer is None:
+            return
+        try:
+            self._tracer(trace_frame(name), event, None)
+        except Exception:
+            write_unraisable_exception(self._tracer)
+
+    cdef object _message_received(self, Context context, Job job, Document document, ddjvu_message_tag_t tag):
+        # Called by the message distributor before the message is passed to
+        # handle_message(...) or to the subscriptions.
+        if job is not None:
+            queue = job._queue
+        elif document is not None:
+            queue = document._queue
+        else:
+            queue = context._queue
+        depth = queue.qsize()
+        if depth > self._max_queue_depth:
+            self._max_queue_depth = depth
+        if job is not None and job._timestamps is not None and 'done' not in job._timestamps and ddjvu_job_done(job.ddjvu_job):
+            now = job._timestamps['done'] = monotonic()
+            self._jobs_done += 1
+            self._job_time += now - job._timestamps['created']
+        if tag == DDJVU_DOCINFO and document is not None and document._timestamps is not None and 'info' not in document._timestamps:
+            now = document._timestamps['info'] = monotonic()
+            self._documents_decoded += 1
+            self._document_time += now - document._timestamps['created']
+
+    property exporter:
+        """
+        The callable passed a snapshot by export(...), or None.
+        """
+        def __get__(self):
+            return self._exporter
+
+        def __set__(self, value):
+            if value is not None and not callable(value):
+                raise TypeError('exporter must be callable or None')
+            self._exporter = value
+
+    property profile:
+        """
+        Indicate whether profiling is enabled.
+        """
+        def __get__(self):
+            return bool(self._profile)
+
+        def __set__(self, value):
+            self._profile = bool(value)
+
+    property tracer:
+        """
+        The callable passed profiling events, or None.
+        """
+        def __get__(self):
+            return self._tracer
+
+        def __set__(self, value):
+            if value is not None and not callable(value):
+                raise TypeError('tracer must be callable or None')
+            self._tracer = value
+
+    property histograms:
+        """
+        Return a dictionary mapping names to the Histogram objects filled in
+        by profiling:
+
+        * 'register_lock.wait', 'register_lock.hold' -- the time spent
+          waiting for and holding the lock that guards the creation of
+          documents and jobs;
+        * 'handle_message.<type>', 'subscriptions.<type>' -- the time spent in
+          handle_message(...) and subscription callbacks, by message type
+          (e.g. 'handle_message.DocInfoMessage');
+        * 'wake_latency' -- the delay between the moment the message
+          distributor takes a message and the moment it wakes up the threads
+          waiting for the job or document.
+        """
+        def __get__(self):
+            return dict(self._histograms)
+
+    def snapshot(self, reset=False):
+        """
+        I.snapshot(reset=False) -> a dict
+
+        Return the current values of the counters, as a dictionary with the
+        following keys:
+
+        * messages -- a dictionary mapping Message subclass names to the
+          number of received messages of that type;
+        * documents_created, documents_decoded -- the number of created
+          documents, and of those for which DocInfoMessage was received;
+        * document_time -- the total time between the creation of these
+          documents and their DocInfoMessage, in seconds;
+        * jobs_created, jobs_done -- the number of created jobs (such as
+          page decoding jobs), and of those which are done;
+        * job_time -- the total time between the creation of these jobs and
+          the message that found them done, in seconds;
+        * render_calls, render_pixels, render_time -- the number of page
+          render calls (tiles are counted separately), the number of
+          rendered pixels, and the time spent rendering, in seconds;
+        * stream_bytes -- the number of bytes passed to Stream.write(...);
+        * max_queue_depth -- the maximum number of messages waiting in the
+          message queue of a job, a document or the context when another
+          message for it was received;
+        * histograms -- a dictionary mapping the names of histograms (see
+          histograms) to dictionaries with the count, total, min, max and
+          buckets keys.
+
+        If reset is true, reset the counters to zero.
+        """
+        cdef int tag
+        messages = {}
+        for tag, message_class in MESSAGE_MAP.items():
+            if self._message_counts[tag]:
+                messages[message_class.__name__] = self._message_counts[tag]
+        snapshot = dict(
+            messages=messages,
+            documents_created=self._documents_created,
+            documents_decoded=self._documents_decoded,
+            document_time=self._document_time,
+            jobs_created=self._jobs_created,
+            jobs_done=self._jobs_done,
+            job_time=self._job_time,
+            render_calls=self._render_calls,
+            render_pixels=self._render_pixels,
+            render_time=self._render_time,
+            stream_bytes=self._stream_bytes,
+            max_queue_depth=self._max_queue_depth,
+            histograms={
+                name: (<Histogram> histogram)._as_dict()
+                for name, histogram in list(self._histograms.items())
+            },
+        )
+        if reset:
+            self._reset()
+        return snapshot
+
+    def export(self, reset=False):
+        """
+        I.export(reset=False) -> None
+
+        Pass a snapshot (see snapshot(...)) to the exporter, if any.
+
+        If reset is true, reset the counters to zero.
+        """
+        snapshot = self.snapshot(reset)
+        if self._exporter is not None:
+            self._exporter(snapshot)
+
+    def reset(self):
+        """
+        I.reset() -> None
+
+        Reset the counters to zero.
+        """
+        self._reset()
+
+
+cdef class _RegisterLock:
+
+    # The lock that guards the creation of documents and jobs of a context,
+    # as used when the instrumentation of the context is profiling: the time
+    # spent waiting for and holding the lock is measured. Otherwise, the bare
+    # lock is used (see Context._registering()).
+
+    def __cinit__(self, lock):
+        self._lock = lock
+        self._instrumentation = None
+        self._acquired = 0
+
+    def __enter__(self):
+        cdef Instrumentation instrumentation = self._instrumentation
+        cdef double start
+        if instrumentation is None or not instrumentation._profile:
+            self._lock.acquire()
+            return
+        instrumentation._trace('call', 'register_lock')
+        start = monotonic()
+        self._lock.acquire()
+        self._acquired = monotonic()
+        instrumentation._histogram('register_lock.wait')._add(self._acquired - start)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        cdef Instrumentation instrumentation = self._instrumentation
+        cdef double acquired = self._acquired
+        self._acquired = 0
+        self._lock.release()
+        if acquired == 0 or instrumentation is None:
+            return
+        instrumentation._histogram('register_lock.hold')._add(monotonic() - acquired)
+        instrumentation._trace('return', 'register_lock')
+
+
+cdef class Context:
+
+    def __cinit__(self, argv0=None, QueuePolicy queue_policy=None):
+        if argv0 is None:
+            argv0 = sys.argv[0]
+        if is_unicode(argv0):
+            argv0 = encode_utf8(argv0)
+        self._argv0 = argv0
+        self.ddjvu_context = ddjvu_context_create(argv0)
+        if self.ddjvu_context == NULL:
+            raise MemoryError('Unable to create DjVu context')
+        # Held while creating documents and jobs, so that their messages
+        # cannot be handled before the Python objects are registered.
+        self._register_lock = thread.allocate_lock()
+        self._profiled_register_lock = _RegisterLock(self._register_lock)
+        self._queue_policy = queue_policy
+        self._queue = MessageQueue(queue_policy)
+        self._subscriptions = ()
+        self._subscription_mask = 0
+        self._message_types = None
+        self._message_mask = ~0U
+        self._buffer_pool = None
+        self._render_cache = None
+        self._instrumentation = None
+        thread.start_new_thread(Context_message_distributor, (self,), {'sentinel': the_sentinel})
+        _contexts.add(self)
+
+    cdef object _after_fork(self, object cache_size):
+        # Called in the child process after fork(). The libdjvu context, its
+        # threads and the message distributor did not survive; neither did
+        # locks held by other threads. Leak the old context (releasing it
+        # might deadlock) and start afresh.
+        self.ddjvu_context = ddjvu_context_create(self._argv0)
+        if self.ddjvu_context == NULL:
+            raise MemoryError('Unable to create DjVu context')
+        if cache_size is not None:
+            ddjvu_cache_set_size(self.ddjvu_context, cache_size)
+        self._register_lock = thread.allocate_lock()
+        self._profiled_register_lock = _RegisterLock(self._register_lock)
+        self._profiled_register_lock._instrumentation = self._instrumentation
+        self._queue = MessageQueue(self._queue_policy)
+        thread.start_new_thread(Context_message_distributor, (self,), {'sentinel': the_sentinel})
+
+    cdef object _registering(self):
+        # Return the context manager that holds the register lock: unless
+        # profiling, the bare lock, without any Python-level overhead.
+        if self._instrumentation is not None and self._instrumentation._profile:
+            return self._profiled_register_lock
+        return self._register_lock
+
+    property cache_size:
+
+        def __set__(self, value):
+            if 0 < value < (1 << 31):
+                ddjvu_cache_set_size(self.ddjvu_context, value)
+            else:
+                raise ValueError('0 < cache_size < (2 ** 31) must be satisfied')
+
+        def __get__(self):
+            return ddjvu_cache_get_size(self.ddjvu_context)
+
+    property queue_policy:
+        """
+        Return the QueuePolicy of the message queues of this context, its
+        documents and jobs, or None (i.e. unbounded queues).
+        """
+        def __get__(self):
+            return self._queue_policy
+
+    property message_types:
+        """
+        The types of messages passed to handle_message(...), or None (i.e.
+        all messages).
+
+        Other messages are discarded before being converted to Python
+        objects, unless a subscription is interested in them. Blocking
+        methods are not affected.
+
+        Possible exceptions: TypeError.
+        """
+
+        def __get__(self):
+            return self._message_types
+
+        def __set__(self, value):
+            if value is None:
+                self._message_mask = ~0U
+            else:
+                value = tuple(value)
+                self._message_mask = message_types_to_mask(value)
+            self._message_types = value
+
+    def subscribe(self, types, callback):
+        """
+        C.subscribe(types, callback) -> a Subscription
+
+        Call callback(message), in a separate thread, for every received
+        message that is an instance of one of the types. Such messages are
+        then not passed to handle_message(...).
+
+        All exceptions raised by the callback will be ignored.
+
+        Possible exceptions: TypeError.
+        """
+        cdef Subscription subscription
+        subscription = Subscription(self, types, callback, sentinel = the_sentinel)
+        self._subscriptions += (subscription,)
+        self._subscription_mask |= subscription._mask
+        return subscription
+
+    property buffer_pool:
+        """
+        The RenderBufferPool used by the render methods of the jobs and
+        thumbnails of this context when no buffer is provided, or None.
+
+        The default is None, i.e. render into newly created strings.
+        """
+
+        def __get__(self):
+            return self._buffer_pool
+
+        def __set__(self, RenderBufferPool value):
+            self._buffer_pool = value
+
+    property render_cache:
+        """
+        The RenderCache used by PageJob.render(...) for the jobs of this
+        context when no buffer is provided, or None.
+
+        The default is None, i.e. do not cache rendered images.
+        """
+
+        def __get__(self):
+            return self._render_cache
+
+        def __set__(self, RenderCache value):
+            self._render_cache = value
+
+    property instrumentation:
+        """
+        The Instrumentation collecting performance counters of this context,
+        its documents and jobs, or None.
+
+        The default is None, i.e. do not collect anything.
+        """
+
+        def __get__(self):
+            return self._instrumentation
+
+        def __set__(self, Instrumentation value):
+            self._instrumentation = value
+            self._profiled_register_lock._instrumentation = value
+
+    def handle_message(self, Message message not None):
+        """
+        C.handle_message(message) -> None
+
+        This method is called, in a separate thread, for every received
+        message, *before* any blocking method finishes. (Messages filtered
+        out by message_types, or delivered to a subscription, are skipped.)
+
+        By default, do something roughly equivalent to::
+
+            if message.job is not None:
+                message.job.message_queue.put(message)
+            elif message.document is not None:
+                message.document.message_queue.put(message)
+            else:
+                message.context.message_queue.put(message)
+
+        You may want to override this method to change this behaviour.
+
+        All exceptions raised by this method will be ignored.
+        """
+
+        # XXX Order of branches below is *crucial*. Do not change.
+        if message._job is not None:
+            message._job._queue.put(message)
+        elif message._page_job is not None:
+            raise SystemError  # Should not happen.
+        elif message._document is not None:
+            message._document._queue.put(message)
+        else:
+            message._context._queue.put(message)
+
+    property message_queue:
+        """
+        Return the internal message queue.
+        """
+        def __get__(self):
+            return self._queue
+
+    def get_message(self, wait=1):
+        """
+        C.get_message(wait=True) -> a Message or None
+
+        Get message from the internal context queue.
+        Return None if wait is false and no message is available.
+        """
+        try:
+            return self._queue.get(wait)
+        except Empty:
+            return
+
+    def new_document(self, uri, cache=1, DocumentIndex index=None):
+        """
+        C.new_document(uri, cache=True, index=None) -> a Document
+
+        Creates a decoder for a DjVu document and starts decoding. This
+        method returns immediately. The decoding job then generates messages to
+        request the raw data and to indicate the state of the decoding process.
+
+        uri specifies an optional URI for the document. The URI follows the
+        usual syntax (protocol://machine/path). It should not end with
+        a slash. It only serves two purposes:
+
+        - The URI is used as a key for the cache of decoded pages.
+        - The URI is used to document NewStreamMessage messages.
+
+        Setting argument cache to a true value indicates that decoded pages
+        should be cached when possible.
+
+        It is important to understand that the URI is not used to access the
+        data. The document generates NewStreamMessage messages to indicate
+        which data is needed. The caller must then provide the raw data using
+        a NewStreamMessage.stream object.
+
+        To open a local file, provide a FileUri instance as a URI.
+
+        Localized characters in uri should be in URI-encoded.
+
+        If index is a DocumentIndex and uri is a FileUri of a document
+        recorded in it, the page information, the component files, the
+        outline and the document-wide annotations are served from the index
+        until they are decoded (see Document.index_entry).
+
+        Possible exceptions: JobFailed.
+        """
+        cdef Document document
+        cdef ddjvu_document_t* ddjvu_document
+        cdef DocumentIndexEntry entry = None
+        if index is not None and typecheck(uri, FileUri):
+            entry = index.lookup(uri)
+        with self._registering():
+            if typecheck(uri, FileUri):
+                uri = encode_utf8(uri)
+                ddjvu_document = ddjvu_document_create_by_filename(self.ddjvu_context, uri, cache)
+            else:
+                uri = encode_utf8(uri)
+                ddjvu_document = ddjvu_document_create(self.ddjvu_context, uri, cache)
+            if ddjvu_document == NULL:
+                raise JobFailed
+            document = Document(sentinel = the_sentinel)
+            if entry is not None:
+                document._index_entry = entry
+                document._page_info_table = entry._page_info_table
+                document._file_table = entry._file_table
+            document._init(self, ddjvu_document)
+        return document
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get_message()
+
+    def clear_cache(self):
+        """
+        C.clear_cache() -> None
+        """
+        ddjvu_cache_clear(self.ddjvu_context)
+
+    def __dealloc__(self):
+        ddjvu_context_release(self.ddjvu_context)
+
+
+cdef object context_pool_release
+
+
+def _context_pool_release(ContextPool pool, uri):
+    pool._release(uri)
+
+
+context_pool_release = _context_pool_release
+del _context_pool_release
+
+
+cdef object _contexts, _context_pools, _buffer_pools, _render_caches, _page_job_caches, _schedulers, _document_indexes, _fork_state, _fork_indexes
+_contexts = weakref.WeakSet()
+_context_pools = weakref.WeakSet()
+_buffer_pools = weakref.WeakSet()
+_render_caches = weakref.WeakSet()
+_page_job_caches = weakref.WeakSet()
+_schedulers = weakref.WeakSet()
+_document_indexes = weakref.WeakSet()
+_fork_indexes = []
+_fork_state = []
+
+
+cdef object before_fork, after_fork_in_parent, after_fork_in_child
+
+
+def _before_fork():
+    # Wait until no document or job is being created, and keep it so until
+    # the fork is over. Remember the cache sizes: libdjvu must not be called
+    # in the child for the old contexts.
+    # An SQLite connection must not be used (not even closed) in the child:
+    # close the databases of the indexes, and reopen them afterwards.
+    cdef Context context
+    cdef DocumentIndex index
+    contexts = sorted(_contexts, key=id)
+    for context in contexts:
+        context._register_lock.acquire()
+        _fork_state.append((context, ddjvu_cache_get_size(context.ddjvu_context)))
+    for index in sorted(_document_indexes, key=id):
+        index._lock.acquire()
+        _fork_indexes.append(index)
+        if index._path is not None:
+            index._connection.close()
+
+
+def _after_fork_in_parent():
+    cdef Context context
+    cdef DocumentIndex index
+    for context, cache_size in _fork_state:
+        context._register_lock.release()
+    del _fork_state[:]
+    for index in _fork_indexes:
+        try:
+            index._reopen()
+        finally:
+            index._lock.release()
+    del _fork_indexes[:]
+
+
+def _after_fork_in_child():
+    global fork_generation
+    cdef Context context
+    cdef ContextPool pool
+    cdef RenderBufferPool buffer_pool
+    cdef RenderCache render_cache
+    cdef PageJobCache page_job_cache
+    cdef DecodeScheduler scheduler
+    cdef DocumentIndex index
+    fork_generation += 1
+    # Unfinished documents and jobs will never be finished.
+    _document_loft.clear()
+    _job_loft.clear()
+    cache_sizes = dict(_fork_state)
+    del _fork_state[:]
+    for context in list(_contexts):
+        context._after_fork(cache_sizes.get(context))
+    for pool in list(_context_pools):
+        pool._lock = thread.allocate_lock()
+    for buffer_pool in list(_buffer_pools):
+        buffer_pool._lock = thread.allocate_lock()
+    for render_cache in list(_render_caches):
+        render_cache._lock = thread.allocate_lock()
+    for page_job_cache in list(_page_job_caches):
+        page_job_cache._lock = thread.allocate_lock()
+        page_job_cache._in_flight.clear()
+    for scheduler in list(_schedulers):
+        scheduler._condition = Condition()
+    for index in _fork_indexes:
+        index._lock = thread.allocate_lock()
+        index._reopen()
+    del _fork_indexes[:]
+
+
+before_fork = _before_fork
+after_fork_in_parent = _after_fork_in_parent
+after_fork_in_child = _after_fork_in_child
+del _before_fork, _after_fork_in_parent, _after_fork_in_child
+
+if register_at_fork is not None:
+    register_at_fork(before=before_fork, after_in_parent=after_fork_in_parent, after_in_child=after_fork_in_child)
+
+
+cdef class ContextPool:
+    """
+    ContextPool(n=None, argv0=None, cache_size=None, queue_policy=None)
+      -> a context pool
+
+    A pool of n contexts, each with its own message distributor thread and
+    its own cache of decoded pages. By default, n is equal to the number of
+    processors. argv0 and queue_policy are passed to every Context; if
+    cache_size is not None, it is the cache size of every context.
+
+    Documents with the same URI are opened in the same context, so that they
+    share the cache. Other documents are opened in the context with the
+    fewest open documents.
+    """
+
+    def __cinit__(self, n=None, argv0=None, cache_size=None, QueuePolicy queue_policy=None):
+        if n is None:
+            n = cpu_count() or 1
+        elif n <= 0:
+            raise ValueError('n must be a positive integer')
+        self._contexts = tuple(Context(argv0, queue_policy) for i in range(n))
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self._lock = thread.allocate_lock()
+        self._loads = [0] * n
+        self._uris = {}
+        _context_pools.add(self)
+
+    cdef int _acquire(self, object uri) except -1:
+        # Choose the context for a new document and account for it.
+        cdef int n
+        with self._lock:
+            entry = self._uris.get(uri)
+            if entry is None:
+                n = min(range(len(self._loads)), key=self._loads.__getitem__)
+                entry = self._uris[uri] = [n, 0]
+            else:
+                n = entry[0]
+            entry[1] += 1
+            self._loads[n] += 1
+            return n
+
+    cdef object _release(self, object uri):
+        # Called when a document is deallocated.
+        with self._lock:
+            entry = self._uris[uri]
+            entry[1] -= 1
+            self._loads[entry[0]] -= 1
+            if entry[1] == 0:
+                del self._uris[uri]
+
+    property contexts:
+        """
+        Return the contexts of the pool, as a tuple.
+        """
+        def __get__(self):
+            return self._contexts
+
+    property loads:
+        """
+        Return the number of open documents in each context, as a list.
+        """
+        def __get__(self):
+            with self._lock:
+                return list(self._loads)
+
+    property cache_size:
+        """
+        The cache size of each context of the pool.
+        """
+
+        def __get__(self):
+            return self._contexts[0].cache_size
+
+        def __set__(self, value):
+            for context in self._contexts:
+                context.cache_size = value
+
+    def new_document(self, uri, cache=1, index=None):
+        """
+        P.new_document(uri, cache=True, index=None) -> a Document
+
+        Create a decoder for a DjVu document in one of the contexts of the
+        pool. See Context.new_document(...).
+
+        Possible exceptions: JobFailed.
+        """
+        cdef int n
+        n = self._acquire(uri)
+        try:
+            document = self._contexts[n].new_document(uri, cache, index)
+        except BaseException:
+            self._release(uri)
+            raise
+        weakref.finalize(document, context_pool_release, self, uri)
+        return document
+
+    def clear_cache(self):
+        """
+        P.clear_cache() -> None
+
+        Clear the caches of all the contexts of the pool.
+        """
+        for context in self._contexts:
+            context.clear_cache()
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def __repr__(self):
+        return f'<{get_type_name(ContextPool)} of {len(self._contexts)} contexts>'
+
+
+RENDER_COLOR = DDJVU_RENDER_COLOR
+RENDER_BLACK = DDJVU_RENDER_BLACK
+RENDER_COLOR_ONLY = DDJVU_RENDER_COLORONLY
+RENDER_MASK_ONLY = DDJVU_RENDER_MASKONLY
+RENDER_BACKGROUND = DDJVU_RENDER_BACKGROUND
+RENDER_FOREGROUND = DDJVU_RENDER_FOREGROUND
+
+PAGE_TYPE_UNKNOWN = DDJVU_PAGETYPE_UNKNOWN
+PAGE_TYPE_BITONAL = DDJVU_PAGETYPE_BITONAL
+PAGE_TYPE_PHOTO = DDJVU_PAGETYPE_PHOTO
+PAGE_TYPE_COMPOUND = DDJVU_PAGETYPE_COMPOUND
+
+
+cdef class PixelFormat:
+    """
+    Abstract pixel format.
+
+    Do not use this class directly, use one of its subclasses.
+    """
+
+    def __cinit__(self, *args, **kwargs):
+        self._row_order = 0
+        self._y_direction = 0
+        self._dither_bpp = 32
+        self._gamma = 2.2
+        self.ddjvu_format = NULL
+        for cls in (PixelFormatRgb, PixelFormatRgbMask, PixelFormatRgba, PixelFormatGrey, PixelFormatPalette, PixelFormatPackedBits):
+            if typecheck(self, cls):
+                return
+        raise_instantiation_error(type(self))
+
+    property rows_top_to_bottom:
+        """
+        Flag indicating whether the rows in the pixel buffer are stored
+        starting from the top or the bottom of the image.
+
+        Default ordering starts from the bottom of the image. This is the
+        opposite of the X11 convention.
+        """
+
+        def __get__(self):
+            return bool(self._row_order)
+
+        def __set__(self, value):
+            self._row_order = not not value
+            ddjvu_format_set_row_order(self.ddjvu_format, self._row_order)
+
+    property y_top_to_bottom:
+        """
+        Flag indicating whether the *y* coordinates in the drawing area are
+        oriented from bottom to top, or from top to bottom.
+
+        The default is bottom to top, similar to PostScript. This is the
+        opposite of the X11 convention.
+        """
+
+        def __get__(self):
+            return bool(self._y_direction)
+
+        def __set__(self, value):
+            self._y_direction = not not value
+            ddjvu_format_set_y_direction(self.ddjvu_format, self._y_direction)
+
+    property bpp:
+        """
+        Return the depth of the image, in bits per pixel.
+        """
+        def __get__(self):
+            return self._bpp
+
+    property dither_bpp:
+        """
+        The final depth of the image on the screen. This is used to decide
+        which dithering algorithm should be used.
+
+        The default is usually appropriate.
+        """
+        def __get__(self):
+            return self._dither_bpp
+
+        def __set__(self, int value):
+            if 0 < value < 64:
+                ddjvu_format_set_ditherbits(self.ddjvu_format, value)
+                self._dither_bpp = value
+            else:
+                raise ValueError('0 < value < 64 must be satisfied')
+
+    property gamma:
+        """
+        Gamma of the display for which the pixels are intended. This will be
+        combined with the gamma stored in DjVu documents in order to compute
+        a suitable color correction.
+
+        The default value is 2.2.
+        """
+        def __get__(self):
+            return self._gamma
+
+        def __set__(self, double value):
+            if 0.5 <= value <= 5.0:
+                ddjvu_format_set_gamma(self.ddjvu_format, value)
+                self._gamma = value
+            else:
+                raise ValueError('0.5 <= value <= 5.0 must be satisfied')
+
+    def __dealloc__(self):
+        if self.ddjvu_format != NULL:
+            ddjvu_format_release(self.ddjvu_format)
+
+    def __repr__(self):
+        return f'{get_type_name(type(self))}()'
+
+
+cdef class PixelFormatRgb(PixelFormat):
+    """
+    PixelFormatRgb([byteorder='RGB']) -> a pixel format
+
+    24-bit pixel format, with:
+
+    - RGB (byteorder == 'RGB') or
+    - BGR (byteorder == 'BGR')
+
+    byte order.
+    """
+
+    def __cinit__(self, byte_order='RGB', unsigned int bpp=24):
+        cdef ddjvu_format_style_t _format
+        if byte_order == 'RGB':
+            self._rgb = 1
+            _format = DDJVU_FORMAT_RGB24
+        elif byte_order == 'BGR':
+            self._rgb = 0
+            _format = DDJVU_FORMAT_BGR24
+        else:
+            raise ValueError("byte_order must be equal to 'RGB' or 'BGR'")
+        if bpp != 24:
+            raise ValueError('bpp must be equal to 24')
+        self._bpp = 24
+        self.ddjvu_format = ddjvu_format_create(_format, 0, NULL)
+
+    property byte_order:
+        """
+        Return the byte order:
+        - 'RGB' or
+        - 'BGR'.
+        """
+        def __get__(self):
+            if self._rgb:
+                return 'RGB'
+            else:
+                return 'BGR'
+
+    def __repr__(self):
+        return f'{get_type_name(PixelFormatRgb)}(byte_order = {self.byte_order!r}, bpp = {self.bpp})'
+
+
+cdef class PixelFormatRgbMask(PixelFormat):
+    """
+    PixelFormatRgbMask(red_mask, green_mask, blue_mask[, xor_value], bpp=16) -> a pixel format
+    PixelFormatRgbMask(red_mask, green_mask, blue_mask[, xor_value], bpp=32) -> a pixel format
+
+    red_mask, green_mask and blue_mask are bit masks for color components
+    for each pixel. The resulting color is then xored with the xor_value.
+
+    For example, PixelFormatRgbMask(0xF800, 0x07E0, 0x001F, bpp=16) is a
+    highcolor format with:
+
+    - 5 (most significant) bits for red,
+    - 6 bits for green,
+    - 5 (least significant) bits for blue.
+    """
+
+    def __cinit__(
+            self, unsigned int red_mask, unsigned int green_mask, unsigned int blue_mask, unsigned int xor_value = 0, unsigned int bpp = 16
+    ):
+        cdef ddjvu_format_style_t _format
+        if bpp == 16:
+            _format = DDJVU_FORMAT_RGBMASK16
+            red_mask = red_mask & 0xFFFF
+            blue_mask = blue_mask & 0xFFFF
+            green_mask = green_mask & 0xFFFF
+            xor_value = xor_value & 0xFFFF
+        elif bpp == 32:
+            _format = DDJVU_FORMAT_RGBMASK32
+            red_mask = red_mask & 0xFFFFFFFF
+            blue_mask = blue_mask & 0xFFFFFFFF
+            green_mask = green_mask & 0xFFFFFFFF
+            xor_value = xor_value & 0xFFFFFFFF
+        else:
+            raise ValueError('bpp must be equal to 16 or 32')
+        self._bpp = self._dither_bpp = bpp
+        (self._params[0], self._params[1], self._params[2], self._params[3]) = (red_mask, green_mask, blue_mask, xor_value)
+        self.ddjvu_format = ddjvu_format_create(_format, 4, self._params)
+
+    def __repr__(self):
+        return (
+            f'{get_type_name(PixelFormatRgbMask)}(red_mask = 0x{self._params[0]:0{self.bpp // 4}x}, '
+            f'green_mask = 0x{self._params[1]:0{self.bpp // 4}x}, blue_mask = 0x{self._params[2]:0{self.bpp // 4}x}, '
+            f'xor_value = 0x{self._params[3]:0{self.bpp // 4}x}, bpp = {self.bpp})'
+        )
+
+
+cdef class PixelFormatRgba(PixelFormat):
+    """
+    PixelFormatRgba(byte_order='RGBA', premultiplied=False) -> a pixel format
+
+    32-bit pixel format with an alpha channel, with:
+
+    - RGBA (byte_order == 'RGBA'),
+    - BGRA (byte_order == 'BGRA'),
+    - ARGB (byte_order == 'ARGB') or
+    - ABGR (byte_order == 'ABGR')
+
+    byte order.
+
+    Color components are rendered according to the rendering mode. Within the
+    same call, the mask (stencil) of the page is rendered stripe by stripe
+    into the alpha channel: pixels are opaque where the mask is set and
+    transparent elsewhere. Pages without a mask are opaque. For example,
+    rendering with RENDER_FOREGROUND yields the foreground colors with the
+    mask as the alpha channel.
+
+    If premultiplied is true, color components are premultiplied by alpha.
+    """
+
+    def __cinit__(self, byte_order='RGBA', premultiplied=False):
+        cdef int i, shift
+        if byte_order not in ('RGBA', 'BGRA', 'ARGB', 'ABGR'):
+            raise ValueError("byte_order must be equal to 'RGBA', 'BGRA', 'ARGB' or 'ABGR'")
+        for i, channel in enumerate(byte_order):
+            shift = 8 * i if sys.byteorder == 'little' else 8 * (3 - i)
+            if channel == 'A':
+                self._alpha_index = i
+            else:
+                self._params['RGB'.index(channel)] = 0xFF << shift
+        self._params[3] = 0
+        self._byte_order = byte_order
+        self._premultiplied = not not premultiplied
+        self._bpp = self._dither_bpp = 32
+        self.ddjvu_format = ddjvu_format_create(DDJVU_FORMAT_RGBMASK32, 4, self._params)
+
+    property byte_order:
+        """
+        Return the byte order:
+        - 'RGBA',
+        - 'BGRA',
+        - 'ARGB' or
+        - 'ABGR'.
+        """
+        def __get__(self):
+            return self._byte_order
+
+    property premultiplied:
+        """
+        Indicate whether color components are premultiplied by alpha.
+        """
+        def __get__(self):
+            return bool(self._premultiplied)
+
+    def __repr__(self):
+        return (
+            f'{get_type_name(PixelFormatRgba)}(byte_order = {self._byte_order!r}, '
+            f'premultiplied = {self.premultiplied!r})'
+        )
+
+
+cdef class PixelFormatGrey(PixelFormat):
+    """
+    PixelFormatGrey() -> a pixel format
+
+    8-bit, grey pixel format.
+    """
+
+    def __cinit__(self, unsigned int bpp = 8):
+        cdef unsigned int params[4]
+        if bpp != 8:
+            raise ValueError('bpp must be equal to 8')
+        self._bpp = self._dither_bpp = bpp
         self.ddjvu_format = ddjvu_format_create(DDJVU_FORMAT_GREY8, 0, NULL)
 
     def __repr__(self):
-        return f'{get_type_name(PixelFormatGrey)}(bpp = {self.bpp!r})'
+        return f'{get_type_name(PixelFormatGrey)}(bpp = {self.bpp!r})'
+
+
+cdef class PixelFormatPalette(PixelFormat):
+    """
+    PixelFormatPalette(palette) -> a pixel format
+
+    Palette pixel format.
+
+    palette must be a dictionary which contains 216 (6 * 6 * 6) entries of
+    a web color cube, such that:
+
+    - for each key (r, g, b): r in range(0, 6), g in range(0, 6) etc.;
+    - for each value v: v in range(0, 0x100).
+    """
+
+    def __cinit__(self, palette, unsigned int bpp = 8):
+        cdef int i, j, k, n
+        for i in range(6):
+            for j in range(6):
+                for k in range(6):
+                    n = palette[(i, j, k)]
+                    if not 0 <= n < 0x100:
+                        raise ValueError('palette entries must be in range(0, 0x100)')
+                    self._palette[i*6*6 + j*6 + k] = n
+        if bpp != 8:
+            raise ValueError('bpp must be equal to 8')
+        self._bpp = self._dither_bpp = bpp
+        self.ddjvu_format = ddjvu_format_create(DDJVU_FORMAT_PALETTE8, 216, self._palette)
+
+    def __repr__(self):
+        cdef int i, j, k
+        io = StringIO()
+        io.write(get_type_name(PixelFormatPalette) + '({')
+        for i in range(6):
+            for j in range(6):
+                for k in range(6):
+                    io.write(f'({i}, {j}, {k}): 0x{self._palette[i * 6 * 6 + j * 6 + k]:02x}')
+                    if not (i == j == k == 5):
+                        io.write(', ')
+        io.write(f'}}, bpp = {self.bpp})')
+        return io.getvalue()
+
+
+cdef class PixelFormatPackedBits(PixelFormat):
+    """
+    PixelFormatPackedBits(endianness) -> a pixel format
+
+    Bitonal, 1 bit per pixel format with:
+
+    - most significant bits on the left (endianness=='>') or
+    - least significant bits on the left (endianness=='<').
+    """
+
+    def __cinit__(self, endianness):
+        cdef ddjvu_format_style_t _format
+        if endianness == '<':
+            self._little_endian = 1
+            _format = DDJVU_FORMAT_LSBTOMSB
+        elif endianness == '>':
+            self._little_endian = 0
+            _format = DDJVU_FORMAT_MSBTOLSB
+        else:
+            raise ValueError("endianness must be equal to '<' or '>'")
+        self._bpp = 1
+        self._dither_bpp = 1
+        self.ddjvu_format = ddjvu_format_create(_format, 0, NULL)
+
+    property endianness:
+        """
+        The endianness:
+        - '<' (most significant bits on the left) or
+        - '>' (least significant bits on the left).
+        """
+        def __get__(self):
+            if self._little_endian:
+                return '<'
+            else:
+                return '>'
+
+    def __repr__(self):
+        return f'{get_type_name(PixelFormatPackedBits)}({self.endianness!r})'
+
+
+cdef object calculate_row_size(long width, long row_alignment, int bpp):
+    cdef long result
+    cdef object row_size
+    if bpp == 1:
+        row_size = (width >> 3) + ((width & 7) != 0)
+    elif bpp & 7 == 0:
+        row_size = width
+        row_size = row_size * (bpp >> 3)
+    else:
+        raise SystemError
+    result = ((row_size + (row_alignment - 1)) // row_alignment) * row_alignment
+    return result
+
+
+cdef Py_ssize_t buffer_bucket_size(Py_ssize_t size):
+    # Round the size up, so that there are four buckets per power of two.
+    cdef Py_ssize_t step = 1
+    while (step << 3) < size:
+        step <<= 1
+    return (size + step - 1) // step * step
+
+
+cdef class RenderBufferPool:
+    """
+    RenderBufferPool(max_bytes=64 << 20) -> a render buffer pool
+
+    A pool of reusable image buffers.
+
+    Pass the pool as the buffer argument of PageJob.render(...),
+    PageJob.render_image(...) or Thumbnail.render(...), or attach it to
+    a context (see Context.buffer_pool), to render into buffers taken from
+    the pool rather than into newly created strings. The rendered data is
+    then a memoryview of a pooled bytearray. Pass it to release(...) once it
+    is no longer needed, so that the buffer can be reused.
+
+    Buffer sizes are rounded up, so that requests of similar sizes share
+    buffers. At most max_bytes bytes of idle buffers are kept; the least
+    recently released buffers are evicted first.
+    """
+
+    def __cinit__(self, max_bytes=(64 << 20)):
+        self._lock = thread.allocate_lock()
+        self._idle = OrderedDict()
+        self._buckets = {}
+        self._idle_bytes = 0
+        self._max_bytes = 0
+        self._hits = self._misses = self._evictions = 0
+        _buffer_pools.add(self)
+        self.max_bytes = max_bytes
+
+    cdef object _evict(self):
+        # Assumption: self._lock is already acquired.
+        cdef Py_ssize_t size
+        while self._idle_bytes > self._max_bytes:
+            key, buffer = self._idle.popitem(last=False)
+            size = len(buffer)
+            del self._buckets[size][key]
+            self._idle_bytes -= size
+            self._evictions += 1
+
+    property max_bytes:
+        """
+        The maximum total size of idle buffers kept in the pool, in bytes.
+        """
+        def __get__(self):
+            return self._max_bytes
+
+        def __set__(self, value):
+            if value < 0:
+                raise ValueError('max_bytes must be a non-negative integer')
+            with self._lock:
+                self._max_bytes = value
+                self._evict()
+
+    def acquire(self, size):
+        """
+        P.acquire(size) -> a bytearray
+
+        Return a writable buffer of at least size bytes, reusing an idle
+        buffer if possible.
+        """
+        cdef Py_ssize_t c_size = size
+        if c_size < 0:
+            raise ValueError('size must be a non-negative integer')
+        c_size = buffer_bucket_size(c_size)
+        with self._lock:
+            bucket = self._buckets.get(c_size)
+            if bucket:
+                key, buffer = bucket.popitem()
+                del self._idle[key]
+                self._idle_bytes -= c_size
+                self._hits += 1
+                return buffer
+            self._misses += 1
+        return make_bytearray(NULL, c_size)
+
+    def release(self, buffer):
+        """
+        P.release(buffer) -> None
+
+        Return a buffer obtained from the pool (or a memoryview of it) to the
+        pool. The buffer must not be used afterwards.
+
+        Possible exceptions: TypeError, ValueError (if the buffer does not
+        come from a pool).
+        """
+        cdef Py_ssize_t size
+        if typecheck(buffer, memoryview):
+            buffer = buffer.obj
+        if not typecheck(buffer, bytearray):
+            raise TypeError('buffer must be a bytearray or a memoryview of a bytearray')
+        size = len(buffer)
+        if size == 0 or buffer_bucket_size(size) != size:
+            raise ValueError('buffer does not come from a pool')
+        key = id(buffer)
+        with self._lock:
+            if key in self._idle:
+                return
+            self._idle[key] = buffer
+            self._buckets.setdefault(size, OrderedDict())[key] = buffer
+            self._idle_bytes += size
+            self._evict()
+
+    def clear(self):
+        """
+        P.clear() -> None
+
+        Drop all idle buffers.
+        """
+        with self._lock:
+            self._idle.clear()
+            self._buckets.clear()
+            self._idle_bytes = 0
+
+    property idle_bytes:
+        """
+        Return the total size of idle buffers kept in the pool, in bytes.
+        """
+        def __get__(self):
+            return self._idle_bytes
+
+    property hits:
+        """
+        Return the number of requests satisfied by an idle buffer.
+        """
+        def __get__(self):
+            return self._hits
+
+    property misses:
+        """
+        Return the number of requests that required a new buffer.
+        """
+        def __get__(self):
+            return self._misses
+
+    property evictions:
+        """
+        Return the number of idle buffers evicted from the pool.
+        """
+        def __get__(self):
+            return self._evictions
+
+    def __repr__(self):
+        return f'{get_type_name(RenderBufferPool)}(max_bytes = {self._max_bytes})'
 
 
-cdef class PixelFormatPalette(PixelFormat):
+cdef object pixel_format_key(PixelFormat pixel_format):
+    # Key identifying how pixel_format renders images.
+    return (
+        type(pixel_format), repr(pixel_format),
+        pixel_format._dither_bpp, pixel_format._row_order, pixel_format._y_direction, pixel_format._gamma
+    )
+
+
+cdef class RenderCache:
     """
-    PixelFormatPalette(palette) -> a pixel format
+    RenderCache(max_bytes=64 << 20) -> a render cache
 
-    Palette pixel format.
+    An in-memory cache of images rendered by PageJob.render(...).
 
-    palette must be a dictionary which contains 216 (6 * 6 * 6) entries of
-    a web color cube, such that:
+    Attach the cache to a context (see Context.render_cache) to make
+    PageJob.render(...) calls without the buffer argument return cached
+    images where possible. Images are keyed by the document, page number,
+    page_rect, render_rect, mode, pixel format, row alignment and page
+    rotation. Only images of completely decoded pages are cached.
 
-    - for each key (r, g, b): r in range(0, 6), g in range(0, 6) etc.;
-    - for each value v: v in range(0, 0x100).
+    At most max_bytes bytes of images are kept; the least recently used
+    ones are evicted first. Images of a document are dropped when the
+    document is deallocated.
     """
 
-    def __cinit__(self, palette, unsigned int bpp = 8):
-        cdef int i, j, k, n
-        for i in range(6):
-            for j in range(6):
-                for k in range(6):
-                    n = palette[(i, j, k)]
-                    if not 0 <= n < 0x100:
-                        raise ValueError('palette entries must be in range(0, 0x100)')
-                    self._palette[i*6*6 + j*6 + k] = n
-        if bpp != 8:
-            raise ValueError('bpp must be equal to 8')
-        self._bpp = self._dither_bpp = bpp
-        self.ddjvu_format = ddjvu_format_create(DDJVU_FORMAT_PALETTE8, 216, self._palette)
+    def __cinit__(self, max_bytes=(64 << 20)):
+        self._lock = thread.allocate_lock()
+        self._entries = OrderedDict()
+        self._documents = {}
+        self._cached_bytes = 0
+        self._max_bytes = 0
+        self._hits = self._misses = self._evictions = 0
+        _render_caches.add(self)
+        self.max_bytes = max_bytes
+
+    cdef object _get(self, object key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self._misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self._hits += 1
+            return data
+
+    cdef object _put(self, Document document, object key, object data):
+        if len(data) > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self._documents.setdefault(key[0], set()).add(key)
+            self._cached_bytes += len(data)
+            self._evict()
+        document._render_caches.add(self)
+
+    cdef object _forget(self, object key, object data):
+        # Assumption: self._lock is already acquired.
+        self._cached_bytes -= len(data)
+        keys = self._documents[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._documents[key[0]]
+
+    cdef object _evict(self):
+        # Assumption: self._lock is already acquired.
+        while self._cached_bytes > self._max_bytes:
+            key, data = self._entries.popitem(last=False)
+            self._forget(key, data)
+            self._evictions += 1
+
+    cdef object _invalidate(self, object document_key):
+        with self._lock:
+            for key in self._documents.pop(document_key, ()):
+                self._cached_bytes -= len(self._entries.pop(key))
+
+    property max_bytes:
+        """
+        The maximum total size of cached images, in bytes.
+        """
+        def __get__(self):
+            return self._max_bytes
+
+        def __set__(self, value):
+            if value < 0:
+                raise ValueError('max_bytes must be a non-negative integer')
+            with self._lock:
+                self._max_bytes = value
+                self._evict()
+
+    def invalidate(self, Document document not None):
+        """
+        C.invalidate(document) -> None
+
+        Drop all cached images of the document.
+        """
+        self._invalidate(document._serial)
+
+    def clear(self):
+        """
+        C.clear() -> None
+
+        Drop all cached images.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._documents.clear()
+            self._cached_bytes = 0
+
+    property cached_bytes:
+        """
+        Return the total size of cached images, in bytes.
+        """
+        def __get__(self):
+            return self._cached_bytes
+
+    property hits:
+        """
+        Return the number of renders satisfied from the cache.
+        """
+        def __get__(self):
+            return self._hits
+
+    property misses:
+        """
+        Return the number of renders that were not satisfied from the cache.
+        """
+        def __get__(self):
+            return self._misses
+
+    property evictions:
+        """
+        Return the number of images evicted from the cache.
+        """
+        def __get__(self):
+            return self._evictions
+
+    def __len__(self):
+        return len(self._entries)
 
     def __repr__(self):
-        cdef int i, j, k
-        io = StringIO()
-        io.write(get_type_name(PixelFormatPalette) + '({')
-        for i in range(6):
-            for j in range(6):
-                for k in range(6):
-                    io.write(f'({i}, {j}, {k}): 0x{self._palette[i * 6 * 6 + j * 6 + k]:02x}')
-                    if not (i == j == k == 5):
-                        io.write(', ')
-        io.write(f'}}, bpp = {self.bpp})')
-        return io.getvalue()
+        return f'{get_type_name(RenderCache)}(max_bytes = {self._max_bytes})'
+
+
+cdef Py_ssize_t page_job_bytes(PageJob job):
+    # An estimate of the memory used by the decoded page: one bit per pixel
+    # for the mask, three bytes per pixel for the background.
+    cdef Py_ssize_t width, height, result
+    width, height = job.size
+    type = job.type
+    result = 0
+    if type == PAGE_TYPE_BITONAL or type == PAGE_TYPE_COMPOUND:
+        result += (width + 7) // 8 * height
+    if type != PAGE_TYPE_BITONAL:
+        result += width * height * 3
+    return result
 
 
-cdef class PixelFormatPackedBits(PixelFormat):
+cdef class PageJobCache:
     """
-    PixelFormatPackedBits(endianness) -> a pixel format
+    PageJobCache(max_bytes=256 << 20) -> a page job cache
 
-    Bitonal, 1 bit per pixel format with:
+    An in-memory cache of completed PageJobs of a document.
 
-    - most significant bits on the left (endianness=='>') or
-    - least significant bits on the left (endianness=='<').
+    Attach the cache to a document (see Document.page_job_cache) to make
+    page.decode(...) return the cached job of the page where possible,
+    instead of decoding the page again. Jobs that completed successfully
+    are cached as soon as they are done. Cached jobs are shared by all
+    callers, including their rotation.
+
+    Jobs are kept while their estimated size in memory, computed from the
+    page size and type, does not exceed max_bytes bytes in total; the least
+    recently used ones are evicted first. Jobs of pinned pages are never
+    evicted.
     """
 
-    def __cinit__(self, endianness):
-        cdef ddjvu_format_style_t _format
-        if endianness == '<':
-            self._little_endian = 1
-            _format = DDJVU_FORMAT_LSBTOMSB
-        elif endianness == '>':
-            self._little_endian = 0
-            _format = DDJVU_FORMAT_MSBTOLSB
+    def __cinit__(self, max_bytes=(256 << 20)):
+        self._lock = thread.allocate_lock()
+        self._entries = OrderedDict()
+        self._pins = {}
+        self._in_flight = {}
+        self._document_weakref = None
+        self._cached_bytes = 0
+        self._max_bytes = 0
+        self._hits = self._misses = self._evictions = self._evicted_bytes = 0
+        self.max_bytes = max_bytes
+        _page_job_caches.add(self)
+
+    cdef PageJob _get(self, int n):
+        cdef PageJob job
+        with self._lock:
+            entry = self._entries.get(n)
+            if entry is not None:
+                job = entry[0]
+                if job._generation == fork_generation:
+                    self._entries.move_to_end(n)
+                    self._hits += 1
+                    return job
+                # The job belongs to the parent process.
+                del self._entries[n]
+                self._cached_bytes -= entry[1]
+            job = self._in_flight.get(n)
+            if job is not None:
+                if job._generation == fork_generation:
+                    self._hits += 1
+                    return job
+                del self._in_flight[n]
+            self._misses += 1
+            return None
+
+    cdef object _start(self, PageJob job):
+        # Serve the job to other callers until it is done.
+        with self._lock:
+            if not job.is_done:
+                self._in_flight[job._n] = job
+
+    cdef object _put(self, PageJob job):
+        # Called for every message of the job once it is done: cache the job
+        # only once, so that it is not added again after being evicted.
+        if not job.is_done:
+            return
+        cached = job._cached or job.is_error
+        if not cached:
+            nbytes = page_job_bytes(job)
+        with self._lock:
+            if self._in_flight.get(job._n) is job:
+                del self._in_flight[job._n]
+            if cached or job._cached:
+                return
+            job._cached = 1
+            if job._n in self._entries:
+                return
+            self._entries[job._n] = (job, nbytes)
+            self._cached_bytes += nbytes
+            self._evict()
+
+    cdef object _evict(self):
+        # Assumption: self._lock is already acquired.
+        if self._cached_bytes <= self._max_bytes:
+            return
+        for n in list(self._entries):
+            if self._cached_bytes <= self._max_bytes:
+                break
+            if n in self._pins:
+                continue
+            job, nbytes = self._entries.pop(n)
+            self._cached_bytes -= nbytes
+            self._evictions += 1
+            self._evicted_bytes += nbytes
+
+    property max_bytes:
+        """
+        The maximum total estimated size of cached jobs, in bytes.
+        """
+        def __get__(self):
+            return self._max_bytes
+
+        def __set__(self, value):
+            if value < 0:
+                raise ValueError('max_bytes must be a non-negative integer')
+            with self._lock:
+                self._max_bytes = value
+                self._evict()
+
+    def pin(self, n):
+        """
+        C.pin(n) -> None
+
+        Keep the job of the n-th page in the cache (once it is there) until
+        unpin(n) is called as many times as pin(n).
+        """
+        with self._lock:
+            self._pins[n] = self._pins.get(n, 0) + 1
+
+    def unpin(self, n):
+        """
+        C.unpin(n) -> None
+
+        Undo one pin(n) call.
+
+        Possible exceptions: ValueError.
+        """
+        with self._lock:
+            count = self._pins.get(n, 0)
+            if count == 0:
+                raise ValueError(f'page {n} is not pinned')
+            if count == 1:
+                del self._pins[n]
+            else:
+                self._pins[n] = count - 1
+            self._evict()
+
+    property pinned:
+        """
+        Return the set of pinned page numbers.
+        """
+        def __get__(self):
+            with self._lock:
+                return frozenset(self._pins)
+
+    def discard(self, n):
+        """
+        C.discard(n) -> None
+
+        Drop the cached job of the n-th page, if any, even if it is pinned.
+        """
+        with self._lock:
+            entry = self._entries.pop(n, None)
+            if entry is not None:
+                self._cached_bytes -= entry[1]
+
+    def clear(self):
+        """
+        C.clear() -> None
+
+        Drop all cached jobs, even pinned ones. Pins are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._cached_bytes = 0
+
+    property cached_bytes:
+        """
+        Return the total estimated size of cached jobs, in bytes.
+        """
+        def __get__(self):
+            return self._cached_bytes
+
+    property hits:
+        """
+        Return the number of decode calls satisfied from the cache.
+        """
+        def __get__(self):
+            return self._hits
+
+    property misses:
+        """
+        Return the number of decode calls that were not satisfied from the
+        cache.
+        """
+        def __get__(self):
+            return self._misses
+
+    property hit_rate:
+        """
+        Return the ratio of hits to decode calls, or None if there were none.
+        """
+        def __get__(self):
+            total = self._hits + self._misses
+            if total == 0:
+                return
+            return self._hits / total
+
+    property evictions:
+        """
+        Return the number of jobs evicted from the cache.
+        """
+        def __get__(self):
+            return self._evictions
+
+    property evicted_bytes:
+        """
+        Return the total estimated size of jobs evicted from the cache, in
+        bytes.
+        """
+        def __get__(self):
+            return self._evicted_bytes
+
+    def __contains__(self, n):
+        return n in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f'{get_type_name(PageJobCache)}(max_bytes = {self._max_bytes})'
+
+
+cdef object allocate_image_memory(long width, long height, object buffer, void **memory):
+    cdef char[::1] memview = None
+    cdef Py_ssize_t c_requested_size
+    cdef Py_ssize_t c_memory_size
+    py_requested_size = int(width) * int(height)
+    try:
+        c_requested_size = py_requested_size
+    except OverflowError:
+        raise MemoryError(f'Unable to allocate {py_requested_size} bytes for an image memory')
+    if buffer is None:
+        result = charp_to_bytes(NULL, c_requested_size)
+        memory[0] = <char*> result
+    else:
+        if typecheck(buffer, RenderBufferPool):
+            buffer = (<RenderBufferPool> buffer).acquire(c_requested_size)
+            result = memoryview(buffer)[:c_requested_size]
         else:
-            raise ValueError("endianness must be equal to '<' or '>'")
-        self._bpp = 1
-        self._dither_bpp = 1
-        self.ddjvu_format = ddjvu_format_create(_format, 0, NULL)
+            result = buffer
+        memview = memoryview(buffer).cast('c')
+        # Avoid:
+        #   warning: comparison of integer expressions of different signedness: ‘size_t’ {aka ‘long unsigned int’} and ‘Py_ssize_t’ {aka ‘long int’}
+        memview_size = len(memview)
+        try:
+            c_memview_size = memview_size
+        except OverflowError:
+            raise MemoryError(f'Unable to convert memory view size {memview_size}.')
+        if c_memview_size < c_requested_size:
+            raise ValueError(f'Image buffer is too small ({c_requested_size} > {c_memview_size})')
+        memory[0] = &memview[0]
+    return (result, memview)
 
-    property endianness:
+
+cdef class Image:
+    """
+    An image rendered by PageJob.render_image(...).
+
+    Images support the buffer protocol and the NumPy array interface, so they
+    can be converted to arrays without copying, e.g. with numpy.asarray().
+    Shape and item type depend on the pixel format:
+
+    PixelFormatRgb
+        (height, width, 3) array of bytes
+    PixelFormatRgba
+        (height, width, 4) array of bytes
+    PixelFormatRgbMask
+        (height, width) array of 16-bit or 32-bit unsigned integers, in the
+        native byte order
+    PixelFormatGrey, PixelFormatPalette
+        (height, width) array of bytes
+    PixelFormatPackedBits
+        (height, ceil(width / 8)) array of bytes
+
+    The first row of the array is always the top row of the image. If the
+    pixel format stores rows starting from the bottom of the image, the row
+    stride is negative.
+
+    Use PageJob.render_image(...) to obtain instances of this class.
+    """
+
+    def __cinit__(self, **kwargs):
+        check_sentinel(self, kwargs)
+        self._buffer = None
+        self._have_view = 0
+        self._memory = NULL
+
+    cdef object _init(self, PixelFormat pixel_format, long width, long height, long row_size, object buffer):
+        cdef Py_ssize_t c_size
+        cdef Py_ssize_t row_bytes
+        cdef int i
+        cdef int bpp = pixel_format._bpp
+        self._pixel_format = pixel_format
+        self._width = width
+        self._height = height
+        self._row_size = row_size
+        self._shape[0] = height
+        self._shape[1] = width
+        self._shape[2] = 1
+        self._itemsize = 1
+        self._format = b'B'
+        if typecheck(pixel_format, PixelFormatRgb):
+            self._ndim = 3
+            self._shape[2] = 3
+        elif typecheck(pixel_format, PixelFormatRgba):
+            self._ndim = 3
+            self._shape[2] = 4
+        elif typecheck(pixel_format, PixelFormatRgbMask):
+            self._ndim = 2
+            self._itemsize = bpp >> 3
+            self._format = b'H' if bpp == 16 else b'I'
+        elif typecheck(pixel_format, PixelFormatPackedBits):
+            self._ndim = 2
+            self._shape[1] = (width >> 3) + ((width & 7) != 0)
+        else:
+            self._ndim = 2
+        self._strides[self._ndim - 1] = self._itemsize
+        for i in range(self._ndim - 2, -1, -1):
+            self._strides[i] = self._strides[i + 1] * self._shape[i + 1]
+        row_bytes = self._strides[0]
+        self._contiguous = row_size == row_bytes and pixel_format._row_order
+        if pixel_format._row_order:
+            self._strides[0] = row_size
+            self._offset = 0
+        else:
+            self._strides[0] = -row_size
+            self._offset = (height - 1) * row_size
+        py_size = int(row_size) * int(height)
+        try:
+            c_size = py_size
+        except OverflowError:
+            raise MemoryError(f'Unable to allocate {py_size} bytes for an image memory')
+        if buffer is None:
+            self._buffer = make_bytearray(NULL, c_size)
+            self._memory = bytearray_to_charp(self._buffer)
+            return
+        if typecheck(buffer, RenderBufferPool):
+            buffer = (<RenderBufferPool> buffer).acquire(c_size)
+        get_buffer(buffer, &self._view, PyBUF_RECORDS)
+        self._have_view = 1
+        self._buffer = buffer
+        self._memory = <char*> self._view.buf
+        if self._view.ndim <= 1:
+            if self._view.ndim == 1 and self._view.strides[0] != self._view.itemsize:
+                raise ValueError('Image buffer must be contiguous')
+            if self._view.len < c_size:
+                raise ValueError(f'Image buffer is too small ({c_size} > {self._view.len})')
+            return
+        if self._view.shape[0] != height:
+            raise ValueError(f'Image buffer has {self._view.shape[0]} rows, expected {height}')
+        if self._view.strides[0] != row_size:
+            raise ValueError(f'Image buffer row stride ({self._view.strides[0]}) does not match the row size ({row_size})')
+        c_size = self._view.itemsize
+        for i in range(self._view.ndim - 1, 0, -1):
+            if self._view.strides[i] != c_size:
+                raise ValueError('Image buffer rows must be contiguous')
+            c_size *= self._view.shape[i]
+        if c_size < row_bytes:
+            raise ValueError(f'Image buffer rows are too short ({row_bytes} > {c_size})')
+
+    property width:
         """
-        The endianness:
-        - '<' (most significant bits on the left) or
-        - '>' (least significant bits on the left).
+        Return the image width, in pixels.
         """
         def __get__(self):
-            if self._little_endian:
-                return '<'
+            return self._width
+
+    property height:
+        """
+        Return the image height, in pixels.
+        """
+        def __get__(self):
+            return self._height
+
+    property row_size:
+        """
+        Return the distance between the starts of consecutive rows in the
+        image memory, in bytes.
+        """
+        def __get__(self):
+            return self._row_size
+
+    property pixel_format:
+        """
+        Return the pixel format of the image.
+        """
+        def __get__(self):
+            return self._pixel_format
+
+    property buffer:
+        """
+        Return the object holding the image memory: either the buffer passed
+        to PageJob.render_image(...) or a newly created bytearray.
+        """
+        def __get__(self):
+            return self._buffer
+
+    property shape:
+        """
+        Return the shape of the image array.
+        """
+        def __get__(self):
+            return tuple(self._shape[i] for i in range(self._ndim))
+
+    property strides:
+        """
+        Return the strides of the image array, in bytes.
+        """
+        def __get__(self):
+            return tuple(self._strides[i] for i in range(self._ndim))
+
+    property __array_interface__:
+        """
+        The NumPy array interface.
+        """
+        def __get__(self):
+            if self._itemsize == 1:
+                typestr = '|u1'
             else:
-                return '>'
+                typestr = f"{'<' if sys.byteorder == 'little' else '>'}u{self._itemsize}"
+            return dict(
+                version=3,
+                shape=self.shape,
+                typestr=typestr,
+                data=(voidp_to_int(self._memory + self._offset), False),
+                strides=None if self._contiguous else self.strides,
+            )
+
+    def __getbuffer__(self, Py_buffer *view, int flags):
+        cdef int i
+        if (flags & PyBUF_F_CONTIGUOUS) == PyBUF_F_CONTIGUOUS:
+            raise BufferError('image is not Fortran contiguous')
+        if not self._contiguous and (
+            (flags & PyBUF_STRIDES) != PyBUF_STRIDES or
+            (flags & PyBUF_C_CONTIGUOUS) == PyBUF_C_CONTIGUOUS or
+            (flags & PyBUF_ANY_CONTIGUOUS) == PyBUF_ANY_CONTIGUOUS
+        ):
+            raise BufferError('image is not contiguous')
+        view.buf = self._memory + self._offset
+        view.obj = self
+        view.len = self._itemsize
+        for i in range(self._ndim):
+            view.len *= self._shape[i]
+        view.readonly = 0
+        view.itemsize = self._itemsize
+        view.format = self._format if (flags & PyBUF_FORMAT) == PyBUF_FORMAT else NULL
+        if (flags & PyBUF_ND) == PyBUF_ND:
+            view.ndim = self._ndim
+            view.shape = self._shape
+        else:
+            view.ndim = 1
+            view.shape = NULL
+        view.strides = self._strides if (flags & PyBUF_STRIDES) == PyBUF_STRIDES else NULL
+        view.suboffsets = NULL
+        view.internal = NULL
+
+    def __dealloc__(self):
+        if self._have_view:
+            release_buffer(&self._view)
+
+    def __repr__(self):
+        return f'<{get_type_name(Image)}: {self._width}x{self._height}, {self._pixel_format!r}>'
+
+
+cdef object decode_page(Page page, object dpi):
+    # Decode the page; return the job and the page size scaled to dpi
+    # resolution.
+    cdef PageJob job
+    job = page.decode(wait=1)
+    if job.is_error:
+        raise job.status
+    width, height = job.size
+    if dpi is not None:
+        page_dpi = job.dpi
+        width = max(1, int(width * dpi / page_dpi + 0.5))
+        height = max(1, int(height * dpi / page_dpi + 0.5))
+    return job, width, height
+
+
+cdef object render_page(Page page, ddjvu_render_mode_t mode, object dpi, PixelFormat pixel_format, long row_alignment):
+    # Decode the page and render it in full, scaled to dpi resolution.
+    cdef PageJob job
+    job, width, height = decode_page(page, dpi)
+    rect = (0, 0, width, height)
+    row_size = calculate_row_size(width, row_alignment, pixel_format._bpp)
+    data = job.render(mode, rect, rect, pixel_format, row_alignment)
+    return (width, height, row_size), data
+
+
+cdef object image_file_formats
+image_file_formats = ('png', 'ppm', 'pgm', 'pbm')
+
+cdef long image_stripe_size = 1 << 20
 
-    def __repr__(self):
-        return f'{get_type_name(PixelFormatPackedBits)}({self.endianness!r})'
+cdef object invert_bits
+invert_bits = bytes(range(255, -1, -1))
 
 
-cdef object calculate_row_size(long width, long row_alignment, int bpp):
-    cdef long result
-    cdef object row_size
-    if bpp == 1:
-        row_size = (width >> 3) + ((width & 7) != 0)
-    elif bpp & 7 == 0:
-        row_size = width
-        row_size = row_size * (bpp >> 3)
-    else:
-        raise SystemError
-    result = ((row_size + (row_alignment - 1)) // row_alignment) * row_alignment
-    return result
+cdef object write_png_chunk(object file, bytes tag, object data):
+    file.write(struct_pack('>I', len(data)))
+    file.write(tag)
+    file.write(data)
+    file.write(struct_pack('>I', crc32(data, crc32(tag))))
 
 
-cdef object allocate_image_memory(long width, long height, object buffer, void **memory):
-    cdef char[::1] memview = None
-    cdef Py_ssize_t c_requested_size
-    cdef Py_ssize_t c_memory_size
-    py_requested_size = int(width) * int(height)
-    try:
-        c_requested_size = py_requested_size
-    except OverflowError:
-        raise MemoryError(f'Unable to allocate {py_requested_size} bytes for an image memory')
-    if buffer is None:
-        result = charp_to_bytes(NULL, c_requested_size)
-        memory[0] = <char*> result
+cdef object write_image(PageJob job, object file, object format, ddjvu_render_mode_t mode, long width, long height, int bitonal):
+    # Render the image stripe by stripe, streaming the rows into the encoder.
+    cdef PixelFormat pixel_format
+    cdef long row_size, stripe_h, i
+    cdef int png = format == 'png'
+    if format == 'pbm' or (png and bitonal):
+        pixel_format = PixelFormatPackedBits('>')
+        pnm_magic = b'P4'
+        png_header = (1, 0)
+    elif format == 'pgm':
+        pixel_format = PixelFormatGrey()
+        pnm_magic = b'P5'
     else:
-        result = buffer
-        memview = memoryview(buffer).cast('c')
-        # Avoid:
-        #   warning: comparison of integer expressions of different signedness: ‘size_t’ {aka ‘long unsigned int’} and ‘Py_ssize_t’ {aka ‘long int’}
-        memview_size = len(memview)
-        try:
-            c_memview_size = memview_size
-        except OverflowError:
-            raise MemoryError(f'Unable to convert memory view size {memview_size}.')
-        if c_memview_size < c_requested_size:
-            raise ValueError(f'Image buffer is too small ({c_requested_size} > {c_memview_size})')
-        memory[0] = &memview[0]
-    return (result, memview)
+        pixel_format = PixelFormatRgb()
+        pnm_magic = b'P6'
+        png_header = (8, 2)
+    pixel_format.rows_top_to_bottom = 1
+    pixel_format.y_top_to_bottom = 1
+    row_size = calculate_row_size(width, 1, pixel_format._bpp)
+    stripe_h = max(1, min(height, image_stripe_size // row_size))
+    rect = (0, 0, width, height)
+    stripes = job.render_tiles(mode, rect, (None, stripe_h), pixel_format, reuse_buffer=True)
+    if not png:
+        file.write(pnm_magic + f'\n{width} {height}\n'.encode('ASCII'))
+        if pixel_format._bpp != 1:
+            file.write(b'255\n')
+        for _, _, _, _, data in stripes:
+            file.write(data)
+        return
+    file.write(b'\x89PNG\r\n\x1A\n')
+    write_png_chunk(file, b'IHDR', struct_pack('>IIBBBBB', width, height, png_header[0], png_header[1], 0, 0, 0))
+    compressor = compressobj()
+    for _, _, _, h, data in stripes:
+        if pixel_format._bpp == 1:
+            # PNG uses 0 for black; PBM uses 1.
+            data = data.tobytes().translate(invert_bits)
+        rows = []
+        for i in range(h):
+            rows += [b'\0', data[i * row_size:(i + 1) * row_size]]
+        data = compressor.compress(b''.join(rows))
+        if data:
+            write_png_chunk(file, b'IDAT', data)
+    write_png_chunk(file, b'IDAT', compressor.flush())
+    write_png_chunk(file, b'IEND', b'')
+
+
+cdef object rect_to_c(object rect, ddjvu_rect_t *c_rect, object name):
+    cdef long x, y, w, h
+    x, y, w, h = rect
+    if w <= 0 or h <= 0:
+        raise ValueError(f'{name} width/height must be a positive integer')
+    c_rect.x, c_rect.y, c_rect.w, c_rect.h = x, y, w, h
+    if c_rect.x != x or c_rect.y != y or c_rect.w != w or c_rect.h != h:
+        raise OverflowError(f'{name} coordinates are too large')
+
+
+cdef object check_rect_inside(ddjvu_rect_t *c_page_rect, ddjvu_rect_t *c_render_rect):
+    if (
+        c_page_rect.x > c_render_rect.x or
+        c_page_rect.y > c_render_rect.y or
+        int(c_page_rect.x) + c_page_rect.w < int(c_render_rect.x) + c_render_rect.w or
+        int(c_page_rect.y) + c_page_rect.h < int(c_render_rect.y) + c_render_rect.h
+    ):
+        raise ValueError('render_rect must be inside page_rect')
+
+
+cdef long alpha_stripe_size = 1 << 16
+
+
+cdef void fill_alpha(char *memory, long w, long h, long row_size, int alpha_index) noexcept nogil:
+    # Make an image rendered with PixelFormatRgba opaque.
+    cdef long i, j
+    cdef unsigned char *pixel
+    for i in range(h):
+        pixel = <unsigned char*> memory + i * row_size
+        for j in range(w):
+            pixel[alpha_index] = 255
+            pixel += 4
+
+
+cdef object render_alpha(
+        PageJob job, ddjvu_render_mode_t mode, ddjvu_rect_t *c_page_rect, ddjvu_rect_t *c_render_rect,
+        PixelFormatRgba pixel_format, long row_size, char *memory
+):
+    # Render the mask of the page into the alpha channel of an image rendered
+    # with PixelFormatRgba in the mode, stripe by stripe.
+    cdef ddjvu_page_t* ddjvu_page
+    cdef ddjvu_format_t* mask_format
+    cdef ddjvu_format_t* color_format = pixel_format.ddjvu_format
+    cdef ddjvu_rect_t c_stripe_rect
+    cdef long w, h, y, stripe_h, first_row, i, j
+    cdef int k, rc, failed = 0
+    cdef int alpha_index = pixel_format._alpha_index
+    cdef int premultiplied = pixel_format._premultiplied
+    cdef int same_direction = pixel_format._row_order == pixel_format._y_direction
+    cdef unsigned int alpha
+    cdef unsigned char *pixel
+    cdef unsigned char *mask_row
+    cdef char *mask
+    ddjvu_page = <ddjvu_page_t*> job.ddjvu_job
+    w = c_render_rect.w
+    h = c_render_rect.h
+    stripe_h = max(1, min(h, alpha_stripe_size // w))
+    stripe = charp_to_bytes(NULL, w * stripe_h)
+    mask = stripe
+    mask_format = ddjvu_format_create(DDJVU_FORMAT_GREY8, 0, NULL)
+    if mask_format == NULL:
+        raise MemoryError('Unable to create pixel format')
+    ddjvu_format_set_row_order(mask_format, pixel_format._row_order)
+    ddjvu_format_set_y_direction(mask_format, pixel_format._y_direction)
+    ddjvu_format_set_gamma(mask_format, pixel_format._gamma)
+    c_stripe_rect.x = c_render_rect.x
+    c_stripe_rect.w = c_render_rect.w
+    rc = 1
+    with nogil:
+        y = c_render_rect.y
+        while y < c_render_rect.y + h:
+            c_stripe_rect.y = y
+            c_stripe_rect.h = stripe_h
+            if y + stripe_h > c_render_rect.y + h:
+                c_stripe_rect.h = c_render_rect.y + h - y
+            rc = ddjvu_page_render(ddjvu_page, DDJVU_RENDER_MASKONLY, c_page_rect, &c_stripe_rect, mask_format, w, mask)
+            if rc == 0:
+                break
+            if same_direction:
+                first_row = y - c_render_rect.y
+            else:
+                first_row = c_render_rect.y + h - y - c_stripe_rect.h
+            for i in range(c_stripe_rect.h):
+                pixel = <unsigned char*> memory + (first_row + i) * row_size
+                mask_row = <unsigned char*> mask + i * w
+                for j in range(w):
+                    alpha = 255 - mask_row[j]
+                    pixel[alpha_index] = alpha
+                    if premultiplied and alpha != 255:
+                        for k in range(4):
+                            if k != alpha_index:
+                                pixel[k] = (pixel[k] * alpha + 127) // 255
+                    pixel += 4
+            y += c_stripe_rect.h
+        if rc == 0:
+            # The page has no mask.
+            if premultiplied and y > c_render_rect.y:
+                # The mask became unavailable midway, and the stripes done so
+                # far have their colors premultiplied already: render the
+                # colors again.
+                failed = not ddjvu_page_render(ddjvu_page, mode, c_page_rect, c_render_rect, color_format, row_size, memory)
+            fill_alpha(memory, w, h, row_size, alpha_index)
+        ddjvu_format_release(mask_format)
+    if failed:
+        raise _NotAvailable_
+
+
+cdef object page_render(
+        PageJob job, ddjvu_render_mode_t mode, ddjvu_rect_t *c_page_rect, ddjvu_rect_t *c_render_rect, PixelFormat pixel_format,
+        long row_size, void *memory
+):
+    # The caller must keep the image memory alive.
+    cdef int rc
+    cdef ddjvu_page_t* ddjvu_page
+    cdef ddjvu_format_t* ddjvu_format
+    cdef Instrumentation instrumentation
+    cdef double start = 0
+    ddjvu_page = <ddjvu_page_t*> job.ddjvu_job
+    ddjvu_format = pixel_format.ddjvu_format
+    instrumentation = job._context._instrumentation
+    if instrumentation is not None:
+        start = monotonic()
+    with nogil:
+        rc = ddjvu_page_render(ddjvu_page, mode, c_page_rect, c_render_rect, ddjvu_format, row_size, <char*> memory)
+    if rc == 0:
+        raise _NotAvailable_
+    if typecheck(pixel_format, PixelFormatRgba):
+        render_alpha(job, mode, c_page_rect, c_render_rect, <PixelFormatRgba> pixel_format, row_size, <char*> memory)
+    if instrumentation is not None:
+        instrumentation._render_calls += 1
+        instrumentation._render_pixels += <long long> c_render_rect.w * c_render_rect.h
+        instrumentation._render_time += monotonic() - start
+
+
+cdef long pyramid_single_pass_area = 1 << 22
+
+
+cdef object cut_tiles(
+        object level, object data, long width, long height, long level_row_size, long tile_w, long tile_h, long row_alignment,
+        PixelFormat pixel_format
+):
+    # Cut an image rendered in a single pass into (level, x, y, w, h, data)
+    # tiles, as if they were rendered one by one.
+    cdef long x, y, w, h, i, first_row
+    cdef long row_size, row_bytes, offset
+    cdef int bpp = pixel_format._bpp
+    view = memoryview(data)
+    tiles = []
+    for y in range(0, height, tile_h):
+        h = min(tile_h, height - y)
+        if pixel_format._row_order == pixel_format._y_direction:
+            first_row = y
+        else:
+            first_row = height - y - h
+        for x in range(0, width, tile_w):
+            w = min(tile_w, width - x)
+            row_size = calculate_row_size(w, row_alignment, bpp)
+            row_bytes = calculate_row_size(w, 1, bpp)
+            padding = b'\0' * (row_size - row_bytes)
+            rows = []
+            for i in range(first_row, first_row + h):
+                offset = i * level_row_size + ((x * bpp) >> 3)
+                rows += [view[offset:offset + row_bytes], padding]
+            tiles += [(level, x, y, w, h, b''.join(rows))]
+    return tiles
 
 
 cdef class PageJob(Job):
@@ -2115,62 +5583,608 @@ cdef class PageJob(Job):
         at row_alignment bytes boundary.
 
         Data will be saved to the provided buffer or to a newly created string.
+        If buffer is a RenderBufferPool, data will be saved to a buffer taken
+        from the pool, and a memoryview of it will be returned. If no buffer
+        is provided, and the context has a render cache, a cached string may
+        be returned; otherwise, the buffer pool of the context (if any) is
+        used.
 
         This method makes a best effort to compute an image that reflects the
         most recently decoded data.
 
+        The global interpreter lock is released while the image is being
+        rendered, so pages can be rendered in parallel from multiple threads.
+
         Possible exceptions: NotAvailable (to indicate that no image could be
         computed at this point.)
         """
         cdef ddjvu_rect_t c_page_rect
         cdef ddjvu_rect_t c_render_rect
-        cdef Py_ssize_t buffer_size
         cdef long row_size
-        cdef int bpp
-        cdef long x, y, w, h
         cdef void *memory
         if row_alignment <= 0:
             raise ValueError('row_alignment must be a positive integer')
-        x, y, w, h = page_rect
-        if w <= 0 or h <= 0:
-            raise ValueError('page_rect width/height must be a positive integer')
-        c_page_rect.x, c_page_rect.y, c_page_rect.w, c_page_rect.h = x, y, w, h
-        if c_page_rect.x != x or c_page_rect.y != y or c_page_rect.w != w or c_page_rect.h != h:
-            raise OverflowError('page_rect coordinates are too large')
-        x, y, w, h = render_rect
-        if w <= 0 or h <= 0:
-            raise ValueError('render_rect width/height must be a positive integer')
-        c_render_rect.x, c_render_rect.y, c_render_rect.w, c_render_rect.h = x, y, w, h
-        if c_render_rect.x != x or c_render_rect.y != y or c_render_rect.w != w or c_render_rect.h != h:
-            raise OverflowError('render_rect coordinates are too large')
-        if (
-            c_page_rect.x > c_render_rect.x or
-            c_page_rect.y > c_render_rect.y or
-            int(c_page_rect.x) + c_page_rect.w < int(c_render_rect.x) + c_render_rect.w or
-            int(c_page_rect.y) + c_page_rect.h < int(c_render_rect.y) + c_render_rect.h
-        ):
-            raise ValueError('render_rect must be inside page_rect')
+        rect_to_c(page_rect, &c_page_rect, 'page_rect')
+        rect_to_c(render_rect, &c_render_rect, 'render_rect')
+        check_rect_inside(&c_page_rect, &c_render_rect)
         row_size = calculate_row_size(c_render_rect.w, row_alignment, pixel_format._bpp)
+        if buffer is None and self._context._render_cache is not None and self._document is not None:
+            return self._render_cached(mode, &c_page_rect, &c_render_rect, pixel_format, row_alignment, row_size)
+        if buffer is None:
+            buffer = self._context._buffer_pool
         (result, memview) = allocate_image_memory(row_size, c_render_rect.h, buffer, &memory)
-        if ddjvu_page_render(
-                <ddjvu_page_t*> self.ddjvu_job, mode, &c_page_rect, &c_render_rect, pixel_format.ddjvu_format, row_size, <char*> memory
-        ) == 0:
-            raise _NotAvailable_
+        # result and memview keep the image memory alive while the GIL is released.
+        page_render(self, mode, &c_page_rect, &c_render_rect, pixel_format, row_size, memory)
+        return result
+
+    cdef object _render_cached(
+            self, ddjvu_render_mode_t mode, ddjvu_rect_t *c_page_rect, ddjvu_rect_t *c_render_rect, PixelFormat pixel_format,
+            long row_alignment, long row_size
+    ):
+        cdef RenderCache cache = self._context._render_cache
+        cdef void *memory
+        key = (
+            self._document._serial, self._n,
+            (c_page_rect.x, c_page_rect.y, c_page_rect.w, c_page_rect.h),
+            (c_render_rect.x, c_render_rect.y, c_render_rect.w, c_render_rect.h),
+            mode, pixel_format_key(pixel_format), row_alignment, <int> ddjvu_page_get_rotation(<ddjvu_page_t*> self.ddjvu_job)
+        )
+        result = cache._get(key)
+        if result is not None:
+            return result
+        # Images of pages that are still being decoded are incomplete.
+        complete = ddjvu_job_done(self.ddjvu_job) and not ddjvu_job_error(self.ddjvu_job)
+        (result, memview) = allocate_image_memory(row_size, c_render_rect.h, None, &memory)
+        page_render(self, mode, c_page_rect, c_render_rect, pixel_format, row_size, memory)
+        if complete:
+            cache._put(self._document, key, result)
         return result
 
+    def iter_progressive_renders(
+            self, ddjvu_render_mode_t mode, page_rect, render_rect, PixelFormat pixel_format not None, long row_alignment=1,
+            min_interval=0.1
+    ):
+        """
+        J.iter_progressive_renders(mode, page_rect, render_rect, pixel_format, row_alignment=1, min_interval=0.1)
+          -> an iterator
+
+        Render a segment of a page again and again, as more of the page data
+        is decoded. The arguments have the same meaning as for render(...).
+
+        Yield the image data as soon as something can be rendered, then again
+        whenever a RedisplayMessage or a RelayoutMessage indicates that a
+        better image is available, but no more often than every min_interval
+        seconds. Finally, yield the image rendered after the job is done.
+
+        Possible exceptions: JobFailed (if decoding of the page failed).
+        """
+        if min_interval < 0:
+            raise ValueError('min_interval must be a non-negative number')
+        if row_alignment <= 0:
+            raise ValueError('row_alignment must be a positive integer')
+
+        def renders():
+            cdef long seen = -1
+            last_time = None
+            while True:
+                self._condition.acquire()
+                try:
+                    while True:
+                        done = ddjvu_job_done(self.ddjvu_job)
+                        if done:
+                            break
+                        if self._updates == seen:
+                            self._condition.wait()
+                        elif last_time is None:
+                            break
+                        else:
+                            timeout = last_time + min_interval - monotonic()
+                            if timeout <= 0:
+                                break
+                            self._condition.wait(timeout)
+                    seen = self._updates
+                finally:
+                    self._condition.release()
+                if done:
+                    if ddjvu_job_error(self.ddjvu_job):
+                        raise self.status
+                    yield self.render(mode, page_rect, render_rect, pixel_format, row_alignment)
+                    return
+                try:
+                    data = self.render(mode, page_rect, render_rect, pixel_format, row_alignment)
+                except NotAvailable:
+                    continue
+                last_time = monotonic()
+                yield data
+
+        return renders()
+
+    def render_image(
+            self, ddjvu_render_mode_t mode, page_rect, render_rect, PixelFormat pixel_format not None, long row_alignment=1, buffer=None
+    ):
+        """
+        J.render_image(mode, page_rect, render_rect, pixel_format, row_alignment=1, buffer=None) -> an Image
+
+        Render a segment of a page, like render(...), but return an Image
+        object that exposes the data with the shape and strides matching the
+        pixel format.
+
+        Data will be saved to the provided buffer or to a newly created
+        bytearray. As with render(...), buffer may be a RenderBufferPool;
+        Image.buffer is then the buffer taken from the pool. If the buffer is multi-dimensional (e.g. a NumPy array),
+        its first dimension must span the image rows, with the stride equal to
+        the row size implied by pixel_format and row_alignment, and each row
+        must be contiguous and large enough to hold the row pixels. The
+        buffer holds the rows in the order specified by pixel_format.
+
+        Possible exceptions: NotAvailable (to indicate that no image could be
+        computed at this point.), ValueError (if the buffer does not match
+        the image layout).
+        """
+        cdef ddjvu_rect_t c_page_rect
+        cdef ddjvu_rect_t c_render_rect
+        cdef long row_size
+        cdef Image image
+        if row_alignment <= 0:
+            raise ValueError('row_alignment must be a positive integer')
+        rect_to_c(page_rect, &c_page_rect, 'page_rect')
+        rect_to_c(render_rect, &c_render_rect, 'render_rect')
+        check_rect_inside(&c_page_rect, &c_render_rect)
+        row_size = calculate_row_size(c_render_rect.w, row_alignment, pixel_format._bpp)
+        if buffer is None:
+            buffer = self._context._buffer_pool
+        image = Image(sentinel = the_sentinel)
+        image._init(pixel_format, c_render_rect.w, c_render_rect.h, row_size, buffer)
+        # The image keeps its memory alive while the GIL is released.
+        page_render(self, mode, &c_page_rect, &c_render_rect, pixel_format, row_size, image._memory)
+        return image
+
+    def render_tiles(
+            self, ddjvu_render_mode_t mode, page_rect, tile_size, PixelFormat pixel_format not None, long row_alignment=1,
+            render_rect=None, reuse_buffer=False
+    ):
+        """
+        J.render_tiles(mode, page_rect, tile_size, pixel_format, row_alignment=1, render_rect=None, reuse_buffer=False)
+          -> an iterator
+
+        Render a segment of a page tile by tile. The arguments have the same
+        meaning as for render(...); render_rect defaults to page_rect.
+        Only a single tile is rendered at a time, so memory usage depends only
+        on the tile size, not on the size of render_rect.
+
+        tile_size is a (w, h) pair of the maximum tile dimensions. If w (or h)
+        is None, tiles span the whole width (or height) of render_rect.
+        For example, (None, 64) splits the image into horizontal stripes of
+        64 rows.
+
+        Yield (x, y, w, h, data) tuples, row of tiles by row of tiles, in
+        order of increasing coordinates. (x, y, w, h) is the rectangle
+        covered by the tile; data is the actual image data.
+
+        If reuse_buffer is true, a single buffer is reused for all the tiles,
+        and data is a memoryview of it that is valid only until the next tile
+        is requested. Otherwise, data is a newly created string, or a buffer
+        taken from the buffer pool of the context (if any).
+
+        Possible exceptions: NotAvailable (to indicate that no image could be
+        computed at this point.)
+        """
+        cdef ddjvu_rect_t c_page_rect
+        cdef ddjvu_rect_t c_render_rect
+        cdef long tile_w, tile_h
+        if row_alignment <= 0:
+            raise ValueError('row_alignment must be a positive integer')
+        rect_to_c(page_rect, &c_page_rect, 'page_rect')
+        if render_rect is None:
+            c_render_rect = c_page_rect
+        else:
+            rect_to_c(render_rect, &c_render_rect, 'render_rect')
+            check_rect_inside(&c_page_rect, &c_render_rect)
+        w, h = tile_size
+        tile_w = c_render_rect.w if w is None else w
+        tile_h = c_render_rect.h if h is None else h
+        if tile_w <= 0 or tile_h <= 0:
+            raise ValueError('tile_size width/height must be a positive integer')
+        tile_w = min(tile_w, c_render_rect.w)
+        tile_h = min(tile_h, c_render_rect.h)
+
+        def tiles():
+            cdef ddjvu_rect_t c_tile_rect
+            cdef char[::1] memview
+            cdef void *memory
+            cdef long row_size
+            cdef long x, y
+            if reuse_buffer:
+                row_size = calculate_row_size(tile_w, row_alignment, pixel_format._bpp)
+                shared_buffer = bytearray(row_size * tile_h)
+                memview = shared_buffer
+                memory = &memview[0]
+            for y in range(c_render_rect.y, c_render_rect.y + <long> c_render_rect.h, tile_h):
+                for x in range(c_render_rect.x, c_render_rect.x + <long> c_render_rect.w, tile_w):
+                    c_tile_rect.x = x
+                    c_tile_rect.y = y
+                    c_tile_rect.w = min(tile_w, c_render_rect.x + <long> c_render_rect.w - x)
+                    c_tile_rect.h = min(tile_h, c_render_rect.y + <long> c_render_rect.h - y)
+                    row_size = calculate_row_size(c_tile_rect.w, row_alignment, pixel_format._bpp)
+                    if reuse_buffer:
+                        page_render(self, mode, &c_page_rect, &c_tile_rect, pixel_format, row_size, memory)
+                        data = memoryview(shared_buffer)[:row_size * c_tile_rect.h]
+                    else:
+                        (data, _) = allocate_image_memory(row_size, c_tile_rect.h, self._context._buffer_pool, &memory)
+                        page_render(self, mode, &c_page_rect, &c_tile_rect, pixel_format, row_size, memory)
+                    yield (x, y, c_tile_rect.w, c_tile_rect.h, data)
+
+        return tiles()
+
+    def render_pyramid(
+            self, ddjvu_render_mode_t mode, tile_size, PixelFormat pixel_format not None, levels=None, long row_alignment=1,
+            workers=None, sink=None
+    ):
+        """
+        J.render_pyramid(mode, (tw, th), pixel_format, levels=None, row_alignment=1, workers=None, sink=None)
+          -> an iterator or None
+
+        Render the page as a pyramid of tiles at power-of-two zoom levels
+        (as used by Deep Zoom or IIIF image viewers), using a pool of worker
+        threads.
+
+        Level 0 is the page at its full size; each subsequent level is half as
+        large (rounded up) as the previous one. If levels is None, there are
+        just enough levels for the last one to fit in a single tile. Each level
+        is split into tiles of tw x th pixels; tiles at the end of each row or
+        column may be smaller. mode, pixel_format and row_alignment have the
+        same meaning as for render(...).
+
+        Small levels are rendered in a single pass and then cut into tiles;
+        larger levels are rendered tile by tile. Tiles of different levels
+        are rendered in parallel.
+
+        If sink is None, yield (level, x, y, w, h, data) tuples, level by
+        level, starting with the smallest level. (x, y, w, h) is the
+        rectangle covered by the tile, in the coordinates of the level;
+        data is the actual image data. Otherwise, call
+        sink(level, x, y, w, h, data) for every tile, from the worker
+        threads, and return None once all the tiles are written.
+
+        workers is the number of threads to use. By default, it is equal to
+        the number of processors.
+
+        Possible exceptions: NotAvailable.
+        """
+        cdef long tile_w, tile_h, width, height, level_w, level_h, x, y
+        cdef int n_levels, level
+        if row_alignment <= 0:
+            raise ValueError('row_alignment must be a positive integer')
+        tile_w, tile_h = tile_size
+        if tile_w <= 0 or tile_h <= 0:
+            raise ValueError('tile_size width/height must be a positive integer')
+        if workers is None:
+            workers = cpu_count() or 1
+        elif workers < 1:
+            raise ValueError('workers must be a positive integer')
+        width, height = self.size
+        if levels is None:
+            n_levels = 1
+            while ((width - 1) >> (n_levels - 1)) >= tile_w or ((height - 1) >> (n_levels - 1)) >= tile_h:
+                n_levels += 1
+        elif levels <= 0:
+            raise ValueError('levels must be a positive integer')
+        else:
+            n_levels = levels
+        items = []
+        remaining = {}
+        for level in range(n_levels - 1, -1, -1):
+            level_w = ((width - 1) >> level) + 1
+            level_h = ((height - 1) >> level) + 1
+            page_rect = (0, 0, level_w, level_h)
+            if level_w * level_h <= pyramid_single_pass_area and (pixel_format._bpp != 1 or tile_w % 8 == 0):
+                items += [(level, page_rect, None)]
+            else:
+                for y in range(0, level_h, tile_h):
+                    for x in range(0, level_w, tile_w):
+                        items += [(level, page_rect, (x, y, min(tile_w, level_w - x), min(tile_h, level_h - y)))]
+            remaining[level] = len(items) - sum(remaining.values())
+
+        def render(item):
+            level, page_rect, rect = item
+            if rect is None:
+                (_, _, level_w, level_h) = page_rect
+                row_size = calculate_row_size(level_w, row_alignment, pixel_format._bpp)
+                data = self.render(mode, page_rect, page_rect, pixel_format, row_alignment, bytearray(row_size * level_h))
+                tiles = cut_tiles(level, data, level_w, level_h, row_size, tile_w, tile_h, row_alignment, pixel_format)
+            else:
+                tiles = [(level,) + rect + (self.render(mode, page_rect, rect, pixel_format, row_alignment),)]
+            if sink is None:
+                return tiles
+            for tile in tiles:
+                sink(*tile)
+
+        if sink is not None:
+            for _ in parallel_map(render, items, workers):
+                pass
+            return
+
+        def pyramid_tiles():
+            # Yield tiles level by level, holding back tiles of levels
+            # that are completed ahead of time.
+            current = n_levels - 1
+            ahead = {}
+            for (level, _, _), level_tiles in parallel_map(render, items, workers):
+                remaining[level] -= 1
+                if level == current:
+                    yield from level_tiles
+                else:
+                    ahead.setdefault(level, []).extend(level_tiles)
+                while current >= 0 and remaining[current] == 0:
+                    current -= 1
+                    yield from ahead.pop(current, ())
+
+        return pyramid_tiles()
+
     def __dealloc__(self):
-        if self.ddjvu_job == NULL:
+        if self.ddjvu_job == NULL or self._generation != fork_generation:
             return
+        ddjvu_page_set_user_data(<ddjvu_page_t*> self.ddjvu_job, NULL)
         ddjvu_page_release(<ddjvu_page_t*> self.ddjvu_job)
         self.ddjvu_job = NULL
 
 
-cdef PageJob PageJob_from_c(ddjvu_page_t* ddjvu_page):
+cdef PageJob PageJob_from_c(Context context, ddjvu_page_t* ddjvu_page):
     cdef PageJob job
-    job = Job_from_c(<ddjvu_job_t*> ddjvu_page)
+    job = Job_from_c(context, <ddjvu_job_t*> ddjvu_page)
     return job
 
 
+cdef class DecodeScheduler:
+    """
+    DecodeScheduler(document, max_jobs=None, prefetch=0) -> a decode scheduler
+
+    Decode the pages of the document in order of priority, with at most
+    max_jobs (by default, the number of processors) PageJobs in flight.
+
+    Pages are requested with request(n, priority) or set_visible(pages); the
+    lower the priority, the sooner the page is decoded. Visible pages have
+    priority 0; set_visible() also requests the prefetch pages that follow
+    the last visible page, with priorities 1, 2, ...
+
+    Jobs in flight are never stopped to make way for more urgent pages;
+    those are started as soon as a job finishes. Only the in-flight jobs of
+    pages that are no longer requested are stopped. The jobs of requested
+    pages are kept until the pages are cancelled or left out of
+    set_visible(), and repeated requests are served from them.
+
+    Pages can be requested before the DocInfoMessage is received; they are
+    decoded as soon as it is, and requests for pages out of range are then
+    dropped.
+
+    Possible exceptions: ValueError.
+    """
+
+    def __cinit__(self, Document document not None, max_jobs=None, int prefetch=0):
+        if max_jobs is None:
+            max_jobs = cpu_count() or 1
+        elif max_jobs <= 0:
+            raise ValueError('max_jobs must be a positive integer')
+        if prefetch < 0:
+            raise ValueError('prefetch must be a non-negative integer')
+        self._document = document
+        self._max_jobs = max_jobs
+        self._prefetch = prefetch
+        self._condition = Condition()
+        self._heap = []
+        self._priorities = {}
+        self._running = {}
+        self._jobs = {}
+        self._seq = 0
+        _schedulers.add(self)
+
+    property document:
+        """
+        Return the Document whose pages are decoded.
+        """
+        def __get__(self):
+            return self._document
+
+    property max_jobs:
+        """
+        Return the maximum number of jobs in flight.
+        """
+        def __get__(self):
+            return self._max_jobs
+
+    property prefetch:
+        """
+        Return the number of pages requested after the visible ones.
+        """
+        def __get__(self):
+            return self._prefetch
+
+    property running:
+        """
+        Return the number of jobs in flight.
+        """
+        def __get__(self):
+            with self._condition:
+                return len(self._running)
+
+    property pending:
+        """
+        Return the number of requested pages whose jobs were not started yet.
+        """
+        def __get__(self):
+            with self._condition:
+                return len(self._priorities)
+
+    cdef object _push(self, int n, int priority):
+        # Assumption: self._condition is already acquired.
+        cdef PageJob job
+        running = self._running.get(n)
+        if running is not None:
+            if priority < running[0]:
+                self._running[n] = (priority, running[1])
+            return
+        if n in self._jobs:
+            return
+        if self._priorities.get(n, priority + 1) <= priority:
+            return
+        self._priorities[n] = priority
+        heappush(self._heap, (priority, self._seq, n))
+        self._seq += 1
+
+    cdef object _stop(self, int n):
+        # Assumption: self._condition is already acquired.
+        priority, job = self._running.pop(n)
+        self._jobs.pop(n, None)
+        job.stop()
+        return priority
+
+    cdef object _pump(self):
+        cdef PageJob job
+        with self._condition:
+            while self._heap:
+                priority, seq, n = self._heap[0]
+                if self._priorities.get(n) != priority:
+                    # Superseded by another request for the same page.
+                    heappop(self._heap)
+                    continue
+                if len(self._running) >= self._max_jobs:
+                    # Jobs in flight are not preempted: stopping them would
+                    # throw their progress away. Wait for one to finish.
+                    break
+                heappop(self._heap)
+                del self._priorities[n]
+                try:
+                    job = Page(self._document, n).decode(wait=False)
+                except JobFailed:
+                    # Document decoding failed: the page cannot be decoded.
+                    continue
+                except NotAvailable:
+                    # Register before checking, so that the DocInfoMessage
+                    # cannot slip through in between.
+                    if self._document._schedulers is None:
+                        self._document._schedulers = weakref.WeakSet()
+                    self._document._schedulers.add(self)
+                    if self._document.decoding_done:
+                        # The page is out of range.
+                        continue
+                    # The document is not decoded yet: try again when it is.
+                    self._priorities[n] = priority
+                    heappush(self._heap, (priority, seq, n))
+                    break
+                # Jobs from the page_job_cache are done, and may be shared
+                # with other schedulers: only the jobs in flight, which were
+                # just created, are owned by this scheduler.
+                if job._scheduler is None and not job.is_done:
+                    job._scheduler = self
+                self._jobs[n] = job
+                # The job might have been done before it got its scheduler.
+                if job._scheduler is self and not job.is_done:
+                    self._running[n] = (priority, job)
+            self._condition.notify_all()
+
+    cdef object _job_done(self, PageJob job):
+        with self._condition:
+            running = self._running.get(job._n)
+            if running is not None and running[1] is job:
+                del self._running[job._n]
+            if job.status is JobStopped and self._jobs.get(job._n) is job:
+                # Stopped by someone else: start afresh when requested.
+                del self._jobs[job._n]
+        self._pump()
+
+    def request(self, n, int priority=0):
+        """
+        S.request(n, priority=0) -> None
+
+        Request decoding of the n-th page with the priority. Requesting
+        a page again can only make it more urgent.
+        """
+        with self._condition:
+            self._push(n, priority)
+        self._pump()
+
+    def cancel(self, n):
+        """
+        S.cancel(n) -> None
+
+        Withdraw the request for the n-th page, and stop its job if it is in
+        flight.
+        """
+        with self._condition:
+            self._priorities.pop(n, None)
+            if n in self._running:
+                self._stop(n)
+            else:
+                self._jobs.pop(n, None)
+
+    def set_visible(self, pages):
+        """
+        S.set_visible(pages) -> None
+
+        Request the pages with priority 0, and the prefetch pages that follow
+        the last of them as read-ahead. Withdraw all the other requests: stop
+        the jobs in flight for pages not requested anymore, and forget their
+        finished jobs.
+        """
+        wanted = {}
+        for n in pages:
+            wanted[n] = 0
+        if wanted:
+            # Before the DocInfoMessage the number of pages is not known yet;
+            # out-of-range pages are dropped once the document is decoded.
+            n_pages = None
+            if self._document.decoding_done:
+                n_pages = len(self._document.pages)
+            last = max(wanted)
+            for i in range(1, self._prefetch + 1):
+                if n_pages is not None and last + i >= n_pages:
+                    break
+                wanted.setdefault(last + i, i)
+        with self._condition:
+            for n in list(self._jobs):
+                if n not in wanted:
+                    if n in self._running:
+                        self._stop(n)
+                    else:
+                        del self._jobs[n]
+            self._heap = []
+            self._priorities = {}
+            for n, priority in wanted.items():
+                self._push(n, priority)
+        self._pump()
+
+    def get(self, n, wait=1, timeout=None, deadline=None):
+        """
+        S.get(n, wait=True, timeout=None, deadline=None) -> a PageJob
+
+        Request the n-th page with priority 0, and return its job as soon as
+        it is started (or, if wait is true, done). See Page.get_info() for
+        timeout and deadline.
+
+        Possible exceptions: IndexError, JobFailed, DeadlineExceeded.
+        """
+        cdef PageJob job
+        end = get_deadline(timeout, deadline)
+        self._document.decoding_job.wait(deadline=end)
+        if n < 0 or n >= len(self._document.pages):
+            raise IndexError('page number out of range')
+        self.request(n)
+        while True:
+            with self._condition:
+                job = self._jobs.get(n)
+                if job is not None:
+                    break
+                withdrawn = n not in self._priorities
+                if not withdrawn and not wait_until(self._condition, end):
+                    raise DeadlineExceeded
+            if withdrawn:
+                # The request was withdrawn meanwhile: renew it.
+                self.request(n)
+        if wait:
+            job.wait(deadline=end)
+        return job
+
+
 cdef class Job:
     """
     A job.
@@ -2181,23 +6195,27 @@ cdef class Job:
         self._context = None
         self.ddjvu_job = NULL
         self._condition = Condition()
-        self._queue = Queue()
+        self._waiters = []
+        self._queue = MessageQueue()
+        self._timestamps = None
 
     cdef object _init(self, Context context, ddjvu_job_t *ddjvu_job):
-        # Assumption: loft_lock is already acquired.
+        # Assumption: context._register_lock is already acquired.
         assert (context is not None) and ddjvu_job != NULL
         self._context = context
         self.ddjvu_job = ddjvu_job
+        self._queue = MessageQueue(context._queue_policy)
+        self._generation = fork_generation
+        if context._instrumentation is not None:
+            self._timestamps = dict(created=monotonic())
+            context._instrumentation._jobs_created += 1
+        self._weakref = weakref.ref(self)
+        Py_INCREF(self._weakref)
+        ddjvu_job_set_user_data(ddjvu_job, <void*> self._weakref)
         _job_loft.add(self)
-        _job_weak_loft[voidp_to_int(ddjvu_job)] = self
 
     cdef object _clear(self):
-        with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
-        try:
-            _job_loft.discard(self)
-        finally:
-            release_lock(loft_lock)
+        _job_loft.discard(self)
 
     property status:
         """
@@ -2220,20 +6238,61 @@ cdef class Job:
         def __get__(self):
             return bool(ddjvu_job_done(self.ddjvu_job))
 
-    def wait(self):
+    property timestamps:
+        """
+        Return a dictionary mapping the lifecycle events of the job to their
+        time.monotonic() values:
+
+        * 'created' -- when the job was created, e.g. by Page.decode(...);
+        * 'done' -- when a message found the job done.
+
+        Timestamps are recorded only if the context had an Instrumentation
+        when the job was created; otherwise, the dictionary is empty.
         """
-        J.wait() -> None
+        def __get__(self):
+            if self._timestamps is None:
+                return {}
+            return dict(self._timestamps)
+
+    def wait(self, timeout=None, deadline=None):
+        """
+        J.wait(timeout=None, deadline=None) -> None
 
         Wait until the job is done.
+
+        If the timeout (in seconds) or the deadline (a time.monotonic()
+        value), or the deadline of the enclosing deadline(...) block, passes
+        first, stop the job and raise DeadlineExceeded.
+
+        Possible exceptions: DeadlineExceeded, RuntimeError (if the job was
+        created before fork() in the parent process).
         """
+        check_generation(self._generation)
+        end = get_deadline(timeout, deadline)
         while True:
             self._condition.acquire()
             try:
                 if ddjvu_job_done(self.ddjvu_job):
+                    return
+                if not wait_until(self._condition, end):
                     break
-                self._condition.wait()
             finally:
                 self._condition.release()
+        self.stop()
+        raise DeadlineExceeded
+
+    async def wait_async(self):
+        """
+        J.wait_async() -> None
+
+        Coroutine version of wait(): wait until the job is done, without
+        blocking the event loop. The deadline of the enclosing deadline(...)
+        block applies.
+
+        Possible exceptions: DeadlineExceeded, RuntimeError.
+        """
+        check_generation(self._generation)
+        await wait_async(self._condition, self._waiters, lambda: self.is_done, self.stop)
 
     def stop(self):
         """
@@ -2259,36 +6318,69 @@ cdef class Job:
 
         Get message from the internal job queue.
         Return None if wait is false and no message is available.
+
+        Possible exceptions: RuntimeError (if the job was created before
+        fork() in the parent process).
         """
+        check_generation(self._generation)
         try:
             return self._queue.get(wait)
         except Empty:
             return
 
+    async def get_message_async(self):
+        """
+        J.get_message_async() -> a Message
+
+        Coroutine version of get_message(): get message from the internal job
+        queue, without blocking the event loop. The deadline of the enclosing
+        deadline(...) block applies, but the job is not stopped when it
+        passes.
+
+        Possible exceptions: DeadlineExceeded, RuntimeError.
+        """
+        check_generation(self._generation)
+        return await get_message_async(self._condition, self._waiters, self._queue)
+
     def __iter__(self):
         return self
 
     def __next__(self):
         return self.get_message()
 
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get_message_async()
+
     def __dealloc__(self):
-        if self.ddjvu_job == NULL:
+        cdef void *user_data
+        if self.ddjvu_job == NULL or self._generation != fork_generation:
             return
+        user_data = ddjvu_job_get_user_data(self.ddjvu_job)
+        ddjvu_job_set_user_data(self.ddjvu_job, NULL)
+        if user_data != NULL:
+            Py_DECREF(<object> user_data)
         ddjvu_job_release(self.ddjvu_job)
         self.ddjvu_job = NULL
 
 
-cdef Job Job_from_c(ddjvu_job_t* ddjvu_job):
-    cdef Job result
+cdef Job Job_from_c(Context context, ddjvu_job_t* ddjvu_job):
+    cdef void *user_data
     if ddjvu_job == NULL:
-        result = None
+        return
+    user_data = ddjvu_job_get_user_data(ddjvu_job)
+    if user_data != NULL:
+        result = from_user_data(user_data)
     else:
-        with nogil:
-            acquire_lock(loft_lock, WAIT_LOCK)
-        try:
-            result = _job_weak_loft.get(voidp_to_int(ddjvu_job))
-        finally:
-            release_lock(loft_lock)
+        # The job might be still being created. Resolve the borrowed weak
+        # reference while the lock is held (see Document_from_c()).
+        with context._registering():
+            result = from_user_data(ddjvu_job_get_user_data(ddjvu_job))
+    if not typecheck(result, Job):
+        # Documents are jobs, too, as far as libdjvu is concerned.
+        return
     return result
 
 
@@ -2420,10 +6512,10 @@ cdef class Message:
     cdef object _init(self):
         if self.ddjvu_message == NULL:
             raise SystemError
-        self._context = Context_from_c(self.ddjvu_message.m_any.context)
-        self._document = Document_from_c(self.ddjvu_message.m_any.document)
-        self._page_job = PageJob_from_c(self.ddjvu_message.m_any.page)
-        self._job = Job_from_c(self.ddjvu_message.m_any.job)
+        # Assumption: self._context is already set.
+        self._document = Document_from_c(self._context, self.ddjvu_message.m_any.document)
+        self._page_job = PageJob_from_c(self._context, self.ddjvu_message.m_any.page)
+        self._job = Job_from_c(self._context, self.ddjvu_message.m_any.job)
 
     property context:
         """
@@ -2585,15 +6677,21 @@ cdef class Stream:
         """
         cdef char* raw_data
         cdef Py_ssize_t length
+        cdef Instrumentation instrumentation
         if self._open:
             bytes_to_charp(data, &raw_data, &length)
             ddjvu_stream_write(self._document.ddjvu_document, self._streamid, raw_data, length)
+            instrumentation = self._document._context._instrumentation
+            if instrumentation is not None:
+                instrumentation._stream_bytes += length
         else:
             raise IOError('I/O operation on closed file')
 
     def __dealloc__(self):
         if <object>self._document is None:
             return
+        if self._document._generation != fork_generation:
+            return
         if self._open:
             ddjvu_stream_close(self._document.ddjvu_document, self._streamid, 1)
 
@@ -2758,7 +6856,7 @@ MESSAGE_MAP = {
 }
 
 
-cdef Message Message_from_c(ddjvu_message_t* ddjvu_message):
+cdef Message Message_from_c(Context context, ddjvu_message_t* ddjvu_message):
     cdef Message message
     if ddjvu_message == NULL:
         return
@@ -2768,6 +6866,7 @@ cdef Message Message_from_c(ddjvu_message_t* ddjvu_message):
         raise SystemError
     message = klass(sentinel = the_sentinel)
     message.ddjvu_message = ddjvu_message
+    message._context = context
     message._init()
     return message
 
@@ -2842,6 +6941,39 @@ class JobStopped(JobFailed):
     """
 
 
+class DeadlineExceeded(JobStopped):
+    """
+    Operation was interrupted because its deadline passed.
+    """
+
+
+@contextmanager
+def deadline(timeout):
+    """
+    deadline(timeout) -> a context manager
+
+    Within the with block, waiting methods raise DeadlineExceeded when
+    timeout seconds have passed since entering the block. Job.wait() also
+    stops the job it waits for. Waiting for page information, for an
+    S-expression or for a message (e.g. with Job.get_message_async()) stops
+    nothing: the document, which may be shared, goes on decoding. Nested
+    blocks cannot extend the deadline of the enclosing ones.
+
+    The deadline is stored in a context variable: it applies to coroutines,
+    but not to other threads. The with statement target is the deadline,
+    as a time.monotonic() value.
+    """
+    end = monotonic() + timeout
+    outer = current_deadline.get()
+    if outer is not None and outer < end:
+        end = outer
+    token = current_deadline.set(end)
+    try:
+        yield end
+    finally:
+        current_deadline.reset(token)
+
+
 JOB_EXCEPTION_MAP = {
     DDJVU_JOB_NOTSTARTED: JobNotStarted,
     DDJVU_JOB_STARTED: JobStarted,
@@ -2851,6 +6983,14 @@ JOB_EXCEPTION_MAP = {
 }
 
 
+cdef object sexpr_available(object owner):
+    try:
+        owner.sexpr
+    except NotAvailable:
+        return False
+    return True
+
+
 cdef class _SexprWrapper:
 
     def __cinit__(self, document, **kwargs):
@@ -2865,7 +7005,7 @@ cdef class _SexprWrapper:
         if self._cexpr == NULL:
             return
         document = self._document_weakref()
-        if document is None:
+        if document is None or document._generation != fork_generation:
             return
         ddjvu_miniexp_release(document.ddjvu_document, self._cexpr)
 
@@ -2894,12 +7034,19 @@ cdef class DocumentOutline(DocumentExtension):
             ddjvu_document_get_outline(self._document.ddjvu_document)
         )
 
-    def wait(self):
+    def wait(self, timeout=None, deadline=None):
         """
-        O.wait() -> None
+        O.wait(timeout=None, deadline=None) -> None
 
         Wait until the associated S-expression is available.
+
+        If the timeout (in seconds) or the deadline (a time.monotonic()
+        value), or the deadline of the enclosing deadline(...) block, passes
+        first, raise DeadlineExceeded.
+
+        Possible exceptions: DeadlineExceeded.
         """
+        end = get_deadline(timeout, deadline)
         while True:
             self._document._condition.acquire()
             try:
@@ -2907,9 +7054,32 @@ cdef class DocumentOutline(DocumentExtension):
                     self.sexpr
                     return
                 except NotAvailable:
-                    self._document._condition.wait()
+                    if not wait_until(self._document._condition, end):
+                        break
             finally:
                 self._document._condition.release()
+        raise DeadlineExceeded
+
+    async def wait_async(self):
+        """
+        O.wait_async() -> None
+
+        Coroutine version of wait(): wait until the associated S-expression
+        is available, without blocking the event loop.
+        """
+        await wait_async(self._document._condition, self._document._waiters, lambda: sexpr_available(self), None)
+
+    async def sexpr_async(self):
+        """
+        O.sexpr_async() -> an S-expression
+
+        Wait until the associated S-expression is available, without blocking
+        the event loop, then return it.
+
+        Possible exceptions: JobFailed.
+        """
+        await self.wait_async()
+        return self.sexpr
 
     property sexpr:
         """
@@ -2919,6 +7089,9 @@ cdef class DocumentOutline(DocumentExtension):
         If the S-expression is not available, raise NotAvailable exception.
         Then, PageInfoMessage messages with empty page_job may be emitted.
 
+        If the document was opened with a DocumentIndex, the outline recorded
+        in the index is returned instead of raising NotAvailable.
+
         Possible exceptions: NotAvailable, JobFailed.
         """
         def __get__(self):
@@ -2931,6 +7104,9 @@ cdef class DocumentOutline(DocumentExtension):
                 return sexpr
             except InvalidExpression:
                 self._sexpr = None
+                entry = self._document._index_entry
+                if entry is not None and entry._outline is not None:
+                    return entry._outline
                 raise _NotAvailable_
 
     def __repr__(self):
@@ -2954,12 +7130,22 @@ cdef class Annotations:
     cdef object _update_sexpr(self):
         raise NotImplementedError
 
-    def wait(self):
+    cdef object _indexed_sexpr(self):
+        return
+
+    def wait(self, timeout=None, deadline=None):
         """
-        A.wait() -> None
+        A.wait(timeout=None, deadline=None) -> None
 
         Wait until the associated S-expression is available.
+
+        If the timeout (in seconds) or the deadline (a time.monotonic()
+        value), or the deadline of the enclosing deadline(...) block, passes
+        first, raise DeadlineExceeded.
+
+        Possible exceptions: DeadlineExceeded.
         """
+        end = get_deadline(timeout, deadline)
         while True:
             self._document._condition.acquire()
             try:
@@ -2967,9 +7153,32 @@ cdef class Annotations:
                     self.sexpr
                     return
                 except NotAvailable:
-                    self._document._condition.wait()
+                    if not wait_until(self._document._condition, end):
+                        break
             finally:
                 self._document._condition.release()
+        raise DeadlineExceeded
+
+    async def wait_async(self):
+        """
+        A.wait_async() -> None
+
+        Coroutine version of wait(): wait until the associated S-expression
+        is available, without blocking the event loop.
+        """
+        await wait_async(self._document._condition, self._document._waiters, lambda: sexpr_available(self), None)
+
+    async def sexpr_async(self):
+        """
+        A.sexpr_async() -> an S-expression
+
+        Wait until the associated S-expression is available, without blocking
+        the event loop, then return it.
+
+        Possible exceptions: JobFailed.
+        """
+        await self.wait_async()
+        return self.sexpr
 
     property sexpr:
         """
@@ -2979,6 +7188,10 @@ cdef class Annotations:
         If the S-expression is not available, raise NotAvailable exception.
         Then, PageInfoMessage messages with empty page_job may be emitted.
 
+        If the document was opened with a DocumentIndex, the document-wide
+        annotations recorded in the index are returned instead of raising
+        NotAvailable.
+
         Possible exceptions: NotAvailable, JobFailed.
         """
         def __get__(self):
@@ -2991,6 +7204,9 @@ cdef class Annotations:
                 return sexpr
             except InvalidExpression:
                 self._sexpr = None
+                sexpr = self._indexed_sexpr()
+                if sexpr is not None:
+                    return sexpr
                 raise _NotAvailable_
 
     property background_color:
@@ -3102,6 +7318,13 @@ cdef class DocumentAnnotations(Annotations):
             ddjvu_document_get_anno(self._document.ddjvu_document, self._compat)
         )
 
+    cdef object _indexed_sexpr(self):
+        cdef DocumentIndexEntry entry
+        entry = self._document._index_entry
+        if entry is None or not self._compat:
+            return
+        return entry._annotations
+
     property document:
         """
         Return the concerned Document.
@@ -3233,12 +7456,19 @@ cdef class PageText:
                 ddjvu_document_get_pagetext(self._page._document.ddjvu_document, self._page._n, self._details)
             )
 
-    def wait(self):
+    def wait(self, timeout=None, deadline=None):
         """
-        PT.wait() -> None
+        PT.wait(timeout=None, deadline=None) -> None
 
         Wait until the associated S-expression is available.
+
+        If the timeout (in seconds) or the deadline (a time.monotonic()
+        value), or the deadline of the enclosing deadline(...) block, passes
+        first, raise DeadlineExceeded.
+
+        Possible exceptions: DeadlineExceeded.
         """
+        end = get_deadline(timeout, deadline)
         while True:
             self._page._document._condition.acquire()
             try:
@@ -3246,9 +7476,32 @@ cdef class PageText:
                     self.sexpr
                     return
                 except NotAvailable:
-                    self._page._document._condition.wait()
+                    if not wait_until(self._page._document._condition, end):
+                        break
             finally:
                 self._page._document._condition.release()
+        raise DeadlineExceeded
+
+    async def wait_async(self):
+        """
+        PT.wait_async() -> None
+
+        Coroutine version of wait(): wait until the associated S-expression
+        is available, without blocking the event loop.
+        """
+        await wait_async(self._page._document._condition, self._page._document._waiters, lambda: sexpr_available(self), None)
+
+    async def sexpr_async(self):
+        """
+        PT.sexpr_async() -> an S-expression
+
+        Wait until the associated S-expression is available, without blocking
+        the event loop, then return it.
+
+        Possible exceptions: JobFailed.
+        """
+        await self.wait_async()
+        return self.sexpr
 
     property page:
         """
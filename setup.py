@@ -241,7 +241,7 @@ setup_params = dict(
         for cmd in (BuildExtension, Sdist, bdist_wheel)
         if cmd is not None
     ),
-    py_modules=['djvu.const'],
+    py_modules=['djvu.batch', 'djvu.const'],
     extras_require={
         'dev': [
             'flake8',
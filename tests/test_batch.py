@@ -0,0 +1,157 @@
+# Copyright © 2024 FriedrichFroebel
+#
+# This file is part of python-djvulibre.
+#
+# python-djvulibre is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+#
+# python-djvulibre is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+import multiprocessing
+import os
+import tempfile
+
+from djvu.batch import (
+    SharedImage,
+    Task,
+    WorkerPool,
+    export_ps,
+    extract_text,
+    page_info,
+    render_pages,
+    save,
+)
+from djvu.decode import (
+    Context,
+    FileUri,
+    JobFailed,
+    PixelFormatGrey,
+    RENDER_COLOR,
+)
+from djvu.sexpr import (
+    Expression,
+)
+
+from tools import (
+    IMAGES,
+    TestCase,
+    wildcard_import,
+)
+
+
+class WorkerPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(2, mp_context=multiprocessing.get_context('spawn'))
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_bad_args(self):
+        with self.assertRaisesString(ValueError, 'workers must be a positive integer'):
+            WorkerPool(0)
+        with self.assertRaisesString(ValueError, 'chunk_size must be a positive integer'):
+            WorkerPool(1, chunk_size=0)
+        with self.assertRaisesString(ValueError, 'max_in_flight must be a positive integer'):
+            WorkerPool(1, max_in_flight=0)
+        with self.assertRaisesString(ValueError, 'max_documents must be a positive integer'):
+            WorkerPool(1, max_documents=0)
+        with self.assertRaisesString(ValueError, "Unknown pixel format: 'CMYK'"):
+            render_pages(IMAGES + 'test1.djvu', pixel_format='CMYK')
+
+    def test_task(self):
+        task = render_pages(IMAGES + 'test0.djvu', pages=[1], dpi=75)
+        self.assertEqual(task, render_pages(IMAGES + 'test0.djvu', pages=(1,), dpi=75))
+        self.assertEqual(len({task, render_pages(IMAGES + 'test0.djvu', pages=[1], dpi=75), page_info(IMAGES + 'test0.djvu')}), 2)
+        self.assertEqual(dict(task.options)['pages'], (1,))
+
+    def test_page_info(self):
+        tasks = [page_info(IMAGES + 'test0.djvu'), page_info(IMAGES + 'test1.djvu')]
+        results = dict(self.pool.imap(tasks))
+        self.assertEqual(set(results), set(tasks))
+        self.assertEqual(results[tasks[1]], [(0, (64, 48), 300, 0)])
+        self.assertEqual([n for n, size, dpi, rotation in results[tasks[0]]], [0, 1])
+
+    def test_render_pages(self):
+        task = render_pages(IMAGES + 'test0.djvu', pages=[1], dpi=75, pixel_format='L', row_alignment=4)
+        self.assertIsInstance(task, Task)
+        [(result_task, result)] = self.pool.imap([task])
+        self.assertEqual(result_task, task)
+        [(n, (w, h, row_size), image)] = result
+        self.assertEqual(n, 1)
+        self.assertIsInstance(image, SharedImage)
+        self.assertEqual(row_size % 4, 0)
+        self.assertEqual(len(image.data), row_size * h)
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        document.decoding_job.wait()
+        page_job = document.pages[1].decode()
+        self.assertEqual(w, int(page_job.width * 75 / page_job.dpi + 0.5))
+        self.assertEqual(h, int(page_job.height * 75 / page_job.dpi + 0.5))
+        pixel_format = PixelFormatGrey()
+        pixel_format.rows_top_to_bottom = 1
+        rect = (0, 0, w, h)
+        with image:
+            self.assertEqual(bytes(image), page_job.render(RENDER_COLOR, rect, rect, pixel_format, 4))
+        image.close()
+
+    def test_extract_text(self):
+        [(task, result)] = self.pool.imap([extract_text(IMAGES + 'test0.djvu')])
+        self.assertEqual([n for n, sexpr in result], [0, 1])
+        for n, sexpr in result:
+            self.assertIsInstance(sexpr, Expression)
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            djvu_path = os.path.join(tmpdir, 'test.djvu')
+            ps_path = os.path.join(tmpdir, 'test.ps')
+            tasks = [
+                save(IMAGES + 'test0.djvu', djvu_path, pages=[0]),
+                export_ps(IMAGES + 'test0.djvu', ps_path, pages=[1], eps=True),
+            ]
+            results = dict(self.pool.imap(tasks))
+            self.assertEqual(results, {tasks[0]: djvu_path, tasks[1]: ps_path})
+            with open(djvu_path, 'rb') as file:
+                self.assertEqual(file.read(8), b'AT&TFORM')
+            with open(ps_path, 'rb') as file:
+                self.assertEqual(file.read(4), b'%!PS')
+
+    def test_errors(self):
+        path = IMAGES + 'nonexistent.djvu'
+        tasks = [page_info(path), page_info(IMAGES + 'test1.djvu')]
+        results = dict(self.pool.imap(tasks, return_exceptions=True))
+        self.assertIsInstance(results[tasks[0]], JobFailed)
+        self.assertEqual(results[tasks[1]], [(0, (64, 48), 300, 0)])
+        with self.assertRaises(JobFailed):
+            list(self.pool.imap(tasks))
+
+    def test_chunks(self):
+        pool = WorkerPool(2, chunk_size=3, max_in_flight=1, max_documents=2, mp_context=multiprocessing.get_context('spawn'))
+        with pool:
+            tasks = [page_info(IMAGES + 'test1.djvu') for i in range(10)]
+            results = list(pool.imap(iter(tasks)))
+        self.assertEqual(len(results), 10)
+        for task, result in results:
+            self.assertEqual(result, [(0, (64, 48), 300, 0)])
+
+
+class WildcardImportTestCase(TestCase):
+    def test_wildcard_import(self):
+        namespace = wildcard_import('djvu.batch')
+        self.assertListEqual(
+            sorted(namespace.keys()), [
+                'PIXEL_FORMATS',
+                'SharedImage',
+                'Task',
+                'WorkerPool',
+                'export_ps',
+                'extract_text',
+                'page_info',
+                'render_pages',
+                'save',
+            ]
+        )
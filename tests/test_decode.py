@@ -13,39 +13,61 @@
 # more details.
 
 import array
+import asyncio
 import errno
+import gc
+import io
 import os
 import re
+import signal
+import struct
 import subprocess
 import sys
 import tempfile
+import time
+import warnings
+import zlib
 
 from djvu.decode import (
     AffineTransform,
     Context,
+    ContextPool,
     DDJVU_VERSION,
     DOCUMENT_TYPE_BUNDLED,
     DOCUMENT_TYPE_SINGLE_PAGE,
+    DeadlineExceeded,
+    DecodeScheduler,
     DocInfoMessage,
     Document,
     DocumentAnnotations,
     DocumentDecodingJob,
+    DocumentIndex,
+    DocumentIndexEntry,
     DocumentOutline,
     ErrorMessage,
     File,
+    FileTable,
     FileUri,
+    Histogram,
     Hyperlinks,
+    Image,
+    Instrumentation,
     Job,
     JobFailed,
     JobOK,
+    JobStarted,
+    JobStopped,
     Message,
+    MessageQueue,
     Metadata,
     NewStreamMessage,
     NotAvailable,
     PAGE_TYPE_BITONAL,
     Page,
     PageAnnotations,
+    PageInfoTable,
     PageJob,
+    PageJobCache,
     PageText,
     PixelFormat,
     PixelFormatGrey,
@@ -53,9 +75,17 @@ from djvu.decode import (
     PixelFormatPalette,
     PixelFormatRgb,
     PixelFormatRgbMask,
+    PixelFormatRgba,
+    QueuePolicy,
     RENDER_COLOR,
+    RedisplayMessage,
+    RENDER_FOREGROUND,
+    RENDER_MASK_ONLY,
+    RenderBufferPool,
+    RenderCache,
     SaveJob,
     Stream,
+    Subscription,
     TEXT_DETAILS_ALL,
     TEXT_DETAILS_CHARACTER,
     TEXT_DETAILS_COLUMN,
@@ -66,6 +96,7 @@ from djvu.decode import (
     TEXT_DETAILS_WORD,
     ThumbnailMessage,
     __version__,
+    deadline,
 )
 from djvu.sexpr import (
     Expression,
@@ -142,6 +173,37 @@ class ContextTestCase(TestCase):
             n = (n + 1) * 2 - 1
 
 
+class ContextPoolTestCase(TestCase):
+
+    def test_bad_new(self):
+        with self.assertRaisesString(ValueError, 'n must be a positive integer'):
+            ContextPool(0)
+
+    def test_pool(self):
+        pool = ContextPool(2, cache_size=1 << 20)
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(len(pool.contexts), 2)
+        for context in pool.contexts:
+            self.assertIsInstance(context, Context)
+            self.assertEqual(context.cache_size, 1 << 20)
+        self.assertEqual(pool.cache_size, 1 << 20)
+        self.assertEqual(pool.loads, [0, 0])
+        uri0 = FileUri(IMAGES + 'test0.djvu')
+        uri1 = FileUri(IMAGES + 'test1.djvu')
+        documents = [pool.new_document(uri1), pool.new_document(uri1), pool.new_document(uri0)]
+        self.assertEqual(sorted(pool.loads), [1, 2])
+        for document in documents:
+            document.decoding_job.wait()
+            self.assertIs(document.decoding_status, JobOK)
+        del document, documents
+        gc.collect()
+        self.assertEqual(pool.loads, [0, 0])
+        document = pool.new_document(uri0)
+        self.assertEqual(sorted(pool.loads), [0, 1])
+        document.decoding_job.wait()
+        pool.clear_cache()
+
+
 class DocumentsTestCase(DecodeTestCase):
 
     def test_bad_new(self):
@@ -204,6 +266,83 @@ class DocumentsTestCase(DecodeTestCase):
             )
             self.assertEqual(str(message), message.message)
 
+    def test_page_info_table(self):
+        with self.assertRaisesString(TypeError, "cannot create 'djvu.decode.PageInfoTable' instances"):
+            PageInfoTable()
+        context = Context()
+        document = context.new_document('dummy://dummy.djvu')
+        with self.assertRaises(NotAvailable):
+            document.page_info_table(wait=False)
+        with self.assertRaises(DeadlineExceeded):
+            document.page_info_table(timeout=0.05)
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        pages = [context.new_document(FileUri(IMAGES + 'test0.djvu')).pages[n] for n in range(2)]
+        table = document.page_info_table()
+        self.assertIsInstance(table, PageInfoTable)
+        self.assertIs(document.page_info_table(wait=False), table)
+        self.assertRepr(table, '<djvu.decode.PageInfoTable of 2 pages>')
+        self.assertEqual(len(table), 2)
+        self.assertIsInstance(table.width, memoryview)
+        self.assertTrue(table.width.readonly)
+        with self.assertRaises(TypeError):
+            table.width[0] = 1
+        for n, page in enumerate(pages):
+            page.get_info()
+            self.assertEqual(table[n], (page.width, page.height, page.dpi, page.rotation, page.version))
+            self.assertEqual(table.width[n], page.width)
+            self.assertEqual(table.height[n], page.height)
+            self.assertEqual(table.dpi[n], page.dpi)
+            self.assertEqual(table.rotation[n], page.rotation)
+            self.assertEqual(table.version[n], page.version)
+            # Pages obtained after the table was built already have the
+            # information.
+            page = document.pages[n]
+            self.assertEqual(page.size, (table.width[n], table.height[n]))
+            self.assertEqual(page.rotation, table.rotation[n])
+
+    def test_file_table(self):
+        with self.assertRaisesString(TypeError, "cannot create 'djvu.decode.FileTable' instances"):
+            FileTable()
+        context = Context()
+        document = context.new_document('dummy://dummy.djvu')
+        with self.assertRaises(NotAvailable):
+            document.file_table(wait=False)
+        with self.assertRaises(NotAvailable):
+            document.files['p0001.djvu']
+        with self.assertRaises(DeadlineExceeded):
+            document.file_table(timeout=0.05)
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        files = [context.new_document(FileUri(IMAGES + 'test0.djvu')).files[n] for n in range(3)]
+        table = document.file_table()
+        self.assertIsInstance(table, FileTable)
+        self.assertIs(document.file_table(wait=False), table)
+        self.assertRepr(table, '<djvu.decode.FileTable of 3 files>')
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.type, 'IPP')
+        self.assertIsInstance(table.n_page, memoryview)
+        self.assertTrue(table.n_page.readonly)
+        self.assertEqual(list(table.n_page), [-1, 0, 1])
+        self.assertEqual(table.id, ('shared_anno.iff', 'p0001.djvu', 'p0002.djvu'))
+        for n, file in enumerate(files):
+            file.get_info()
+            self.assertEqual(table[n], (file.type, file.n_page, file.size, file.id, file.name, file.title))
+        self.assertEqual(table.find_page(1), 2)
+        self.assertEqual(table.find_id('p0001.djvu'), 1)
+        self.assertEqual(table.find_name('shared_anno.iff'), 0)
+        with self.assertRaises(KeyError):
+            table.find_page(2)
+        file = document.files[document.pages[1]]
+        self.assertEqual(file.n, 2)
+        self.assertEqual(file.n_page, 1)
+        self.assertEqual(file.id, 'p0002.djvu')
+        self.assertEqual(document.files['p0001.djvu'].page.n, 0)
+        with self.assertRaises(KeyError):
+            document.files['eggs.djvu']
+        with self.assertRaises(KeyError):
+            document.files[files[0].document.pages[0]]
+        with self.assertRaisesString(TypeError, 'DocumentFiles indices must be integers, strings or Page instances'):
+            document.files[b'p0001.djvu']
+
     def test_new_document(self):
         context = Context()
         document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
@@ -395,6 +534,115 @@ class DocumentsTestCase(DecodeTestCase):
             expected = '1 Lorem ipsum'
             self.assertMultiLineEqual(stdout, expected)
 
+    def test_render_pages(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        pixel_format = PixelFormatGrey()
+        results = list(document.render_pages(None, RENDER_COLOR, None, pixel_format, workers=2))
+        self.assertEqual(sorted(n for n, _, _ in results), [0, 1])
+        for n, (w, h, row_size), data in results:
+            page_job = document.pages[n].decode()
+            self.assertEqual((w, h), page_job.size)
+            self.assertEqual(row_size, w)
+            rect = (0, 0, w, h)
+            self.assertEqual(data, page_job.render(RENDER_COLOR, rect, rect, pixel_format))
+        [(n, (w, h, row_size), data)] = document.render_pages([1], RENDER_COLOR, 75, pixel_format, row_alignment=4)
+        page_job = document.pages[1].decode()
+        self.assertEqual(n, 1)
+        self.assertEqual(w, int(page_job.width * 75 / page_job.dpi + 0.5))
+        self.assertEqual(h, int(page_job.height * 75 / page_job.dpi + 0.5))
+        self.assertEqual(row_size % 4, 0)
+        self.assertEqual(len(data), row_size * h)
+        with self.assertRaisesString(ValueError, 'workers must be a positive integer'):
+            document.render_pages(None, RENDER_COLOR, None, pixel_format, workers=0)
+        with self.assertRaisesString(ValueError, 'dpi must be a positive number or none'):
+            document.render_pages(None, RENDER_COLOR, 0, pixel_format)
+
+    def test_render_thumbnails(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        pixel_format = PixelFormatGrey()
+        results = list(document.render_thumbnails((32, 32), pixel_format, workers=2))
+        self.assertEqual(sorted(n for n, _, _ in results), [0, 1])
+        for n, (w, h, row_size), data in results:
+            thumbnail = document.pages[n].thumbnail
+            self.assertEqual(thumbnail.status, JobOK)
+            self.assertEqual(((w, h, row_size), data), thumbnail.render((32, 32), pixel_format))
+            self.assertLessEqual(max(w, h), 32)
+        [(n, (w, h, row_size), data)] = document.render_thumbnails((5, 5), pixel_format, pages=[1], row_alignment=4)
+        self.assertEqual(n, 1)
+        self.assertEqual(row_size, 8)
+        self.assertEqual(len(data), row_size * 5)
+        with self.assertRaisesString(ValueError, 'workers must be a positive integer'):
+            document.render_thumbnails((5, 5), pixel_format, workers=0)
+        with self.assertRaisesString(ValueError, 'size width/height must a positive integer'):
+            document.render_thumbnails((0, 5), pixel_format)
+
+    def test_render_to_file(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        page = document.pages[0]
+        page_job = page.decode()
+
+        def render(pixel_format, width=64, height=48):
+            pixel_format.rows_top_to_bottom = 1
+            pixel_format.y_top_to_bottom = 1
+            rect = (0, 0, width, height)
+            return page_job.render(RENDER_COLOR, rect, rect, pixel_format)
+
+        def read_png(data):
+            self.assertEqual(data[:8], b'\x89PNG\r\n\x1A\n')
+            chunks = []
+            offset = 8
+            while offset < len(data):
+                (length,) = struct.unpack('>I', data[offset:offset + 4])
+                tag = data[offset + 4:offset + 8]
+                body = data[offset + 8:offset + 8 + length]
+                (crc,) = struct.unpack('>I', data[offset + 8 + length:offset + 12 + length])
+                self.assertEqual(crc, zlib.crc32(tag + body))
+                chunks += [(tag, body)]
+                offset += 12 + length
+            self.assertEqual(chunks[0][0], b'IHDR')
+            self.assertEqual(chunks[-1], (b'IEND', b''))
+            header = struct.unpack('>IIBBBBB', chunks[0][1])
+            pixels = zlib.decompress(b''.join(body for tag, body in chunks if tag == b'IDAT'))
+            return header, pixels
+
+        for format, magic, pixel_format in [
+            ('ppm', b'P6\n64 48\n255\n', PixelFormatRgb()),
+            ('pgm', b'P5\n64 48\n255\n', PixelFormatGrey()),
+            ('pbm', b'P4\n64 48\n', PixelFormatPackedBits('>')),
+        ]:
+            file = io.BytesIO()
+            self.assertEqual(page.render_to_file(file, format), (64, 48))
+            self.assertEqual(file.getvalue(), magic + render(pixel_format))
+
+        file = io.BytesIO()
+        page.render_to_file(file)
+        header, pixels = read_png(file.getvalue())
+        self.assertEqual(header, (64, 48, 1, 0, 0, 0, 0))
+        expected = render(PixelFormatPackedBits('>')).translate(bytes(range(255, -1, -1)))
+        self.assertEqual(pixels, b''.join(b'\0' + expected[i * 8:(i + 1) * 8] for i in range(48)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'page.PNG')
+            self.assertEqual(page.render_to_file(path, dpi=150), (32, 24))
+            with open(path, 'rb') as file:
+                header, pixels = read_png(file.read())
+            self.assertEqual(header, (32, 24, 8, 2, 0, 0, 0))
+            expected = render(PixelFormatRgb(), 32, 24)
+            self.assertEqual(pixels, b''.join(b'\0' + expected[i * 96:(i + 1) * 96] for i in range(24)))
+            with self.assertRaisesString(ValueError, "Unknown image format: 'txt'"):
+                page.render_to_file(os.path.join(directory, 'page.txt'))
+        with self.assertRaisesString(ValueError, "Unknown image format: 'gif'"):
+            page.render_to_file(io.BytesIO(), 'gif')
+
 
 class PixelFormatsTestCase(TestCase):
 
@@ -425,6 +673,16 @@ class PixelFormatsTestCase(TestCase):
             )
         )
 
+    def test_rgba(self):
+        pf = PixelFormatRgba()
+        self.assertRepr(pf, "djvu.decode.PixelFormatRgba(byte_order = 'RGBA', premultiplied = False)")
+        self.assertEqual(pf.bpp, 32)
+        pf = PixelFormatRgba('BGRA', premultiplied=True)
+        self.assertRepr(pf, "djvu.decode.PixelFormatRgba(byte_order = 'BGRA', premultiplied = True)")
+        self.assertEqual((pf.byte_order, pf.premultiplied), ('BGRA', True))
+        with self.assertRaisesString(ValueError, "byte_order must be equal to 'RGBA', 'BGRA', 'ARGB' or 'ABGR'"):
+            PixelFormatRgba('RGB')
+
     def test_grey(self):
         pf = PixelFormatGrey()
         self.assertRepr(pf, "djvu.decode.PixelFormatGrey(bpp = 8)")
@@ -445,6 +703,16 @@ class PixelFormatsTestCase(TestCase):
             f'djvu.decode.PixelFormatPalette({{{data_repr}}}, bpp = 8)'
         )
 
+    def test_row_order(self):
+        pf = PixelFormatGrey()
+        self.assertEqual((pf.rows_top_to_bottom, pf.y_top_to_bottom), (False, False))
+        pf.rows_top_to_bottom = True
+        self.assertEqual((pf.rows_top_to_bottom, pf.y_top_to_bottom), (True, False))
+        pf.y_top_to_bottom = True
+        self.assertEqual((pf.rows_top_to_bottom, pf.y_top_to_bottom), (True, True))
+        pf.rows_top_to_bottom = False
+        self.assertEqual((pf.rows_top_to_bottom, pf.y_top_to_bottom), (False, True))
+
     def test_packed_bits(self):
         pf = PixelFormatPackedBits('<')
         self.assertRepr(pf, "djvu.decode.PixelFormatPackedBits('<')")
@@ -537,6 +805,417 @@ class PageJobsTestCase(TestCase):
             s = bytes(buffer)
             self.assertEqual(s, b'\xFF\xFF\xFF\x00' * 4)
 
+    def test_render_image(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        page_job = document.pages[0].decode()
+        rect = (0, 0, 10, 10)
+        rows = [b'\xFF\xFF\xFF\xFF', b'\xFF\xFF\xFF\xEF', b'\xFF\xFF\xFF\xA4', b'\xFF\xFF\xFF\xB8']
+
+        pixel_format = PixelFormatGrey()
+        image = page_job.render_image(RENDER_COLOR, rect, (0, 0, 4, 4), pixel_format)
+        self.assertIsInstance(image, Image)
+        self.assertEqual((image.width, image.height, image.row_size), (4, 4, 4))
+        self.assertIs(image.pixel_format, pixel_format)
+        self.assertEqual(bytes(image.buffer), b''.join(rows))
+        self.assertEqual((image.shape, image.strides), ((4, 4), (-4, 1)))
+        view = memoryview(image)
+        self.assertEqual((view.shape, view.strides, view.format), ((4, 4), (-4, 1), 'B'))
+        self.assertEqual(view.tobytes(), b''.join(reversed(rows)))
+        self.assertEqual(bytes(image), b''.join(reversed(rows)))
+        interface = image.__array_interface__
+        self.assertEqual(interface['shape'], (4, 4))
+        self.assertEqual(interface['typestr'], '|u1')
+        self.assertEqual(interface['strides'], (-4, 1))
+
+        pixel_format.rows_top_to_bottom = True
+        self.assertTrue(pixel_format.rows_top_to_bottom)
+        self.assertFalse(pixel_format.y_top_to_bottom)
+        image = page_job.render_image(RENDER_COLOR, rect, (0, 0, 4, 4), pixel_format)
+        self.assertEqual(image.strides, (4, 1))
+        self.assertEqual(bytes(image), b''.join(reversed(rows)))
+        self.assertIsNone(image.__array_interface__['strides'])
+
+        image = page_job.render_image(RENDER_COLOR, rect, (0, 0, 3, 2), PixelFormatRgb(), 4)
+        self.assertEqual((image.row_size, image.shape, image.strides), (12, (2, 3, 3), (-12, 3, 1)))
+        image = page_job.render_image(RENDER_COLOR, rect, (0, 0, 2, 2), PixelFormatRgbMask(0xF800, 0x7E0, 0x1F, bpp=16))
+        self.assertEqual((image.shape, image.strides), ((2, 2), (-4, 2)))
+        self.assertEqual(memoryview(image).format, 'H')
+        self.assertEqual(image.__array_interface__['typestr'], '<u2' if sys.byteorder == 'little' else '>u2')
+        image = page_job.render_image(RENDER_COLOR, rect, (0, 0, 10, 3), PixelFormatPackedBits('>'), 4)
+        self.assertEqual((image.row_size, image.shape, image.strides), (4, (3, 2), (-4, 1)))
+
+        pixel_format = PixelFormatRgbMask(0xFF0000, 0xFF00, 0xFF, bpp=32)
+        buffer = array.array('I', [0] * 4)
+        image = page_job.render_image(RENDER_COLOR, rect, (0, 0, 2, 2), pixel_format, 1, buffer)
+        self.assertIs(image.buffer, buffer)
+        self.assertEqual(buffer.tobytes(), b'\xFF\xFF\xFF\x00' * 4)
+        buffer = bytearray(16)
+        page_job.render_image(RENDER_COLOR, rect, (0, 0, 2, 2), pixel_format, 1, memoryview(buffer).cast('I', shape=(2, 2)))
+        self.assertEqual(bytes(buffer), b'\xFF\xFF\xFF\x00' * 4)
+        with self.assertRaisesString(ValueError, 'Image buffer is too small (16 > 8)'):
+            page_job.render_image(RENDER_COLOR, rect, (0, 0, 2, 2), pixel_format, 1, bytearray(8))
+        with self.assertRaisesString(ValueError, 'Image buffer has 4 rows, expected 2'):
+            page_job.render_image(RENDER_COLOR, rect, (0, 0, 2, 2), pixel_format, 1, memoryview(bytearray(32)).cast('I', shape=(4, 2)))
+        with self.assertRaisesString(ValueError, 'Image buffer row stride (8) does not match the row size (16)'):
+            page_job.render_image(RENDER_COLOR, rect, (0, 0, 2, 2), pixel_format, 16, memoryview(buffer).cast('I', shape=(2, 2)))
+        with self.assertRaisesString(ValueError, 'Image buffer must be contiguous'):
+            page_job.render_image(RENDER_COLOR, rect, (0, 0, 1, 2), pixel_format, 1, memoryview(buffer).cast('I')[::2])
+
+    def test_render_buffer_pool(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        page_job = document.pages[0].decode()
+        rect = (0, 0, 10, 10)
+        expected = b'\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xEF\xFF\xFF\xFF\xA4\xFF\xFF\xFF\xB8'
+        pool = RenderBufferPool()
+        data = page_job.render(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey(), 1, pool)
+        self.assertIsInstance(data, memoryview)
+        self.assertIsInstance(data.obj, bytearray)
+        self.assertEqual(data.tobytes(), expected)
+        pool.release(data)
+        self.assertIs(context.buffer_pool, None)
+        context.buffer_pool = pool
+        self.assertIs(context.buffer_pool, pool)
+        other_data = page_job.render(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey(), 1)
+        self.assertIs(other_data.obj, data.obj)
+        self.assertEqual(other_data.tobytes(), expected)
+        image = page_job.render_image(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey(), 1)
+        self.assertIsInstance(image.buffer, bytearray)
+        self.assertEqual((pool.hits, pool.misses), (1, 2))
+        with self.assertRaises(TypeError):
+            context.buffer_pool = 42
+        context.buffer_pool = None
+        self.assertIsInstance(page_job.render(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey(), 1), bytes)
+
+    def test_render_pyramid(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        page_job = document.pages[0].decode()
+        sizes = {0: (64, 48), 1: (32, 24), 2: (16, 12)}
+        for pixel_format, tile_size in [
+            (PixelFormatGrey(), (16, 16)),
+            (PixelFormatRgb(), (10, 7)),
+            (PixelFormatPackedBits('>'), (12, 16)),
+            (PixelFormatPackedBits('<'), (16, 16)),
+        ]:
+            for rows_top_to_bottom in False, True:
+                pixel_format.rows_top_to_bottom = rows_top_to_bottom
+                tiles = list(page_job.render_pyramid(RENDER_COLOR, tile_size, pixel_format, row_alignment=4, workers=2))
+                levels = [level for level, x, y, w, h, data in tiles]
+                self.assertEqual(levels, sorted(levels, reverse=True))
+                self.assertEqual(set(levels), {0, 1, 2})
+                for level, x, y, w, h, data in tiles:
+                    page_rect = (0, 0) + sizes[level]
+                    self.assertEqual(data, page_job.render(RENDER_COLOR, page_rect, (x, y, w, h), pixel_format, 4))
+                for level, (width, height) in sizes.items():
+                    area = sum(w * h for tile_level, x, y, w, h, data in tiles if tile_level == level)
+                    self.assertEqual(area, width * height)
+        tiles = list(page_job.render_pyramid(RENDER_COLOR, (16, 16), PixelFormatGrey(), levels=2))
+        self.assertEqual({tile[0] for tile in tiles}, {0, 1})
+        [(level, x, y, w, h, data)] = page_job.render_pyramid(RENDER_COLOR, (64, 48), PixelFormatGrey())
+        self.assertEqual((level, x, y, w, h), (0, 0, 0, 64, 48))
+        written = []
+        self.assertIsNone(page_job.render_pyramid(RENDER_COLOR, (16, 16), PixelFormatGrey(), sink=lambda *tile: written.append(tile)))
+        self.assertEqual(sorted(written), sorted(page_job.render_pyramid(RENDER_COLOR, (16, 16), PixelFormatGrey())))
+        with self.assertRaisesString(ValueError, 'tile_size width/height must be a positive integer'):
+            page_job.render_pyramid(RENDER_COLOR, (0, 16), PixelFormatGrey())
+        with self.assertRaisesString(ValueError, 'levels must be a positive integer'):
+            page_job.render_pyramid(RENDER_COLOR, (16, 16), PixelFormatGrey(), levels=0)
+
+    def test_message_dispatch(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        self.assertIs(message.context, context)
+        self.assertIs(message.document, document)
+        self.assertIs(message.job, None)
+        page_jobs = [page.decode(wait=False) for page in document.pages]
+        for page_job in page_jobs:
+            page_job.wait()
+            message = page_job.get_message(wait=False)
+            self.assertIsNot(message, None)
+            self.assertIs(message.context, context)
+            self.assertIs(message.document, document)
+            self.assertIs(message.job, page_job)
+        # Jobs that are gone must not confuse the message distributor:
+        del page_jobs, page_job, message
+        gc.collect()
+        page_job = document.pages[0].decode()
+        self.assertIs(page_job.status, JobOK)
+
+    def test_iter_progressive_renders(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        page_job = document.pages[0].decode(wait=False)
+        page_rect = (0, 0, 64, 48)
+        pixel_format = PixelFormatGrey()
+        renders = list(page_job.iter_progressive_renders(RENDER_COLOR, page_rect, page_rect, pixel_format, min_interval=0))
+        self.assertTrue(page_job.is_done)
+        self.assertNotEqual(renders, [])
+        self.assertEqual(renders[-1], page_job.render(RENDER_COLOR, page_rect, page_rect, pixel_format))
+        with self.assertRaisesString(ValueError, 'min_interval must be a non-negative number'):
+            page_job.iter_progressive_renders(RENDER_COLOR, page_rect, page_rect, pixel_format, min_interval=-1)
+        with self.assertRaisesString(ValueError, 'row_alignment must be a positive integer'):
+            page_job.iter_progressive_renders(RENDER_COLOR, page_rect, page_rect, pixel_format, row_alignment=0)
+
+    def test_render_rgba(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        page_job = document.pages[0].decode()
+        page_rect = (0, 0, 2048, 1536)
+        # Wide enough for the mask to be rendered in several stripes:
+        render_rect = (0, 1000, 2048, 70)
+        for rows_top_to_bottom in False, True:
+            rgb_format = PixelFormatRgb()
+            grey_format = PixelFormatGrey()
+            rgb_format.rows_top_to_bottom = grey_format.rows_top_to_bottom = rows_top_to_bottom
+            color = page_job.render(RENDER_FOREGROUND, page_rect, render_rect, rgb_format)
+            mask = page_job.render(RENDER_MASK_ONLY, page_rect, render_rect, grey_format)
+            alpha = mask.translate(bytes(range(255, -1, -1)))
+            self.assertIn(b'\0', alpha)
+            self.assertIn(b'\xFF', alpha)
+            for byte_order in 'RGBA', 'BGRA', 'ARGB', 'ABGR':
+                for premultiplied in False, True:
+                    pixel_format = PixelFormatRgba(byte_order, premultiplied)
+                    pixel_format.rows_top_to_bottom = rows_top_to_bottom
+                    data = page_job.render(RENDER_FOREGROUND, page_rect, render_rect, pixel_format)
+                    for i, channel in enumerate(byte_order):
+                        if channel == 'A':
+                            self.assertEqual(data[i::4], alpha)
+                        elif premultiplied:
+                            expected = bytes((c * a + 127) // 255 for c, a in zip(color['RGB'.index(channel)::3], alpha))
+                            self.assertEqual(data[i::4], expected)
+                        else:
+                            self.assertEqual(data[i::4], color['RGB'.index(channel)::3])
+        image = page_job.render_image(RENDER_FOREGROUND, (0, 0, 64, 48), (0, 0, 3, 2), PixelFormatRgba())
+        self.assertEqual((image.shape, image.strides), ((2, 3, 4), (-12, 4, 1)))
+
+    def test_render_tiles(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        page_job = document.pages[0].decode()
+        pixel_format = PixelFormatGrey()
+        rect = (0, 0, 64, 48)
+        expected = page_job.render(RENDER_COLOR, rect, rect, pixel_format, 4)
+        for tile_size in (10, 10), (None, 7), (64, 48), (100, 100):
+            for reuse_buffer in False, True:
+                image = bytearray(len(expected))
+                tiles = []
+                for x, y, w, h, data in page_job.render_tiles(
+                        RENDER_COLOR, rect, tile_size, pixel_format, 4, reuse_buffer=reuse_buffer
+                ):
+                    tiles += [(x, y, w, h)]
+                    row_size = (w + 3) // 4 * 4
+                    self.assertEqual(len(data), row_size * h)
+                    for i in range(h):
+                        image[(y + i) * 64 + x:(y + i) * 64 + x + w] = data[i * row_size:i * row_size + w]
+                self.assertEqual(bytes(image), expected)
+                self.assertEqual(tiles[0][:2], (0, 0))
+                self.assertEqual(sum(w * h for x, y, w, h in tiles), 64 * 48)
+        stripes = list(page_job.render_tiles(RENDER_COLOR, rect, (None, 20), pixel_format))
+        self.assertEqual([tile[:4] for tile in stripes], [(0, 0, 64, 20), (0, 20, 64, 20), (0, 40, 64, 8)])
+        [(x, y, w, h, data)] = page_job.render_tiles(RENDER_COLOR, rect, (10, 10), pixel_format, render_rect=(2, 2, 4, 4))
+        self.assertEqual((x, y, w, h), (2, 2, 4, 4))
+        self.assertEqual(data, page_job.render(RENDER_COLOR, rect, (2, 2, 4, 4), pixel_format))
+        with self.assertRaisesString(ValueError, 'tile_size width/height must be a positive integer'):
+            page_job.render_tiles(RENDER_COLOR, rect, (0, 10), pixel_format)
+        with self.assertRaisesString(ValueError, 'render_rect must be inside page_rect'):
+            page_job.render_tiles(RENDER_COLOR, rect, (10, 10), pixel_format, render_rect=(60, 0, 10, 10))
+
+
+class DecodeSchedulerTestCase(TestCase):
+
+    def test_bad_args(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        with self.assertRaisesString(ValueError, 'max_jobs must be a positive integer'):
+            DecodeScheduler(document, max_jobs=0)
+        with self.assertRaisesString(ValueError, 'prefetch must be a non-negative integer'):
+            DecodeScheduler(document, prefetch=-1)
+        with self.assertRaisesString(ValueError, 'max_jobs must be a positive integer'):
+            next(document.iter_pages(max_jobs=0))
+
+    def test_scheduler(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        document.decoding_job.wait()
+        scheduler = DecodeScheduler(document, max_jobs=1, prefetch=1)
+        self.assertIs(scheduler.document, document)
+        self.assertEqual((scheduler.max_jobs, scheduler.prefetch), (1, 1))
+        scheduler.set_visible([0])
+        self.assertLessEqual(scheduler.running, 1)
+        job = scheduler.get(0)
+        self.assertIsInstance(job, PageJob)
+        self.assertTrue(job.is_done)
+        self.assertEqual(job.status, JobOK)
+        self.assertIs(scheduler.get(0), job)
+        job = scheduler.get(1)
+        self.assertEqual(job.size, document.pages[1].size)
+        scheduler.set_visible([])
+        self.assertEqual((scheduler.running, scheduler.pending), (0, 0))
+        self.assertIsNot(scheduler.get(1), job)
+        scheduler.cancel(1)
+        scheduler.request(0, priority=5)
+        scheduler.cancel(0)
+        self.assertEqual(scheduler.pending, 0)
+        with self.assertRaisesString(IndexError, 'page number out of range'):
+            scheduler.get(2)
+        document = context.new_document('dummy://dummy.djvu')
+        with self.assertRaises(DeadlineExceeded):
+            DecodeScheduler(document).get(0, timeout=0.05)
+
+    def test_no_preemption(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        document.decoding_job.wait()
+        scheduler = DecodeScheduler(document, max_jobs=1, prefetch=3)
+        scheduler.request(1, priority=1)
+        read_ahead_job = scheduler.get(1, wait=False)
+        # Page 1 is still requested as read-ahead of page 0, which waits for
+        # the read-ahead job to finish rather than stopping it.
+        scheduler.set_visible([0])
+        job = scheduler.get(0)
+        self.assertEqual(job.status, JobOK)
+        self.assertIs(scheduler.get(1, wait=False), read_ahead_job)
+        read_ahead_job.wait()
+        self.assertEqual(read_ahead_job.status, JobOK)
+        self.assertEqual((scheduler.running, scheduler.pending), (0, 0))
+
+    def test_before_docinfo(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        scheduler = DecodeScheduler(document, max_jobs=1, prefetch=5)
+        scheduler.set_visible([0])
+        document.decoding_job.wait()
+        end = time.monotonic() + 10
+        while time.monotonic() < end:
+            if (scheduler.running, scheduler.pending) == (0, 0):
+                break
+            time.sleep(0.01)
+        # Pages 2-5 are out of range: their requests are dropped.
+        self.assertEqual((scheduler.running, scheduler.pending), (0, 0))
+        self.assertEqual(scheduler.get(0, wait=False).status, JobOK)
+        self.assertEqual(scheduler.get(1, wait=False).status, JobOK)
+
+    def test_iter_pages(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        jobs = list(document.iter_pages(prefetch=1, max_jobs=1))
+        self.assertEqual(len(jobs), 2)
+        for n, job in enumerate(jobs):
+            self.assertIsInstance(job, PageJob)
+            self.assertEqual(job.status, JobOK)
+            self.assertEqual(job.size, document.pages[n].size)
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        pages = document.iter_pages(prefetch=5)
+        self.assertEqual(next(pages).status, JobOK)
+        pages.close()
+
+
+class PageJobCacheTestCase(TestCase):
+
+    def test_bad_args(self):
+        with self.assertRaisesString(ValueError, 'max_bytes must be a non-negative integer'):
+            PageJobCache(-1)
+        cache = PageJobCache(1 << 20)
+        self.assertRepr(cache, 'djvu.decode.PageJobCache(max_bytes = 1048576)')
+        with self.assertRaisesString(ValueError, 'page 0 is not pinned'):
+            cache.unpin(0)
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        self.assertIs(document.page_job_cache, None)
+        document.page_job_cache = cache
+        document.page_job_cache = cache
+        self.assertIs(document.page_job_cache, cache)
+        other_document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        with self.assertRaisesString(ValueError, 'cache is already attached to another document'):
+            other_document.page_job_cache = cache
+        document.page_job_cache = None
+        self.assertIs(document.page_job_cache, None)
+
+    def test_cache(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        document.decoding_job.wait()
+        cache = PageJobCache()
+        document.page_job_cache = cache
+        self.assertIs(cache.hit_rate, None)
+        job = document.pages[0].decode()
+        self.assertEqual(job.status, JobOK)
+        self.assertIn(0, cache)
+        self.assertEqual(len(cache), 1)
+        # A bitonal 64×48 page: one bit per pixel.
+        self.assertEqual(cache.cached_bytes, 8 * 48)
+        self.assertIs(document.pages[0].decode(), job)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate, 0.5)
+        cache.pin(0)
+        cache.pin(0)
+        self.assertEqual(cache.pinned, frozenset([0]))
+        cache.max_bytes = 0
+        self.assertIn(0, cache)
+        cache.unpin(0)
+        self.assertIn(0, cache)
+        cache.unpin(0)
+        self.assertNotIn(0, cache)
+        self.assertEqual(cache.pinned, frozenset())
+        self.assertEqual((cache.evictions, cache.evicted_bytes, cache.cached_bytes), (1, 8 * 48, 0))
+        cache.max_bytes = 1 << 20
+        new_job = document.pages[0].decode()
+        self.assertIsNot(new_job, job)
+        self.assertEqual(len(cache), 1)
+        cache.discard(0)
+        self.assertEqual((len(cache), cache.cached_bytes), (0, 0))
+        document.pages[0].decode()
+        cache.clear()
+        self.assertEqual((len(cache), cache.cached_bytes), (0, 0))
+
+    def test_in_flight(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        document.decoding_job.wait()
+        cache = PageJobCache()
+        document.page_job_cache = cache
+        job = document.pages[1].decode(wait=False)
+        self.assertIs(document.pages[1].decode(), job)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(job.status, JobOK)
+        self.assertIn(1, cache)
+        # An evicted job is not cached again.
+        cache.max_bytes = 0
+        self.assertNotIn(1, cache)
+        cache.max_bytes = 1 << 20
+        job.wait()
+        self.assertNotIn(1, cache)
+        self.assertEqual(cache.cached_bytes, 0)
+
+    def test_schedulers(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        document.page_job_cache = PageJobCache()
+        scheduler = DecodeScheduler(document, max_jobs=1)
+        other_scheduler = DecodeScheduler(document, max_jobs=1)
+        job = scheduler.get(0)
+        self.assertIs(other_scheduler.get(0), job)
+        self.assertEqual(other_scheduler.running, 0)
+        other_scheduler.set_visible([])
+        self.assertEqual(job.status, JobOK)
+        self.assertIs(scheduler.get(0), job)
+
 
 class ThumbnailsTestCase(TestCase):
 
@@ -565,6 +1244,387 @@ class ThumbnailsTestCase(TestCase):
         self.assertIs(pixels, buffer)
         s = buffer[:15].tobytes()
         self.assertEqual(s, b'\xFF\xEB\xA7\xF2\xFF\xFF\xBF\x86\xBE\xFF\xFF\xE7\xD6\xE7\xFF')
+        # Thumbnails are opaque.
+        for pixel_format in PixelFormatRgba(), PixelFormatRgba('ARGB', premultiplied=True):
+            (w, h, r), pixels = thumbnail.render((5, 5), pixel_format)
+            self.assertEqual((w, h, r), (5, 3, 20))
+            alpha_index = pixel_format.byte_order.index('A')
+            self.assertEqual(bytes(pixels[alpha_index:60:4]), b'\xFF' * 15)
+        [(n, (w, h, r), pixels)] = document.render_thumbnails((5, 5), PixelFormatRgba(), pages=[0])
+        self.assertEqual(bytes(pixels[3:60:4]), b'\xFF' * 15)
+
+
+class RenderBufferPoolTestCase(TestCase):
+
+    def test_pool(self):
+        pool = RenderBufferPool(100)
+        self.assertRepr(pool, 'djvu.decode.RenderBufferPool(max_bytes = 100)')
+        self.assertEqual(pool.max_bytes, 100)
+        buffer = pool.acquire(25)
+        self.assertIsInstance(buffer, bytearray)
+        self.assertEqual(len(buffer), 28)
+        self.assertEqual((pool.hits, pool.misses, pool.evictions, pool.idle_bytes), (0, 1, 0, 0))
+        pool.release(memoryview(buffer)[:25])
+        self.assertEqual(pool.idle_bytes, 28)
+        self.assertIs(pool.acquire(27), buffer)
+        self.assertEqual((pool.hits, pool.misses, pool.evictions, pool.idle_bytes), (1, 1, 0, 0))
+        self.assertEqual(len(pool.acquire(16)), 16)
+        self.assertEqual((pool.hits, pool.misses), (1, 2))
+
+    def test_eviction(self):
+        pool = RenderBufferPool(100)
+        buffers = [pool.acquire(64), pool.acquire(64)]
+        for buffer in buffers:
+            pool.release(buffer)
+        self.assertEqual((pool.evictions, pool.idle_bytes), (1, 64))
+        self.assertIs(pool.acquire(64), buffers[1])
+        pool.release(buffers[1])
+        pool.max_bytes = 0
+        self.assertEqual((pool.evictions, pool.idle_bytes), (2, 0))
+        pool.max_bytes = 100
+        pool.release(buffers[0])
+        pool.clear()
+        self.assertEqual(pool.idle_bytes, 0)
+        self.assertIsNot(pool.acquire(64), buffers[0])
+
+    def test_bad_args(self):
+        pool = RenderBufferPool()
+        with self.assertRaisesString(ValueError, 'max_bytes must be a non-negative integer'):
+            pool.max_bytes = -1
+        with self.assertRaisesString(ValueError, 'size must be a non-negative integer'):
+            pool.acquire(-1)
+        with self.assertRaisesString(TypeError, 'buffer must be a bytearray or a memoryview of a bytearray'):
+            pool.release(b'foo')
+        with self.assertRaisesString(ValueError, 'buffer does not come from a pool'):
+            pool.release(bytearray(25))
+
+
+class RenderCacheTestCase(TestCase):
+
+    def test_cache(self):
+        context = Context()
+        cache = RenderCache(100)
+        self.assertRepr(cache, 'djvu.decode.RenderCache(max_bytes = 100)')
+        self.assertIs(context.render_cache, None)
+        context.render_cache = cache
+        self.assertIs(context.render_cache, cache)
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        page_job = document.pages[0].decode()
+        rect = (0, 0, 10, 10)
+        data = page_job.render(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey())
+        self.assertEqual(data, b'\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xEF\xFF\xFF\xFF\xA4\xFF\xFF\xFF\xB8')
+        self.assertEqual((cache.hits, cache.misses, len(cache), cache.cached_bytes), (0, 1, 1, 16))
+        self.assertIs(page_job.render(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey()), data)
+        self.assertIs(document.pages[0].decode().render(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey()), data)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        pixel_format = PixelFormatGrey()
+        pixel_format.gamma = 1.0
+        self.assertEqual(pixel_format.gamma, 1.0)
+        page_job.render(RENDER_COLOR, rect, (0, 0, 4, 4), pixel_format)
+        page_job.render(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey(), 4)
+        page_job.render(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey(), 1, bytearray(16))
+        self.assertEqual((cache.hits, cache.misses, len(cache), cache.cached_bytes), (2, 3, 3, 48))
+        page_job.render(RENDER_COLOR, rect, (0, 0, 8, 8), PixelFormatGrey())
+        self.assertEqual((cache.evictions, len(cache), cache.cached_bytes), (1, 3, 96))
+        page_job.render(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey())
+        self.assertEqual((cache.hits, cache.misses), (2, 5))
+        cache.invalidate(document)
+        self.assertEqual((len(cache), cache.cached_bytes), (0, 0))
+        page_job.render(RENDER_COLOR, rect, (0, 0, 4, 4), PixelFormatGrey())
+        self.assertEqual(len(cache), 1)
+        del page_job, document, message
+        for i in range(100):
+            gc.collect()
+            if not len(cache):
+                break
+            time.sleep(0.01)
+        self.assertEqual((len(cache), cache.cached_bytes), (0, 0))
+        cache.max_bytes = 0
+        cache.clear()
+        with self.assertRaisesString(ValueError, 'max_bytes must be a non-negative integer'):
+            cache.max_bytes = -1
+        with self.assertRaises(TypeError):
+            context.render_cache = 42
+
+    def test_dropped_document(self):
+        context = Context()
+        cache = context.render_cache = RenderCache()
+        rect = (0, 0, 10, 10)
+        for i in range(3):
+            document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+            document.decoding_job.wait()
+            document.pages[0].decode().render(RENDER_COLOR, rect, rect, PixelFormatGrey())
+            # Images of the previous documents are never served, even if the
+            # new document reuses their memory.
+            self.assertEqual((cache.hits, cache.misses), (0, i + 1))
+            del document
+            for j in range(100):
+                gc.collect()
+                if not len(cache):
+                    break
+                time.sleep(0.01)
+            self.assertEqual((len(cache), cache.cached_bytes), (0, 0))
+
+
+class SubscriptionsTestCase(TestCase):
+
+    def test_bad_new(self):
+        with self.assertRaisesString(TypeError, "cannot create 'djvu.decode.Subscription' instances"):
+            Subscription(None, (), None)
+
+    def test_bad_args(self):
+        context = Context()
+        with self.assertRaisesString(TypeError, 'types must be a sequence of Message subclasses'):
+            context.subscribe((int,), print)
+        with self.assertRaisesString(TypeError, 'types must be a sequence of Message subclasses'):
+            context.subscribe((42,), print)
+        with self.assertRaisesString(TypeError, 'callback must be callable'):
+            context.subscribe((Message,), None)
+        with self.assertRaisesString(TypeError, 'types must be a sequence of Message subclasses'):
+            context.message_types = (str,)
+
+    def test_context(self):
+        context = Context()
+        messages = []
+        subscription = context.subscribe(types=(DocInfoMessage, ErrorMessage), callback=messages.append)
+        self.assertEqual(subscription.types, (DocInfoMessage, ErrorMessage))
+        self.assertIs(subscription.callback, messages.append)
+        self.assertTrue(subscription.active)
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        document.decoding_job.wait()
+        self.assertEqual([type(message) for message in messages], [DocInfoMessage])
+        self.assertIs(messages[0].document, document)
+        while True:
+            message = document.get_message(wait=False)
+            if message is None:
+                break
+            self.assertNotIsInstance(message, DocInfoMessage)
+        subscription.cancel()
+        self.assertFalse(subscription.active)
+        subscription.cancel()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        self.assertEqual(len(messages), 1)
+
+    def test_document(self):
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        messages = []
+        document.subscribe((Message,), messages.append)
+        page_job = document.pages[0].decode()
+        self.assertIs(page_job.status, JobOK)
+        self.assertNotEqual(messages, [])
+        for message in messages:
+            self.assertIs(message.document, document)
+        self.assertIs(page_job.get_message(wait=False), None)
+
+    def test_message_types(self):
+        context = Context()
+        self.assertIs(context.message_types, None)
+        context.message_types = [ErrorMessage]
+        self.assertEqual(context.message_types, (ErrorMessage,))
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        document.decoding_job.wait()
+        page_job = document.pages[0].decode()
+        self.assertIs(page_job.status, JobOK)
+        self.assertIs(document.get_message(wait=False), None)
+        self.assertIs(page_job.get_message(wait=False), None)
+        context.message_types = None
+        self.assertIs(context.message_types, None)
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+
+
+class QueuePolicyTestCase(TestCase):
+
+    def test_bad_args(self):
+        with self.assertRaisesString(ValueError, 'max_size must be a non-negative integer or None'):
+            QueuePolicy(max_size=-1)
+        with self.assertRaisesString(ValueError, "drop must be 'oldest' or 'newest', not 'eggs'"):
+            QueuePolicy(drop='eggs')
+
+    def test_policy(self):
+        policy = QueuePolicy()
+        self.assertRepr(policy, "djvu.decode.QueuePolicy(max_size = None, drop = 'oldest', coalesce = True)")
+        policy = QueuePolicy(max_size=2, drop='newest', coalesce=False)
+        self.assertRepr(policy, "djvu.decode.QueuePolicy(max_size = 2, drop = 'newest', coalesce = False)")
+
+    def test_drop(self):
+        for drop, expected in ('oldest', [2, 3]), ('newest', [1, 2]):
+            policy = QueuePolicy(max_size=2, drop=drop)
+            queue = MessageQueue(policy)
+            for item in 1, 2, 3:
+                queue.put(item)
+            self.assertEqual((policy.depth, policy.max_depth, policy.dropped), (2, 2, 1))
+            self.assertEqual([queue.get(), queue.get()], expected)
+            self.assertEqual((policy.depth, policy.max_depth), (0, 2))
+            self.assertTrue(queue.empty())
+        policy = QueuePolicy(max_size=0)
+        queue = MessageQueue(policy)
+        queue.put(1)
+        self.assertTrue(queue.empty())
+        self.assertEqual((policy.depth, policy.dropped), (0, 1))
+
+    def test_dropped_queue(self):
+        policy = QueuePolicy()
+        queue = MessageQueue(policy)
+        for item in 1, 2, 3:
+            queue.put(item)
+        self.assertEqual(policy.depth, 3)
+        del queue
+        gc.collect()
+        self.assertEqual((policy.depth, policy.max_depth), (0, 3))
+
+    def test_context(self):
+        policy = QueuePolicy(max_size=0)
+        context = Context(queue_policy=policy)
+        self.assertIs(context.queue_policy, policy)
+        self.assertIs(Context().queue_policy, None)
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        document.decoding_job.wait()
+        self.assertIs(document.message_queue.policy, policy)
+        self.assertIs(document.get_message(wait=False), None)
+        self.assertGreater(policy.dropped, 0)
+        self.assertEqual(policy.depth, 0)
+
+    def test_coalesce(self):
+        policy = QueuePolicy()
+        context = Context(queue_policy=policy)
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        page_job = document.pages[0].decode()
+        messages = []
+        while True:
+            message = page_job.get_message(wait=False)
+            if message is None:
+                break
+            messages += [message]
+        self.assertLessEqual(sum(isinstance(message, RedisplayMessage) for message in messages), 1)
+        self.assertEqual(policy.depth, 0)
+
+
+class InstrumentationTestCase(TestCase):
+
+    def test_bad_args(self):
+        with self.assertRaisesString(TypeError, 'exporter must be callable or None'):
+            Instrumentation(42)
+
+    def test_disabled(self):
+        context = Context()
+        self.assertIsNone(context.instrumentation)
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        self.assertEqual(document.timestamps, {})
+        document.decoding_job.wait()
+        self.assertEqual(document.pages[0].decode().timestamps, {})
+
+    def test_instrumentation(self):
+        snapshots = []
+        instrumentation = Instrumentation(snapshots.append)
+        self.assertIs(instrumentation.exporter, snapshots.append)
+        context = Context()
+        context.instrumentation = instrumentation
+        self.assertIs(context.instrumentation, instrumentation)
+        start = time.monotonic()
+        document = context.new_document('dummy://dummy.djvu')
+        message = document.get_message()
+        self.assertIsInstance(message, NewStreamMessage)
+        with open(IMAGES + 'test1.djvu', 'rb') as fp:
+            data = fp.read()
+        try:
+            message.stream.write(data)
+        finally:
+            message.stream.close()
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        timestamps = document.timestamps
+        self.assertEqual(sorted(timestamps), ['created', 'info'])
+        self.assertLessEqual(start, timestamps['created'])
+        self.assertLessEqual(timestamps['created'], timestamps['info'])
+        page_job = document.pages[0].decode()
+        self.assertLessEqual(timestamps['info'], page_job.timestamps['created'])
+        page_job.render(RENDER_COLOR, (0, 0, 64, 48), (0, 0, 32, 24), PixelFormatRgb())
+        snapshot = instrumentation.snapshot()
+        self.assertEqual(snapshot['messages']['NewStreamMessage'], 1)
+        self.assertEqual(snapshot['messages']['DocInfoMessage'], 1)
+        self.assertEqual(snapshot['documents_created'], 1)
+        self.assertEqual(snapshot['documents_decoded'], 1)
+        self.assertGreaterEqual(snapshot['document_time'], 0)
+        self.assertEqual(snapshot['jobs_created'], 1)
+        self.assertEqual(snapshot['render_calls'], 1)
+        self.assertEqual(snapshot['render_pixels'], 32 * 24)
+        self.assertGreaterEqual(snapshot['render_time'], 0)
+        self.assertEqual(snapshot['stream_bytes'], len(data))
+        self.assertGreaterEqual(snapshot['max_queue_depth'], 0)
+        instrumentation.export(reset=True)
+        [exported] = snapshots
+        self.assertEqual(exported['stream_bytes'], len(data))
+        snapshot = instrumentation.snapshot()
+        self.assertEqual(snapshot['messages'], {})
+        self.assertEqual(snapshot['render_calls'], 0)
+        self.assertEqual(snapshot['stream_bytes'], 0)
+
+    def test_profile(self):
+        with self.assertRaisesString(TypeError, 'tracer must be callable or None'):
+            Instrumentation(tracer=42)
+        events = []
+        instrumentation = Instrumentation(profile=True, tracer=lambda frame, event, arg: events.append((frame.f_code.co_name, event, arg)))
+        self.assertTrue(instrumentation.profile)
+        context = Context()
+        context.instrumentation = instrumentation
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        self.assertIn(('register_lock', 'call', None), events)
+        self.assertIn(('register_lock', 'return', None), events)
+        histograms = instrumentation.histograms
+        self.assertGreaterEqual(histograms['register_lock.wait'].count, 1)
+        self.assertGreaterEqual(histograms['register_lock.hold'].count, 1)
+        message = document.get_message()
+        self.assertIsInstance(message, DocInfoMessage)
+        end = time.monotonic() + 10
+        while time.monotonic() < end:
+            histograms = instrumentation.histograms
+            if 'handle_message.DocInfoMessage' in histograms and 'wake_latency' in histograms:
+                break
+            time.sleep(0.01)
+        self.assertGreaterEqual(histograms['handle_message.DocInfoMessage'].count, 1)
+        self.assertGreaterEqual(histograms['wake_latency'].count, 1)
+        self.assertIn(('dispatch', 'call', None), events)
+        snapshot = instrumentation.snapshot(reset=True)
+        self.assertGreaterEqual(snapshot['histograms']['register_lock.hold']['count'], 1)
+        self.assertEqual(instrumentation.histograms, {})
+        # Without profiling, the register lock is not measured.
+        instrumentation.profile = False
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        self.assertNotIn('register_lock.hold', instrumentation.histograms)
+
+
+class HistogramTestCase(TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.count, 0)
+        self.assertIsNone(histogram.min)
+        self.assertIsNone(histogram.max)
+        self.assertIsNone(histogram.percentile(50))
+        self.assertEqual(histogram.buckets, [])
+        for value in 0, 1e-6, 3e-6, 1e-3, 1e6:
+            histogram.add(value)
+        self.assertEqual(histogram.count, 5)
+        self.assertAlmostEqual(histogram.total, 1e6 + 1.004e-3)
+        self.assertEqual(histogram.min, 0)
+        self.assertEqual(histogram.max, 1e6)
+        self.assertEqual(histogram.buckets, [(1e-6, 2), (4e-6, 1), (1024e-6, 1), (float('inf'), 1)])
+        self.assertEqual(histogram.percentile(0), 1e-6)
+        self.assertEqual(histogram.percentile(50), 4e-6)
+        self.assertEqual(histogram.percentile(100), float('inf'))
+        with self.assertRaisesString(ValueError, 'q must be between 0 and 100'):
+            histogram.percentile(101)
 
 
 class JobsTestCase(TestCase):
@@ -577,6 +1637,289 @@ class JobsTestCase(TestCase):
             DocumentDecodingJob()
 
 
+class AsyncTestCase(TestCase):
+
+    def test_async(self):
+        async def test():
+            context = Context()
+            document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+            message = await document.get_message_async()
+            self.assertIsInstance(message, DocInfoMessage)
+            pages = document.pages
+            await asyncio.gather(*(page.get_info_async() for page in pages))
+            for page in pages:
+                self.assertGreater(page.width, 0)
+                self.assertGreater(page.height, 0)
+            page_jobs = [page.decode(wait=False) for page in pages]
+            await asyncio.gather(*(page_job.wait_async() for page_job in page_jobs))
+            for page_job in page_jobs:
+                self.assertTrue(page_job.is_done)
+                self.assertIs(page_job.status, JobOK)
+                async for message in page_job:
+                    self.assertIsInstance(message, Message)
+                    self.assertIs(message.job, page_job)
+                    break
+            outline = await document.outline.sexpr_async()
+            self.assertIsInstance(outline, Expression)
+            annotations = await document.annotations.sexpr_async()
+            self.assertIsInstance(annotations, Expression)
+            text = await pages[0].text.sexpr_async()
+            self.assertIsInstance(text, Expression)
+
+        asyncio.run(test())
+
+
+class DeadlinesTestCase(TestCase):
+
+    def test_timeout(self):
+        self.assertTrue(issubclass(DeadlineExceeded, JobStopped))
+        context = Context()
+        document = context.new_document('dummy://dummy.djvu')
+        start = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            document.decoding_job.wait(timeout=0.05)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        document = context.new_document('dummy://dummy.djvu')
+        with self.assertRaises(DeadlineExceeded):
+            document.outline.wait(deadline=time.monotonic() + 0.05)
+        with self.assertRaises(DeadlineExceeded):
+            document.pages[0].get_info(timeout=0.05)
+        # Only the decoding job is stopped when its own deadline passes.
+        self.assertIs(document.decoding_status, JobStarted)
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        document.decoding_job.wait(timeout=60)
+        document.pages[0].get_info(timeout=60)
+        document.pages[0].text.wait(timeout=60)
+
+    def test_deadline(self):
+        context = Context()
+        with deadline(0.05) as end:
+            self.assertLessEqual(end, time.monotonic() + 0.05)
+            with deadline(60) as inner_end:
+                self.assertEqual(inner_end, end)
+            document = context.new_document('dummy://dummy.djvu')
+            with self.assertRaises(DeadlineExceeded):
+                document.decoding_job.wait()
+            document = context.new_document('dummy://dummy.djvu')
+            with self.assertRaises(DeadlineExceeded):
+                document.annotations.wait(timeout=60)
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        with deadline(60):
+            document.decoding_job.wait()
+            document.annotations.wait()
+
+    def test_async(self):
+        async def test():
+            context = Context()
+            document = context.new_document('dummy://dummy.djvu')
+            with deadline(0.05):
+                with self.assertRaises(DeadlineExceeded):
+                    await document.decoding_job.wait_async()
+            document = context.new_document('dummy://dummy.djvu')
+            while document.get_message(wait=False) is not None:
+                pass
+            with deadline(0.05):
+                with self.assertRaises(DeadlineExceeded):
+                    await document.get_message_async()
+            with deadline(0.05):
+                with self.assertRaises(DeadlineExceeded):
+                    await document.outline.wait_async()
+            # Waiting for a message or an S-expression did not stop decoding.
+            self.assertIs(document.decoding_status, JobStarted)
+
+        asyncio.run(test())
+
+
+class DocumentIndexTestCase(TestCase):
+
+    def test_index(self):
+        with self.assertRaisesString(TypeError, "cannot create 'djvu.decode.DocumentIndexEntry' instances"):
+            DocumentIndexEntry()
+        context = Context()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.djvu')
+            with open(IMAGES + 'test0.djvu', 'rb') as source, open(path, 'wb') as target:
+                target.write(source.read())
+            index_path = os.path.join(tmpdir, 'index.sqlite')
+            with DocumentIndex(index_path) as index:
+                self.assertEqual(len(index), 0)
+                self.assertIs(index.lookup(path), None)
+                entry = index.add(path, context)
+                self.assertIsInstance(entry, DocumentIndexEntry)
+                self.assertRepr(entry, '<djvu.decode.DocumentIndexEntry of 2 pages>')
+                self.assertEqual(len(index), 1)
+            document = context.new_document(FileUri(path))
+            table = document.page_info_table()
+            self.assertEqual(list(entry.page_info_table), list(table))
+            files = document.files
+            self.assertEqual(len(entry.file_table), len(files))
+            for file, info in zip(files, entry.file_table):
+                file.get_info()
+                self.assertEqual(info, (file.type, file.n_page, file.size, file.id, file.name, file.title))
+            has_text = []
+            for page in document.pages:
+                text = PageText(page, TEXT_DETAILS_PAGE)
+                text.wait()
+                has_text += [len(text.sexpr) > 0]
+            self.assertEqual(list(entry.has_text), has_text)
+            self.assertTrue(entry.has_text.readonly)
+            document.outline.wait()
+            self.assertEqual(entry.outline, document.outline.sexpr)
+            document.annotations.wait()
+            self.assertEqual(entry.annotations, document.annotations.sexpr)
+            with DocumentIndex(index_path) as index:
+                document = context.new_document(FileUri(path), index=index)
+                self.assertIsInstance(document.index_entry, DocumentIndexEntry)
+                # Served from the index, without waiting for the decoding.
+                self.assertEqual(len(document.pages), 2)
+                self.assertEqual(list(document.page_info_table(wait=False)), list(table))
+                self.assertEqual(document.pages[1].size, (table.width[1], table.height[1]))
+                self.assertEqual([page.has_text for page in document.pages], has_text)
+                self.assertEqual(len(document.files), len(entry.file_table))
+                self.assertIs(document.file_table(wait=False), entry.file_table)
+                self.assertEqual(document.files[0].type, entry.file_table.type[0])
+                self.assertEqual(document.outline.sexpr, entry.outline)
+                self.assertEqual(document.annotations.sexpr, entry.annotations)
+                document = context.new_document(FileUri(path))
+                self.assertIs(document.index_entry, None)
+                # Entries survive touching the file, but not changing it.
+                os.utime(path, ns=(0, 0))
+                self.assertIsInstance(index.lookup(path), DocumentIndexEntry)
+                # Replacing the file with different contents of the same size
+                # and modification time is noticed, too.
+                with open(path, 'rb') as file:
+                    data = bytearray(file.read())
+                data[-1] ^= 0xFF
+                new_path = os.path.join(tmpdir, 'new.djvu')
+                with open(new_path, 'wb') as file:
+                    file.write(data)
+                os.utime(new_path, ns=(0, 0))
+                os.replace(new_path, path)
+                self.assertIs(index.lookup(path), None)
+                with open(path, 'ab') as file:
+                    file.write(b'\0')
+                self.assertIs(index.lookup(path), None)
+                self.assertIs(context.new_document(FileUri(path), index=index).index_entry, None)
+                index.remove(path)
+                self.assertEqual(len(index), 0)
+
+    def test_text(self):
+        context = Context()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with DocumentIndex(os.path.join(tmpdir, 'index.sqlite')) as index:
+                entry = index.add(IMAGES + 'test1.djvu', context, text=False)
+                self.assertIs(entry.has_text, None)
+                self.assertEqual(list(entry.file_table), [('P', 0, None, 'test1.djvu', 'test1.djvu', 'test1.djvu')])
+                document = context.new_document(FileUri(IMAGES + 'test1.djvu'), index=index)
+                self.assertIs(document.index_entry.has_text, None)
+                document.pages[0].text.wait()
+                self.assertFalse(document.pages[0].has_text)
+
+
+class ForkTestCase(TestCase):
+
+    def test_fork(self):
+        if not hasattr(os, 'register_at_fork'):
+            self.skipTest('os.register_at_fork() is not available')
+        context = Context()
+        context.cache_size = 1 << 20
+        document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+        document.decoding_job.wait()
+        page_job_cache = PageJobCache()
+        document.page_job_cache = page_job_cache
+        document.pages[0].decode()
+        with warnings.catch_warnings():
+            # Forking a multi-threaded process is deprecated.
+            warnings.simplefilter('ignore', DeprecationWarning)
+            pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                signal.alarm(30)
+                # Documents created before fork() are abandoned.
+                document = None
+                self.assertEqual(context.cache_size, 1 << 20)
+                document = context.new_document(FileUri(IMAGES + 'test1.djvu'))
+                message = document.get_message()
+                self.assertIsInstance(message, DocInfoMessage)
+                page_job = document.pages[0].decode()
+                self.assertIs(page_job.status, JobOK)
+                # Jobs cached before fork() are abandoned, too.
+                self.assertEqual(len(page_job_cache), 1)
+                page_job_cache.clear()
+                self.assertEqual(len(page_job_cache), 0)
+                status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        page_job = document.pages[0].decode()
+        self.assertIs(page_job.status, JobOK)
+
+    def test_fork_stale(self):
+        if not hasattr(os, 'register_at_fork'):
+            self.skipTest('os.register_at_fork() is not available')
+        context = Context()
+        document = context.new_document(FileUri(IMAGES + 'test0.djvu'))
+        document.decoding_job.wait()
+        buffer_pool = RenderBufferPool()
+        render_cache = RenderCache()
+        with warnings.catch_warnings():
+            # Forking a multi-threaded process is deprecated.
+            warnings.simplefilter('ignore', DeprecationWarning)
+            pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                signal.alarm(30)
+                # Documents and jobs created before fork() refuse to wait.
+                with self.assertRaises(RuntimeError):
+                    document.get_message(wait=False)
+                with self.assertRaises(RuntimeError):
+                    document.decoding_job.wait()
+                with self.assertRaises(RuntimeError):
+                    document.pages[1].get_info()
+                with self.assertRaises(RuntimeError):
+                    document.pages[1].decode()
+                # Standalone pools and caches remain usable.
+                buffer_pool.release(buffer_pool.acquire(16))
+                buffer_pool.clear()
+                render_cache.clear()
+                self.assertEqual(len(render_cache), 0)
+                status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        page_job = document.pages[1].decode()
+        self.assertIs(page_job.status, JobOK)
+
+    def test_fork_index(self):
+        if not hasattr(os, 'register_at_fork'):
+            self.skipTest('os.register_at_fork() is not available')
+        context = Context()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with DocumentIndex(os.path.join(tmpdir, 'index.sqlite')) as index:
+                index.add(IMAGES + 'test1.djvu', context, text=False)
+                with warnings.catch_warnings():
+                    # Forking a multi-threaded process is deprecated.
+                    warnings.simplefilter('ignore', DeprecationWarning)
+                    pid = os.fork()
+                if pid == 0:
+                    status = 1
+                    try:
+                        signal.alarm(30)
+                        self.assertEqual(len(index), 1)
+                        self.assertIsNot(index.lookup(IMAGES + 'test1.djvu'), None)
+                        index.close()
+                        status = 0
+                    finally:
+                        os._exit(status)
+                _, status = os.waitpid(pid, 0)
+                self.assertEqual(status, 0)
+                self.assertEqual(len(index), 1)
+
+
 class AffineTransformsTestCase(TestCase):
 
     def test_bad_args(self):
@@ -890,6 +2233,7 @@ class WildcardImportTestCase(TestCase):
                 'Annotations',
                 'ChunkMessage',
                 'Context',
+                'ContextPool',
                 'DDJVU_VERSION',
                 'DOCUMENT_TYPE_BUNDLED',
                 'DOCUMENT_TYPE_INDIRECT',
@@ -897,12 +2241,16 @@ class WildcardImportTestCase(TestCase):
                 'DOCUMENT_TYPE_OLD_INDEXED',
                 'DOCUMENT_TYPE_SINGLE_PAGE',
                 'DOCUMENT_TYPE_UNKNOWN',
+                'DeadlineExceeded',
+                'DecodeScheduler',
                 'DocInfoMessage',
                 'Document',
                 'DocumentAnnotations',
                 'DocumentDecodingJob',
                 'DocumentExtension',
                 'DocumentFiles',
+                'DocumentIndex',
+                'DocumentIndexEntry',
                 'DocumentOutline',
                 'DocumentPages',
                 'ErrorMessage',
@@ -910,10 +2258,14 @@ class WildcardImportTestCase(TestCase):
                 'FILE_TYPE_PAGE',
                 'FILE_TYPE_THUMBNAILS',
                 'File',
+                'FileTable',
                 'FileURI',
                 'FileUri',
+                'Histogram',
                 'Hyperlinks',
+                'Image',
                 'InfoMessage',
+                'Instrumentation',
                 'Job',
                 'JobDone',
                 'JobException',
@@ -924,6 +2276,7 @@ class WildcardImportTestCase(TestCase):
                 'JobStarted',
                 'JobStopped',
                 'Message',
+                'MessageQueue',
                 'Metadata',
                 'NewStreamMessage',
                 'NotAvailable',
@@ -941,7 +2294,9 @@ class WildcardImportTestCase(TestCase):
                 'Page',
                 'PageAnnotations',
                 'PageInfoMessage',
+                'PageInfoTable',
                 'PageJob',
+                'PageJobCache',
                 'PageText',
                 'PixelFormat',
                 'PixelFormatGrey',
@@ -949,7 +2304,9 @@ class WildcardImportTestCase(TestCase):
                 'PixelFormatPalette',
                 'PixelFormatRgb',
                 'PixelFormatRgbMask',
+                'PixelFormatRgba',
                 'ProgressMessage',
+                'QueuePolicy',
                 'RENDER_BACKGROUND',
                 'RENDER_BLACK',
                 'RENDER_COLOR',
@@ -958,8 +2315,11 @@ class WildcardImportTestCase(TestCase):
                 'RENDER_MASK_ONLY',
                 'RedisplayMessage',
                 'RelayoutMessage',
+                'RenderBufferPool',
+                'RenderCache',
                 'SaveJob',
                 'Stream',
+                'Subscription',
                 'TEXT_DETAILS_ALL',
                 'TEXT_DETAILS_CHARACTER',
                 'TEXT_DETAILS_COLUMN',
@@ -970,6 +2330,7 @@ class WildcardImportTestCase(TestCase):
                 'TEXT_DETAILS_WORD',
                 'Thumbnail',
                 'ThumbnailMessage',
-                'cmp_text_zone'
+                'cmp_text_zone',
+                'deadline'
             ]
         )